@@ -2,10 +2,12 @@
 Entrypoint for the FNTC
 """
 import asyncio
-from .controller import start
+import signal
+from .controller import shutdown, start
 
 print("Starting the controller")
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, shutdown)
     while True:
         asyncio.run(start())
@@ -19,3 +19,29 @@ IMAGE = os.getenv("IMAGE")
 TAG = os.getenv("TAG")
 STORAGE_CLASS = os.getenv("STORAGE_CLASS")
 CRD_GROUP = os.getenv("CRD_GROUP")
+DELIVERY_CONFIG = os.getenv("DELIVERY_CONFIG", "controller/delivery.json")
+CONTROLLER_WORKERS = int(os.getenv("CONTROLLER_WORKERS", "4"))
+WATCH_QUEUE_SIZE = int(os.getenv("WATCH_QUEUE_SIZE", "100"))
+K8S_POOL_SIZE = int(os.getenv("K8S_POOL_SIZE", "16"))
+QUEUE_BASE_DELAY = float(os.getenv("QUEUE_BASE_DELAY", "0.05"))
+QUEUE_MAX_DELAY = float(os.getenv("QUEUE_MAX_DELAY", "60"))
+QUEUE_QPS = float(os.getenv("QUEUE_QPS", "10"))
+QUEUE_BURST = int(os.getenv("QUEUE_BURST", "100"))
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "").lower() == "true"
+LEASE_NAME = os.getenv("LEASE_NAME", "fn-task-controller")
+LEASE_DURATION = int(os.getenv("LEASE_DURATION", "15"))
+LEASE_RENEW_DEADLINE = int(os.getenv("LEASE_RENEW_DEADLINE", "10"))
+LEASE_RETRY_PERIOD = int(os.getenv("LEASE_RETRY_PERIOD", "2"))
+SHARDING = os.getenv("SHARDING", "").lower() == "true"
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+ANNOTATIONS_WINDOW = float(os.getenv("ANNOTATIONS_WINDOW", "0.05"))
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "500"))
+RESYNC_PERIOD = float(os.getenv("RESYNC_PERIOD", "300"))
+USER_TOKENS_SIZE = int(os.getenv("USER_TOKENS_SIZE", "256"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+USER_MISS_TTL = float(os.getenv("USER_MISS_TTL", "30"))
+USER_PAGE_SIZE = int(os.getenv("USER_PAGE_SIZE", "100"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP2 = os.getenv("HTTP2", "").lower() == "true"
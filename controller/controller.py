@@ -8,74 +8,338 @@ The lifecycle is documented through labels:
     - results: true     -> results fetched
     - done: true        -> All done, results pushed successfully
     - tries: <1:5>      -> There is a max of 5 retries with exponential waiting times
+    - retry_at: <date>  -> When the pending retry is due
+Each step is also mirrored on the CRD status, as conditions.
 """
+import asyncio
+from contextlib import aclosing
 from copy import deepcopy
+from http import HTTPStatus
 import logging
+import random
 import traceback
 from urllib3.exceptions import MaxRetryError, ProtocolError
 from kubernetes.watch import Watch
 from kubernetes.client.exceptions import ApiException
 
-from exceptions import BaseControllerException
-from helpers.kubernetes_helper import KubernetesCRD
-from helpers.actions import create_retry_job, sync_users, trigger_task, handle_results
+from const import RESYNC_PERIOD, SHARDING
+from exceptions import BaseControllerException, CRDException
+from helpers.kubernetes_helper import (
+    KubernetesCRD, analytics_cache, annotation_writer, crd_writes,
+    start_informers, stop_informers, task_pods
+)
+from helpers.keycloak_helper import user_directory
+from helpers.leader_election import leader_elector
+from helpers.sharding import shard_coordinator
+from helpers.actions import save_status, schedule_retry, sync_users, trigger_task, handle_results
+from helpers.request_helper import close_clients
+from helpers.retry_scheduler import retry_scheduler
+from helpers.watch_helper import ResumePoint, list_and_watch
+from helpers.workers import WorkerPool
 from models.crd import Analytics
 
 
 logger = logging.getLogger('controller')
 logger.setLevel(logging.INFO)
 
+# Shared across restarts of `start`, so reconnections don't replay every CRD
+crd_resume_point = ResumePoint()
+# Decides which CRDs this replica reconciles: a slice of them when sharded,
+# all or nothing with leader election, everything on a single replica
+coordinator = shard_coordinator if SHARDING else leader_elector
+# Each resync period is randomly stretched or shrunk up to this fraction
+RESYNC_JITTER = 0.1
 
-async def start(exit_on_tests=False):
+
+async def reconcile(crd: Analytics) -> Analytics | None:
     """
-    Effectively the entrypoint of the controller.
-    Accepts the `exit_on_tests` argument which is mostly,
-    as the name suggests, used for tests and has to be explicitly
-    set via a code change rather than an env var
+    Runs the next lifecycle step for a single CRD.
+    Called by the worker pool, so different CRDs are
+    reconciled concurrently, while the same CRD is never
+    processed by two workers at once.
+    The watch event caused by a step saving its progress is dropped,
+    so the CRD is returned, as it stands now, to be queued for
+    the next step
     """
+    if not coordinator.owns(crd.name):
+        # Handed over to another replica since it was queued
+        logger.info("%s is no longer reconciled by this replica", crd.name)
+        return None
     try:
-        watcher = Watch()
-        for crds in watcher.stream(
+        new_annotations = deepcopy(crd.annotations)
+        logger.info("Annotations: %s", new_annotations)
+        patched = None
+        if crd.needs_user_sync():
+            logger.info("Synching user")
+            patched = await sync_users(crd, new_annotations)
+        elif crd.can_trigger_task():
+            logger.info("Triggering task")
+            patched = await trigger_task(crd, new_annotations)
+        elif crd.can_deliver_results():
+            logger.info("Getting task results")
+            patched = await handle_results(crd, new_annotations)
+    except MaxRetryError as mre:
+        # in case of unreachable URLs we want to fail and exit
+        logger.error(mre.reason)
+        raise mre
+    except (BaseControllerException, ApiException) as ke:
+        await schedule_retry(crd)
+        logger.error(ke.reason)
+        return None
+    except KeyError:
+        # Possibly missing values, it shouldn't crash the pod
+        logger.error(traceback.format_exc())
+        return None
+    # pylint: disable=W0718
+    except Exception:
+        await schedule_retry(crd)
+        logger.error("Unknown error: %s", traceback.format_exc())
+        return None
+
+    if patched is None:
+        return None
+    crd.annotations = new_annotations
+    await save_status(crd)
+    return None if crd.should_skip() else crd
+
+
+async def enqueue(pool:WorkerPool, crds:dict) -> bool:
+    """
+    Parses a watch event and, unless the CRD lifecycle
+    is already over, queues it for reconciliation.
+    Returns whether the CRD was queued
+    """
+    if Analytics.skip_event(crds):
+        return False
+
+    crd = Analytics(crds)
+    logger.info("CRD: %s", crd.name)
+
+    if crd.should_skip():
+        logger.info("CRD already processed")
+        return False
+
+    if crd.name in retry_scheduler:
+        logger.info("Waiting for the scheduled retry")
+        return False
+    if crd.retry_in():
+        # Scheduled by a previous run of the controller
+        retry_scheduler.schedule(crd.name, crd.retry_in())
+        return False
+
+    await pool.submit(crd.name, crd)
+    return True
+
+
+def retry_from_cache(pool:WorkerPool):
+    """
+    Returns the callback the retry scheduler uses to queue
+    the latest version of a CRD, once its cooldown is over
+    """
+    async def retry(name:str):
+        obj = analytics_cache.get(name)
+        if obj is None or not coordinator.owns(name):
+            return
+        try:
+            await enqueue(pool, {"type": "MODIFIED", "object": obj})
+        except CRDException as exc:
+            logger.error(exc.reason)
+    return retry
+
+
+def analytics_names() -> list[str]:
+    """
+    Names of the Analytics objects in the cache
+    """
+    return [obj["metadata"]["name"] for obj in analytics_cache.list()]
+
+
+async def follow_ownership(pool:WorkerPool):
+    """
+    The watch only queues the CRDs this replica owns, the others
+    are just cached. When the ownership changes (leadership taken over,
+    shard members joining or leaving) the CRDs that were picked
+    up have to catch up, so they are queued from the cache, while
+    the ones given up are dropped from the queue
+    """
+    version = coordinator.version
+    owned = {name for name in analytics_names() if coordinator.owns(name)}
+    while True:
+        await asyncio.sleep(1)
+        if coordinator.version == version:
+            continue
+        version = coordinator.version
+        now_owned = {name for name in analytics_names() if coordinator.owns(name)}
+        if owned - now_owned:
+            logger.info("Gave up %d CRDs", len(owned - now_owned))
+        for name in owned - now_owned:
+            await pool.discard(name)
+        if now_owned - owned:
+            logger.info("Picked up %d CRDs, queueing them", len(now_owned - owned))
+        for name in now_owned - owned:
+            obj = analytics_cache.get(name)
+            if obj is None:
+                continue
+            try:
+                await enqueue(pool, {"type": "MODIFIED", "object": obj})
+            except CRDException as exc:
+                logger.error(exc.reason)
+        owned = now_owned
+
+
+def is_stale(crd:Analytics, pool:WorkerPool) -> bool:
+    """
+    Compares what the CRD needs next, from its annotations, with what
+    the controller is doing about it. A CRD with a step to run, that
+    is neither queued, reconciled, waiting on a retry, on its annotations
+    being written, nor on its task pod, has been lost track of.
+    Waiting on a task pod that's no longer there doesn't count
+    """
+    if not crd.has_next_step():
+        return False
+    task_id = crd.annotations.get(f"{crd.domain}/task_id")
+    return not (
+        pool.queue.active(crd.name)
+        or crd.name in retry_scheduler
+        or crd.name in annotation_writer
+        or (
+            task_id and task_pods.notifies(task_id, crd.name)
+            and task_pods.informer.by_index(task_pods.index, task_id)
+        )
+    )
+
+
+async def resync_once(pool:WorkerPool) -> int:
+    """
+    Walks the cached CRDs this replica owns, and queues the stale ones.
+    Nothing is listed from the API server. Returns how many were queued
+    """
+    queued = 0
+    for obj in analytics_cache.list():
+        event = {"type": "MODIFIED", "object": obj}
+        if Analytics.skip_event(event) or not coordinator.owns(obj["metadata"]["name"]):
+            continue
+        try:
+            if is_stale(Analytics(event), pool) and await enqueue(pool, event):
+                queued += 1
+        except CRDException as exc:
+            logger.error(exc.reason)
+    return queued
+
+
+async def resync(pool:WorkerPool, period:float=RESYNC_PERIOD):
+    """
+    Every `period` seconds, give or take some jitter so replicas
+    don't all go at once, catches up on CRDs whose events were missed.
+    Disabled if `period` isn't positive
+    """
+    if period <= 0:
+        return
+    while True:
+        await asyncio.sleep(period * random.uniform(1 - RESYNC_JITTER, 1 + RESYNC_JITTER))
+        queued = await resync_once(pool)
+        if queued:
+            logger.info("Resync queued %d stale CRDs", queued)
+
+
+async def watch_analytics(pool:WorkerPool, exit_on_tests=False):
+    """
+    Follows the Analytics objects, from where the previous watch
+    left off, or from a paginated list, queueing the ones this replica owns.
+    Returns once the stream ends, or the connection drops
+    """
+    watcher = Watch()
+    if crd_resume_point.version:
+        logger.info("Resuming watch from resourceVersion %s", crd_resume_point.version)
+    try:
+        async with aclosing(list_and_watch(
+            watcher,
+            crd_resume_point,
             KubernetesCRD().list_cluster_custom_object,
             Analytics.domain,
             "v1",
             "analytics"
-            ):
-            crd = Analytics(crds)
-            try:
-                logger.info("CRD: %s", crd.name)
-
-                if crd.should_skip():
-                    logger.info("CRD already processed")
+            )) as events:
+            async for crds in events:
+                if crds["type"] == "BOOKMARK":
+                    # Only carries the resourceVersion, which also helps
+                    # the watch itself to reconnect from there
+                    watcher.resource_version = crd_resume_point.version
+                    continue
+                previous = analytics_cache.get(crds["object"]["metadata"]["name"])
+                analytics_cache.apply(crds["type"], crds["object"])
+                if crds["type"] == "MODIFIED" and Analytics.unchanged(previous, crds["object"]):
+                    # i.e. a status write, nothing to reconcile
+                    continue
+                if crds["type"] == "DELETED":
+                    crd_writes.forget(crds["object"]["metadata"]["name"])
+                elif crd_writes.is_own(crds):
+                    # Caused by one of our own patches
+                    continue
+                if not coordinator.owns(crds["object"]["metadata"]["name"]):
                     continue
 
-                new_annotations = deepcopy(crd.annotations)
-                logger.info("Annotations: %s", new_annotations)
-                if crd.needs_user_sync():
-                    logger.info("Synching user")
-                    await sync_users(crd, new_annotations)
-                elif crd.can_trigger_task():
-                    logger.info("Triggering task")
-                    await trigger_task(crd, new_annotations)
-                elif crd.can_deliver_results():
-                    logger.info("Getting task results")
-                    await handle_results(crd, new_annotations)
+                if not await enqueue(pool, crds):
+                    continue
                 if exit_on_tests:
-                    watcher.stop()
+                    await pool.join()
                     break
-            except MaxRetryError as mre:
-                # in case of unreachable URLs we want to fail and exit
-                logger.error(mre.reason)
-                raise mre
-            except (BaseControllerException, ApiException) as ke:
-                await create_retry_job(crd)
-                logger.error(ke.reason)
-            except KeyError:
-                # Possibly missing values, it shouldn't crash the pod
-                logger.error(traceback.format_exc())
-            # pylint: disable=W0718
-            except Exception:
-                await create_retry_job(crd)
-                logger.error("Unknown error: %s", traceback.format_exc())
     except ProtocolError:
         logger.error("Connection expired. Restarting..")
+    except ApiException as exc:
+        if exc.status != HTTPStatus.GONE:
+            raise exc
+        # Too old to resume from, a full relist is needed
+        logger.info("resourceVersion %s expired. Relisting..", crd_resume_point.version)
+        crd_resume_point.reset()
+        analytics_cache.clear()
+
+
+def shutdown(_signum, _frame):
+    """
+    SIGTERM handler. Gives up this replica's ownership straight away,
+    rather than having the others wait for its Lease to expire
+    """
+    logger.info("Terminating, stopping the %s", type(coordinator).__name__)
+    coordinator.stop()
+    stop_informers()
+    raise SystemExit(0)
+
+
+async def start(exit_on_tests=False):
+    """
+    Effectively the entrypoint of the controller.
+    Accepts the `exit_on_tests` argument which is mostly,
+    as the name suggests, used for tests and has to be explicitly
+    set via a code change rather than an env var
+    """
+    start_informers()
+    user_directory.start()
+    coordinator.start()
+    # A fatal error in a worker stops the controller right away,
+    # rather than on the next event
+    main = asyncio.current_task()
+    # Tests only go through the step for the event they feed in
+    pool = WorkerPool(
+        reconcile,
+        follow_ups=not exit_on_tests,
+        on_error=lambda _exc: main.cancel()
+    )
+    pool.start()
+    retry_scheduler.attach(retry_from_cache(pool))
+    ownership = asyncio.create_task(follow_ownership(pool))
+    resyncing = asyncio.create_task(resync(pool))
+    try:
+        await watch_analytics(pool, exit_on_tests)
+        # The next watch resumes after the events already queued,
+        # so they are seen through, rather than dropped, before it starts
+        await pool.join()
+    except asyncio.CancelledError:
+        pool.raise_if_failed()
+        raise
+    finally:
+        ownership.cancel()
+        resyncing.cancel()
+        retry_scheduler.detach()
+        await pool.stop()
+        await close_clients()
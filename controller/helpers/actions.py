@@ -1,13 +1,11 @@
 import logging
-import asyncio
 
-from const import NAMESPACE
+from kubernetes.client.exceptions import ApiException
+
 from exceptions import CRDException
-from helpers.kubernetes_helper import (
-    KubernetesCRD, KubernetesV1Batch,
-    KubernetesV1
-)
-from helpers.pod_watcher import watch_task_pod, watch_user_pod
+from helpers.kubernetes_helper import AsyncKubernetesCRD, AsyncKubernetesV1Batch, annotation_writer
+from helpers.pod_watcher import completed_task_pod, deliver_results, watch_user_pod
+from helpers.retry_scheduler import retry_scheduler
 from helpers.task_helper import create_fn_task, get_user_token
 from models.crd import Analytics
 
@@ -20,68 +18,85 @@ logger.setLevel(logging.INFO)
 async def sync_users(crds: Analytics, annotations:dict):
     """
     Ensures that the user is already in keycloak and associated
-    with the gihub IdP
+    with the gihub IdP. Returns the patched CRD
     """
     # should trigger the user check
-    KubernetesV1Batch().create_helper_job(
+    job = await AsyncKubernetesV1Batch().create_helper_job(
         f"link-user",
         create_volumes=False,
         script="sync_user.sh",
-        labels=crds.labels,
+        labels={**crds.labels, **crds.owner_label},
         repository=crds.source["repository"],
         user=crds.user
     )
 
-    await watch_user_pod(crds, annotations)
+    return await watch_user_pod(crds, annotations, job.metadata.name)
 
 async def trigger_task(crd: Analytics, annotations):
     """
     Common function to setup all the info necessary
-    to send a FN API request, and the POST /tasks itself
+    to send a FN API request, and the POST /tasks itself.
+    Returns the patched CRD
     """
     user_token = await get_user_token(crd.user)
     logger.info("Creating task with image %s", crd.image)
 
-    task_resp = create_fn_task(crd, user_token)
+    task_resp = await create_fn_task(crd, user_token)
 
     annotations[f"{crd.domain}/done"] = "true"
     if "task_id" in task_resp:
         annotations[f"{crd.domain}/task_id"] = str(task_resp["task_id"])
-    client = KubernetesCRD()
-    client.patch_crd_annotations(crd.name, annotations)
+    return await annotation_writer.write(crd, annotations)
 
 async def handle_results(crd: Analytics, annotations:dict):
     """
-    Common function to handle a CRD last lifecycle step
+    Common function to handle a CRD last lifecycle step.
+    If the task pod is still running, the CRD comes back
+    once it's done. Returns the patched CRD, if the controller patched it
     """
-    # If we have already triggered a task, check if the pod has completed
-    # loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
-    monitor = asyncio.create_task(
-        watch_task_pod(
-            crd,
-            annotations[f"{Analytics.domain}/task_id"],
-            await get_user_token(crd.user),
-            annotations
-        )
-    )
-    await asyncio.gather(monitor)
+    task_id = annotations[f"{Analytics.domain}/task_id"]
+    pod = completed_task_pod(crd, task_id)
+    if pod is None:
+        return None
+    return await deliver_results(crd, pod, await get_user_token(crd.user), annotations)
 
-async def create_retry_job(crd:Analytics):
+async def save_status(crd:Analytics):
     """
-    Wrapper to create a job that updates the CRD
-    with an increasing delay. It will retry up to
-    MAX_RETRIES times.
+    Mirrors the CRD lifecycle on its status. It doesn't fail
+    the step, as the annotations are already saved
     """
+    status = crd.lifecycle_status()
     try:
-        existing_updates = KubernetesV1().list_namespaced_pod(
-            NAMESPACE,
-            label_selector=f"crd={crd.name}",
-            field_selector="status.phase=Pending,status.phase=Running"
-        )
-        if existing_updates.items:
-            logging.info("Anoter annotation update is in progress..")
-            return
+        await AsyncKubernetesCRD().patch_crd_status(crd.name, status)
+    except ApiException as exc:
+        logger.error("Failed to update the status of %s: %s", crd.name, exc.reason)
+        return
+    crd.conditions = status["conditions"]
 
-        KubernetesV1Batch().create_bare_job(**crd.prepare_update_job())
-    except CRDException:
-        pass
+async def schedule_retry(crd:Analytics):
+    """
+    Puts the CRD back in the queue after an increasing
+    delay. It will retry up to MAX_RETRIES times.
+    The attempt is recorded on the CRD, along with its due time,
+    so the retry survives a controller restart
+    """
+    if crd.name in retry_scheduler:
+        logger.info("A retry is already scheduled for %s", crd.name)
+        return
+    try:
+        annotations = {**crd.annotations, **crd.next_retry()}
+    except CRDException as exc:
+        logger.info(exc.reason)
+        return
+
+    try:
+        await annotation_writer.write(crd, annotations)
+        saved = True
+    except ApiException as exc:
+        # Still retried, just not resumed if the controller restarts meanwhile
+        logger.error("Failed to record the retry for %s: %s", crd.name, exc.reason)
+        saved = False
+    crd.annotations = annotations
+    if saved:
+        await save_status(crd)
+    retry_scheduler.schedule(crd.name, crd.retry_in())
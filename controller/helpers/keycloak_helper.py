@@ -4,16 +4,31 @@ Both kubernetes and keycloak standard operations
 - keycloak will have different functions in a way
     to not tamper the __main__ with API calls and the
     status_code checks
+- the admin token is cached until shortly before it expires,
+    and renewed once for all of the callers needing it
+- so are the users' impersonation tokens, for a bounded number
+    of users, the least recently used being dropped first
+- users are looked up in a local index, prefetched in bulk,
+    with the ones not found remembered for a while
 """
 
+import asyncio
 import os
 import logging
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Awaitable, Callable
 
 import httpx
 
 from exceptions import KeycloakException
-from helpers.kubernetes_helper import KubernetesV1
-from const import KC_USER, KC_HOST
+from helpers.kubernetes_helper import AsyncKubernetesV1
+from helpers.request_helper import keycloak
+from const import (
+    KC_USER, KC_HOST, USER_CACHE_TTL, USER_MISS_TTL,
+    USER_PAGE_SIZE, USER_TOKENS_SIZE
+)
 
 logger = logging.getLogger('keycloak_helper')
 logger.setLevel(logging.INFO)
@@ -22,6 +37,52 @@ logger.setLevel(logging.INFO)
 KEYCLOAK_CLIENT = "global"
 REALM = "FederatedNode"
 KC_HOST = os.getenv("KC_HOST")
+# Seconds before their expiry cached tokens are renewed
+TOKEN_LEEWAY = 30
+
+
+class TokenCache:
+    """
+    Keeps a token until `leeway` seconds before it expires.
+    `fetch` is expected to return the token along with its
+    lifetime in seconds (`expires_in`).
+    Callers finding it expired at the same time share one
+    request for a new one, rather than sending one each
+    """
+    def __init__(self, fetch:Callable[[], Awaitable[tuple[str, float]]], leeway:float=TOKEN_LEEWAY):
+        self.fetch = fetch
+        self.leeway = leeway
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh: asyncio.Task = None
+
+    async def get(self, force:bool=False) -> str:
+        """
+        Returns the cached token, unless it's expired or `force`
+        is set, i.e. after the token has been rejected
+        """
+        if not force and self._token and time.monotonic() < self._expires_at:
+            return self._token
+        if self._refresh is None:
+            self._refresh = asyncio.create_task(self._renew())
+        # A caller being cancelled doesn't cancel the others' request
+        return await asyncio.shield(self._refresh)
+
+    def clear(self):
+        """
+        Drops the cached token
+        """
+        self._token = None
+        self._expires_at = 0.0
+
+    async def _renew(self) -> str:
+        try:
+            token, expires_in = await self.fetch()
+            self._token = token
+            self._expires_at = time.monotonic() + max(expires_in - self.leeway, 0)
+            return token
+        finally:
+            self._refresh = None
 
 
 async def get_keycloak_secret() -> str:
@@ -29,21 +90,22 @@ async def get_keycloak_secret() -> str:
     Simple generalization to get keycloak secret, as it has
     fixed keys in it
     """
-    return KubernetesV1().get_secret('kc-secrets', 'KEYCLOAK_SECRET')
+    return await AsyncKubernetesV1().get_secret('kc-secrets', 'KEYCLOAK_SECRET')
 
 async def get_keycloak_admin_pass() -> str:
     """
     Simple generalization to get the specific admin key
     for the keycloak secret
     """
-    return KubernetesV1().get_secret('kc-secrets', 'KEYCLOAK_ADMIN_PASSWORD')
+    return await AsyncKubernetesV1().get_secret('kc-secrets', 'KEYCLOAK_ADMIN_PASSWORD')
 
-async def get_admin_token() -> str:
+async def request_admin_token() -> tuple[str, float]:
     """
     Simply send a request to Keycloak to get the admin token
-    based on the password fetched from the k8s secret itself
+    based on the password fetched from the k8s secret itself.
+    Returns the token, and its lifetime in seconds
     """
-    admin_resp = httpx.post(
+    admin_resp = await keycloak.get().post(
         f"{KC_HOST}/realms/{REALM}/protocol/openid-connect/token",
         data={
             'client_id': KEYCLOAK_CLIENT,
@@ -58,61 +120,301 @@ async def get_admin_token() -> str:
     )
     if admin_resp.status_code > 299:
         raise KeycloakException("Failed to login")
-    return admin_resp.json()["access_token"]
+    body = admin_resp.json()
+    return body["access_token"], body.get("expires_in", 60)
 
 
-async def get_user(email:str=None, username:str=None, idpId:str=None) -> dict:
+admin_token = TokenCache(request_admin_token)
+
+
+async def get_admin_token() -> str:
     """
-    Method to return a dictionary representing a Keycloak user
+    Returns the cached admin token, requesting a new one if needed
     """
-    admin_token = await get_admin_token()
-    if idpId:
-        params = {"idpUserId": idpId}
-    elif email:
-        params={
-            "email": email,
-            "exact": True
-        }
-    elif username:
-        params={
-            "email": email,
-            "exact": True
-        }
-    else:
-        raise KeycloakException("Either email or username are needed")
+    return await admin_token.get()
 
-    user_response = httpx.get(f"{KC_HOST}/admin/realms/{REALM}/users",
-        params=params,
-        headers={"Authorization": f"Bearer {admin_token}"}
-    )
+
+async def with_admin_token(send:Callable[[str], Awaitable[httpx.Response]]) -> httpx.Response:
+    """
+    Calls `send` with the admin token. If Keycloak rejects
+    it (401), a new one is requested, and `send` called once more
+    """
+    response = await send(await admin_token.get())
+    if response.status_code == HTTPStatus.UNAUTHORIZED:
+        logger.info("Admin token rejected, renewing it")
+        response = await send(await admin_token.get(force=True))
+    return response
+
+
+async def query_users(params:dict) -> list[dict]:
+    """
+    Sends a search to the Keycloak users endpoint
+    """
+    async def send(token:str) -> httpx.Response:
+        return await keycloak.get().get(f"{KC_HOST}/admin/realms/{REALM}/users",
+            params=params,
+            headers={"Authorization": f"Bearer {token}"}
+        )
+
+    user_response = await with_admin_token(send)
     if user_response.status_code > 299:
         raise KeycloakException(user_response.content.decode())
-    if len(user_response.json()):
-        return user_response.json()[0]
+    return user_response.json()
+
+
+class UserDirectory:
+    """
+    Local index of the Keycloak users, by id, email, username
+    and federated identity (idpId).
+    - `prefetch` fills it with paginated bulk listings
+    - every entry expires after `ttl` seconds, and is then
+        looked up again on its own, next time it's needed
+    - users not found are remembered for `miss_ttl` seconds,
+        so a burst of lookups for them costs one request
+    - expired entries are pruned as new ones are looked up
+    Concurrent lookups for the same key share one request
+    """
+    QUERIES = {
+        "idpId": lambda value: {"idpUserId": value},
+        "email": lambda value: {"email": value, "exact": True},
+        "username": lambda value: {"username": value, "exact": True}
+    }
+
+    def __init__(
+            self,
+            ttl:float=USER_CACHE_TTL,
+            miss_ttl:float=USER_MISS_TTL,
+            page_size:int=USER_PAGE_SIZE
+        ):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.page_size = page_size
+        self._entries: dict[tuple[str, str], tuple[dict | None, float]] = {}
+        self._next_prune = 0.0
+        self._lookups: dict[tuple[str, str], asyncio.Task] = {}
+        self._prefetch: asyncio.Task = None
+        self._prefetched = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, field:str, value:str) -> dict:
+        """
+        Returns the user with `field` (one of `QUERIES`) matching
+        `value`, raises a KeycloakException if there isn't one
+        """
+        key = self._key(field, value)
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[1]:
+            if key not in self._lookups:
+                self._lookups[key] = asyncio.create_task(self._lookup(key))
+            # A caller being cancelled doesn't cancel the others' request
+            entry = await asyncio.shield(self._lookups[key])
+        if entry[0] is None:
+            raise KeycloakException(f"User {value} not found")
+        return entry[0]
+
+    def start(self):
+        """
+        Runs the bulk prefetch in the background, unless
+        it's running or has completed already
+        """
+        if self._prefetched or (self._prefetch and not self._prefetch.done()):
+            return
+        self._prefetch = asyncio.create_task(self.prefetch())
+
+    async def prefetch(self):
+        """
+        Lists every user, a page at a time, and indexes them.
+        Failures are only logged, lookups will go to Keycloak
+        for the users that weren't indexed
+        """
+        first = 0
+        try:
+            while True:
+                users = await query_users({"first": first, "max": self.page_size})
+                for user in users:
+                    self.add(user)
+                if len(users) < self.page_size:
+                    break
+                first += len(users)
+        except (KeycloakException, httpx.HTTPError) as exc:
+            logger.error("Failed to prefetch the Keycloak users: %s", exc)
+            return
+        self._prefetched = True
+        logger.info("Indexed %d Keycloak users", first + len(users))
+
+    def add(self, user:dict, *keys:tuple[str, str]):
+        """
+        Indexes a user under its id, email, username and federated
+        identities, if listed, plus any other `keys` it was found by
+        """
+        entry = (user, time.monotonic() + self.ttl)
+        found_by = [(field, user.get(field)) for field in ("id", "email", "username")]
+        found_by += [
+            ("idpId", identity.get("userId"))
+            for identity in user.get("federatedIdentities", [])
+        ]
+        for field, value in found_by:
+            if value:
+                self._entries[self._key(field, value)] = entry
+        for key in keys:
+            self._entries[key] = entry
 
-    raise KeycloakException(f"User {email or idpId or username} not found")
+    def clear(self):
+        """
+        Drops every user, and allows a new prefetch
+        """
+        self._entries.clear()
+        self._next_prune = 0.0
+        self._prefetched = False
 
+    def prune(self):
+        """
+        Drops the expired entries, misses included. It's a walk through
+        the whole index, so it's done at most once every `miss_ttl` seconds
+        """
+        now = time.monotonic()
+        if now < self._next_prune:
+            return
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[1] > now}
+        self._next_prune = now + self.miss_ttl
 
-async def impersonate_user(user_id:str) -> str:
+    async def _lookup(self, key:tuple[str, str]) -> tuple[dict | None, float]:
+        field, value = key
+        try:
+            users = await query_users(self.QUERIES[field](value))
+            self.prune()
+            if users:
+                self.add(users[0], key)
+            else:
+                self._entries[key] = (None, time.monotonic() + self.miss_ttl)
+            return self._entries[key]
+        finally:
+            del self._lookups[key]
+
+    @staticmethod
+    def _key(field:str, value:str) -> tuple[str, str]:
+        # Keycloak treats emails and usernames as case insensitive
+        return field, value.lower() if field in ("email", "username") else value
+
+
+user_directory = UserDirectory()
+
+
+async def get_user(email:str=None, username:str=None, idpId:str=None) -> dict:
+    """
+    Method to return a dictionary representing a Keycloak user,
+    from the local directory, or Keycloak if it's not there
+    """
+    if idpId:
+        return await user_directory.get("idpId", idpId)
+    if email:
+        return await user_directory.get("email", email)
+    if username:
+        return await user_directory.get("username", username)
+    raise KeycloakException("Either email or username are needed")
+
+
+async def impersonate_user(user_id:str) -> tuple[str, float]:
     """
     Given a user id, it will return a refresh_token for it
-    through the admin-level user
+    through the admin-level user, and its lifetime in seconds
+    """
+    client_secret = await get_keycloak_secret()
+
+    async def send(token:str) -> httpx.Response:
+        return await keycloak.get().post(
+            f"{KC_HOST}/realms/{REALM}/protocol/openid-connect/token",
+            data={
+                'client_secret': client_secret, # Target client
+                'client_id': KEYCLOAK_CLIENT, #Target client
+                'grant_type': 'urn:ietf:params:oauth:grant-type:token-exchange',
+                'requested_token_type': 'urn:ietf:params:oauth:token-type:refresh_token',
+                'subject_token': token,
+                'requested_subject': user_id,
+                'audience': KEYCLOAK_CLIENT
+            },
+            headers={
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+        )
+
+    exchange_resp = await with_admin_token(send)
+    if exchange_resp.status_code > 299:
+        raise KeycloakException(exchange_resp.content.decode())
+    body = exchange_resp.json()
+    return body["refresh_token"], body.get("refresh_expires_in") or 60
+
+
+async def refresh_user_token(refresh_token:str) -> tuple[str, float]:
+    """
+    Given a user's refresh_token, it will return a new access
+    token for that user, and its lifetime in seconds
     """
-    exchange_resp = httpx.post(
+    refresh_resp = await keycloak.get().post(
         f"{KC_HOST}/realms/{REALM}/protocol/openid-connect/token",
         data={
-            'client_secret': await get_keycloak_secret(), # Target client
-            'client_id': KEYCLOAK_CLIENT, #Target client
-            'grant_type': 'urn:ietf:params:oauth:grant-type:token-exchange',
-            'requested_token_type': 'urn:ietf:params:oauth:token-type:refresh_token',
-            'subject_token': await get_admin_token(),
-            'requested_subject': user_id,
-            'audience': KEYCLOAK_CLIENT
+            'client_secret': await get_keycloak_secret(),
+            'client_id': KEYCLOAK_CLIENT,
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
         },
         headers={
             'Content-Type': 'application/x-www-form-urlencoded'
         }
     )
-    if exchange_resp.status_code > 299:
-        raise KeycloakException(exchange_resp.content.decode())
-    return exchange_resp.json()["refresh_token"]
+    if refresh_resp.status_code > 299:
+        raise KeycloakException(refresh_resp.content.decode())
+    body = refresh_resp.json()
+    return body["access_token"], body.get("expires_in", 60)
+
+
+class UserTokens:
+    """
+    Impersonation tokens, by Keycloak user id. The refresh token from
+    the exchange is kept, and access tokens are minted from it, so a
+    user with many CRDs is only impersonated once per session.
+    At most `size` users are kept, least recently used out first
+    """
+    def __init__(self, size:int=USER_TOKENS_SIZE):
+        self.size = size
+        self._users: OrderedDict[str, TokenCache] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    async def get(self, user_id:str) -> str:
+        """
+        Returns an access token for the user
+        """
+        access = self._users.get(user_id)
+        if access is None:
+            access = self._users[user_id] = self._tokens(user_id)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return await access.get()
+
+    def clear(self):
+        """
+        Drops every user's tokens
+        """
+        self._users.clear()
+
+    @staticmethod
+    def _tokens(user_id:str) -> TokenCache:
+        refresh = TokenCache(lambda: impersonate_user(user_id))
+
+        async def mint() -> tuple[str, float]:
+            refresh_token = await refresh.get()
+            try:
+                return await refresh_user_token(refresh_token)
+            except KeycloakException:
+                # The session might have ended, impersonating again
+                return await refresh_user_token(await refresh.get(force=True))
+        return TokenCache(mint)
+
+
+user_tokens = UserTokens()
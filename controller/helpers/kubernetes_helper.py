@@ -1,30 +1,84 @@
 """
 K8s helpers functions
-    - set the configuration
-    - fetch a secret and decode a given key
+    - set the configuration, once, on an ApiClient shared by every client
+    - fetch a secret and decode a given key, from a watch-backed
+        cache of the namespace's secrets, decoded once, if it has it
+    - awaitable versions of the clients, so API calls don't block the event loop
+    - write the CRD annotations behind the callers, coalescing the
+        changes made close together into a single merge patch
+    - keep local, watch-backed caches (informers) of the resources
+        the controller keeps asking about, and dispatch their events
+        to whoever is waiting on a specific object
 """
 
+import asyncio
+import functools
 import os
 import re
 import base64
+import json
 from datetime import datetime
+from http import HTTPStatus
 import logging
+import threading
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable
 
 from uuid import uuid4
 from kubernetes import client
 from kubernetes.config import load_kube_config, load_incluster_config
 from kubernetes.client.exceptions import ApiException
+from kubernetes.watch import Watch
 
 from exceptions import KubernetesException
 from const import (
-    NAMESPACE, IMAGE, MOUNT_PATH,
+    NAMESPACE, IMAGE, MOUNT_PATH, K8S_POOL_SIZE, ANNOTATIONS_WINDOW,
     PULL_POLICY, STORAGE_CLASS, TAG, KC_USER, KC_HOST, TASK_NAMESPACE
 )
+from helpers.watch_helper import RawWatch, ResumePoint, SelfWrites, lean_decoder
 from models.crd import Analytics
 
 logger = logging.getLogger('k8s_helpers')
 logger.setLevel(logging.INFO)
 
+# What the controller last wrote on each CRD
+crd_writes = SelfWrites()
+
+_api_client = None
+_api_client_lock = threading.Lock()
+
+
+def shared_api_client() -> client.ApiClient:
+    """
+    Returns the process-wide ApiClient, creating it on first use.
+    If KUBERNETES_PORT is in the env, means we are on a cluster,
+    otherwise load_kube_config will look into ~/.kube.
+    The in-cluster configuration re-reads the service account
+    token when it's rotated, so every client picks it up.
+    The urllib3 pool is thread safe, and sized so the workers
+    and the watch threads don't queue for a connection
+    """
+    global _api_client  # pylint: disable=W0603
+    with _api_client_lock:
+        if _api_client is None:
+            configuration = client.Configuration()
+            if 'KUBERNETES_PORT' in os.environ:
+                load_incluster_config(client_configuration=configuration)
+            else:
+                load_kube_config(client_configuration=configuration)
+            configuration.connection_pool_maxsize = K8S_POOL_SIZE
+            _api_client = client.ApiClient(configuration)
+        return _api_client
+
+
+def reset_api_client():
+    """
+    Drops the shared ApiClient, the next client will load the configuration again
+    """
+    global _api_client  # pylint: disable=W0603
+    with _api_client_lock:
+        _api_client = None
+
 
 class BaseK8s:
     """
@@ -35,14 +89,10 @@ class BaseK8s:
     }
     def __init__(self, **kwargs):
         """
-        Configure the k8s client, if KUBERNETES_PORT
-        is in the env, means we are on a cluster, otherwise
-        load_kube_config will look into ~/.kube
+        Configure the k8s client on top of the shared ApiClient,
+        so connections and configuration are reused across instances
         """
-        if 'KUBERNETES_PORT' in os.environ:
-            load_incluster_config()
-        else:
-            load_kube_config()
+        kwargs.setdefault("api_client", shared_api_client())
         super().__init__(**kwargs)
 
     def repo_secret_name(self, repository:str):
@@ -56,18 +106,51 @@ class KubernetesCRD(BaseK8s, client.CustomObjectsApi):
     """
     Custom k8s client wrapper to handle CRD operations
     """
-    def patch_crd_annotations(self, name:str, annotations:dict):
+    def patch_crd_annotations(self, name:str, changes:dict, annotations:dict=None):
         """
-        Since it's too verbose, and has to get a "patch" dedicated to it
-        the annotation update is done here.
+        Sends the changed annotations only, as a JSON merge patch,
+        so the ones set meanwhile by others (i.e. approved) are left
+        alone. A `None` value removes the annotation.
+        `annotations`, the whole map expected once patched, is recorded
+        so the controller can ignore the watch event it causes
         """
-        # Patch for the client library which somehow doesn't do it itself for the patch
-        self.api_client.set_default_header('Content-Type', 'application/json-patch+json')
-        self.patch_cluster_custom_object(
+        if annotations is None:
+            annotations = {key: val for key, val in changes.items() if val is not None}
+        previous = crd_writes.expect(name, annotations)
+        try:
+            # The client library doesn't pick the merge-patch content type by itself.
+            # It's set on the request, as the ApiClient and its headers are shared
+            patched = self.patch_cluster_custom_object(
+                Analytics.domain, "v1", "analytics", name,
+                {"metadata": {"annotations": changes}},
+                _content_type='application/merge-patch+json'
+            )
+        except Exception:
+            crd_writes.restore(name, previous)
+            raise
+        crd_writes.record(name, patched)
+        logger.info("CRD patched")
+        return patched
+
+    def patch_crd_status(self, name:str, status:dict):
+        """
+        Writes the CRD status through its subresource, which doesn't
+        bump the generation. As with annotations, the watch event it
+        causes is recorded to be ignored
+        """
+        patched = self.patch_cluster_custom_object_status(
             Analytics.domain, "v1", "analytics", name,
-            [{"op": "add", "path": "/metadata/annotations", "value": annotations}]
+            {"status": status},
+            _content_type='application/merge-patch+json'
         )
-        logger.info("CRD patched")
+        crd_writes.record(name, patched)
+        return patched
+
+
+class KubernetesCoordination(BaseK8s, client.CoordinationV1Api):
+    """
+    Custom k8s client wrapper for Lease objects
+    """
 
 
 class KubernetesV1(BaseK8s, client.CoreV1Api):
@@ -77,20 +160,29 @@ class KubernetesV1(BaseK8s, client.CoreV1Api):
     """
     def get_secret(self, name:str, key:str, namespace:str=NAMESPACE) -> str:
         """
-        Returns a secret decoded value from a secret name, and its key
+        Returns a secret decoded value from a secret name, and its key.
+        Read from the secrets informer, if it has it
         """
+        cached = cached_secret(name, namespace)
+        if cached is not None:
+            return cached[key]
         secret = self.read_namespaced_secret(name, namespace)
         return base64.b64decode(secret.data[key].encode()).decode()
 
-    def get_secret_by_label(self, label:str, namespace:str=NAMESPACE):
+    def get_secret_by_label(self, label:str, namespace:str=NAMESPACE) -> dict[str, str]:
         """
-        Gets the list of secrets with the label, and return the first match
+        Gets the list of secrets with the label, and return the
+        decoded data of the first match.
+        Read from the secrets informer, if it has it
         """
+        cached = cached_secret_by_label(label, namespace)
+        if cached is not None:
+            return cached
         secrets_list = self.list_namespaced_secret(namespace=namespace, label_selector=label)
-        if not secrets_list:
+        if not secrets_list.items:
             raise KubernetesException(f"No secrets found with label(s) {label}")
 
-        return secrets_list.items[0]
+        return decode_secret_data(secrets_list.items[0].data)
 
     def setup_pvc(self, name:str) -> str:
         """
@@ -320,3 +412,591 @@ class KubernetesV1Batch(BaseK8s, client.BatchV1Api):
             )
         except ApiException as exc:
             raise KubernetesException(exc.body) from exc
+        return base_job
+
+
+class AsyncK8s:
+    """
+    Awaitable facade over one of the clients above.
+    It exposes the same methods, with the same arguments, as the
+    wrapped class, but each call runs on a worker thread so the event
+    loop carries on with other CRDs and HTTP requests meanwhile
+    """
+    sync_class: type
+
+    def __init__(self, **kwargs):
+        self.sync = self.sync_class(**kwargs)
+
+    def __getattr__(self, name:str):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return call
+
+
+class AsyncKubernetesCRD(AsyncK8s):
+    """
+    Awaitable KubernetesCRD
+    """
+    sync_class = KubernetesCRD
+
+
+class AsyncKubernetesV1(AsyncK8s):
+    """
+    Awaitable KubernetesV1. Secrets the informer has are
+    returned straight away, rather than from a worker thread
+    """
+    sync_class = KubernetesV1
+
+    async def get_secret(self, name:str, key:str, namespace:str=NAMESPACE) -> str:
+        """
+        Awaitable KubernetesV1.get_secret
+        """
+        cached = cached_secret(name, namespace)
+        if cached is not None:
+            return cached[key]
+        return await asyncio.to_thread(self.sync.get_secret, name, key, namespace=namespace)
+
+    async def get_secret_by_label(self, label:str, namespace:str=NAMESPACE) -> dict[str, str]:
+        """
+        Awaitable KubernetesV1.get_secret_by_label
+        """
+        cached = cached_secret_by_label(label, namespace)
+        if cached is not None:
+            return cached
+        return await asyncio.to_thread(self.sync.get_secret_by_label, label, namespace=namespace)
+
+
+class AsyncKubernetesV1Batch(AsyncK8s):
+    """
+    Awaitable KubernetesV1Batch
+    """
+    sync_class = KubernetesV1Batch
+
+
+class AnnotationWriter:
+    """
+    Write-behind writer for the CRD annotations. Changes to the same
+    CRD made within `window` seconds of each other are sent together,
+    as a single merge patch, and every caller gets the patched CRD back.
+    Conflicts are retried, as the patch doesn't depend on what it
+    was computed from
+    """
+    def __init__(self, window:float=ANNOTATIONS_WINDOW, conflict_retries:int=3):
+        self.window = window
+        self.conflict_retries = conflict_retries
+        self._pending: dict[str, dict] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def __contains__(self, name:str) -> bool:
+        return name in self._pending
+
+    async def write(self, crd:Analytics, annotations:dict) -> dict:
+        """
+        Saves `annotations` as the new annotations of `crd`,
+        sending only what differs from the ones it was read with
+        """
+        changes = {key: val for key, val in annotations.items() if crd.annotations.get(key) != val}
+        changes.update({key: None for key in crd.annotations if key not in annotations})
+        pending = self._pending.get(crd.name)
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            pending = self._pending[crd.name] = {
+                "changes": {}, "annotations": {}, "result": loop.create_future()
+            }
+            loop.call_later(self.window, self._flush, crd.name)
+        pending["changes"].update(changes)
+        pending["annotations"].update(annotations)
+        for key, val in changes.items():
+            if val is None:
+                pending["annotations"].pop(key, None)
+        # One caller being cancelled doesn't cancel the write for the others
+        return await asyncio.shield(pending["result"])
+
+    def _flush(self, name:str):
+        pending = self._pending.pop(name)
+        task = asyncio.create_task(self._send(name, pending), name=f"annotations-{name}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, name:str, pending:dict):
+        result = pending["result"]
+        for attempt in range(self.conflict_retries + 1):
+            try:
+                patched = await AsyncKubernetesCRD().patch_crd_annotations(
+                    name, pending["changes"], pending["annotations"]
+                )
+            except ApiException as exc:
+                if exc.status == HTTPStatus.CONFLICT and attempt < self.conflict_retries:
+                    logger.info("Conflict patching %s, retrying", name)
+                    await asyncio.sleep(0.1 * 2 ** attempt)
+                    continue
+                result.set_exception(exc)
+            # pylint: disable=W0718
+            except Exception as exc:
+                result.set_exception(exc)
+            else:
+                result.set_result(patched)
+            break
+
+
+annotation_writer = AnnotationWriter()
+
+
+def _field(obj:Any, *path:str) -> Any:
+    """
+    Reads a nested field from either a raw dictionary (custom objects)
+    or a kubernetes model (snake_case attributes)
+    """
+    for step in path:
+        if obj is None:
+            return None
+        if isinstance(obj, dict):
+            obj = obj.get(step)
+        else:
+            obj = getattr(obj, re.sub(r'(?<!^)(?=[A-Z])', '_', step).lower(), None)
+    return obj
+
+
+def label_indexer(*labels:str) -> Callable[[Any], list]:
+    """
+    Indexes an object by the values of one or more of its labels
+    """
+    def index(obj:Any) -> list:
+        obj_labels = _field(obj, "metadata", "labels") or {}
+        return [obj_labels[label] for label in labels if obj_labels.get(label)]
+    return index
+
+
+class Informer:
+    """
+    In-memory copy of a resource type, kept up to date with one list
+    and then one long-lived watch, so that lookups don't go to the API server.
+    Objects are stored by namespace/name and can be looked up through
+    secondary indexes, each being a function returning the index values
+    for a given object.
+
+    When no list function is set, the informer doesn't watch by itself,
+    and it's up to the owner to feed it through `apply`
+    (i.e. the controller's own Analytics watch).
+
+    With a `decoder`, the list and the watch skip the kubernetes models
+    altogether, and the cache holds whatever the decoder makes of each
+    object's raw JSON.
+    """
+    def __init__(
+            self,
+            name:str,
+            client_class:type=None,
+            list_method:str=None,
+            *args,
+            indexers:dict[str, Callable[[Any], list]]=None,
+            decoder:Callable[[dict], Any]=None,
+            **kwargs
+        ):
+        self.name = name
+        self.client_class = client_class
+        self.list_method = list_method
+        self.args = args
+        self.kwargs = kwargs
+        self.indexers = indexers or {}
+        self.decoder = decoder
+        self.resume_point = ResumePoint()
+        self._lock = threading.RLock()
+        self._store: dict[str, Any] = {}
+        self._indices: dict[str, dict[str, set]] = {idx: {} for idx in self.indexers}
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._handlers: list[Callable[[str, Any], None]] = []
+
+    @staticmethod
+    def key(obj:Any) -> str:
+        """
+        namespace/name for namespaced objects, name for cluster-wide ones
+        """
+        name = _field(obj, "metadata", "name")
+        namespace = _field(obj, "metadata", "namespace")
+        return f"{namespace}/{name}" if namespace else name
+
+    @property
+    def has_synced(self) -> bool:
+        """
+        True once the initial list has been loaded, until then
+        the cache can't be trusted to answer on its own
+        """
+        return self._synced.is_set()
+
+    def start(self):
+        """
+        Starts the list+watch thread, if the informer is not already running.
+        Informers are process-wide, so they outlive controller restarts.
+        """
+        if self.list_method is None or (self._thread and self._thread.is_alive()):
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f"informer-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Asks the watch thread to exit, it will once the next event comes in
+        """
+        self._stopped.set()
+
+    def get(self, key:str) -> Any:
+        """
+        Returns a single cached object by namespace/name
+        """
+        with self._lock:
+            return self._store.get(key)
+
+    def list(self) -> list:
+        """
+        Returns all of the cached objects
+        """
+        with self._lock:
+            return list(self._store.values())
+
+    def by_index(self, index:str, value:str) -> list:
+        """
+        Returns the cached objects having `value` in the `index`
+        """
+        with self._lock:
+            return [self._store[key] for key in self._indices[index].get(value, ())]
+
+    def add_handler(self, handler:Callable[[str, Any], None]):
+        """
+        Registers a function called with the event type and the
+        object, after every change applied to the cache.
+        It runs on the informer thread, so it has to be quick
+        """
+        self._handlers.append(handler)
+
+    def apply(self, event_type:str, obj:Any):
+        """
+        Updates the cache with a single watch event
+        """
+        key = self.key(obj)
+        with self._lock:
+            self._unindex(key)
+            if event_type == "DELETED":
+                self._store.pop(key, None)
+            else:
+                self._store[key] = obj
+                for index, func in self.indexers.items():
+                    for value in func(obj):
+                        self._indices[index].setdefault(value, set()).add(key)
+        for handler in self._handlers:
+            handler(event_type, obj)
+
+    def replace(self, objects:list):
+        """
+        Swaps the whole content of the cache, i.e. after a relist.
+        The objects that are gone meanwhile are handed to the handlers
+        as deleted, since their DELETED event was missed
+        """
+        keys = {self.key(obj) for obj in objects}
+        with self._lock:
+            for key, obj in list(self._store.items()):
+                if key not in keys:
+                    self.apply("DELETED", obj)
+            self.clear()
+            for obj in objects:
+                self.apply("ADDED", obj)
+        self._synced.set()
+
+    def clear(self):
+        """
+        Empties the cache, which is no longer considered synced
+        """
+        with self._lock:
+            self._store = {}
+            self._indices = {idx: {} for idx in self.indexers}
+        self._synced.clear()
+
+    def _unindex(self, key:str):
+        old = self._store.get(key)
+        if old is None:
+            return
+        for index, func in self.indexers.items():
+            for value in func(old):
+                keys = self._indices[index].get(value)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self._indices[index][value]
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                list_func = getattr(self.client_class(), self.list_method)
+                if not self.resume_point.version:
+                    self._relist(list_func)
+                watcher = RawWatch() if self.decoder else Watch()
+                for event in watcher.stream(
+                    list_func, *self.args, **self.kwargs, **self.resume_point.watch_kwargs()
+                ):
+                    self.resume_point.observe(event)
+                    if event["type"] != "BOOKMARK":
+                        self.apply(event["type"], self._decode(event["object"]))
+                    failures = 0
+                    if self._stopped.is_set():
+                        break
+            except ApiException as exc:
+                if exc.status == HTTPStatus.GONE:
+                    logger.info("%s informer: resourceVersion expired, relisting", self.name)
+                    self.resume_point.reset()
+                    continue
+                failures += 1
+                logger.error("%s informer: %s", self.name, exc.reason)
+            # pylint: disable=W0718
+            except Exception as exc:
+                failures += 1
+                logger.error("%s informer: %s", self.name, exc)
+            self._stopped.wait(min(2 ** failures, 30) if failures else 0)
+
+    def _decode(self, obj:Any) -> Any:
+        return self.decoder(obj) if self.decoder else obj
+
+    def _relist(self, list_func:Callable):
+        if self.decoder:
+            raw = list_func(*self.args, **self.kwargs, _preload_content=False)
+            resp = json.loads(raw.data)
+        else:
+            resp = list_func(*self.args, **self.kwargs)
+        if isinstance(resp, dict):
+            items = resp.get("items") or []
+        else:
+            items = resp.items
+        self.replace([self._decode(item) for item in items])
+        self.resume_point.version = _field(resp, "metadata", "resourceVersion")
+        logger.info("%s informer: synced %d objects", self.name, len(items))
+
+
+class InformerDispatcher:
+    """
+    Hands the events of an informer over to the coroutines waiting
+    on specific objects, found by one of the informer's indexes,
+    or to the callbacks registered for them.
+    A single watch serves every waiter, instead of one watch each
+    """
+    def __init__(self, informer:Informer, index:str):
+        self.informer = informer
+        self.index = index
+        self._lock = threading.Lock()
+        self._waiters: dict[str, set] = {}
+        self._callbacks: dict[str, dict[str, tuple]] = {}
+        informer.add_handler(self._dispatch)
+
+    def notify(
+            self,
+            value:str,
+            key:str,
+            callback:Callable[[], Any],
+            match:Callable[[dict], bool]=None
+        ):
+        """
+        Calls `callback` once, for the first event on `value`
+        passing `match`, without anyone having to wait for it.
+        Like the informer handlers, it runs on the informer thread,
+        so it has to be quick, and it isn't tied to an event loop.
+        Callbacks are kept by `key`, registering again replaces the previous one
+        """
+        with self._lock:
+            self._callbacks.setdefault(value, {})[key] = (callback, match)
+
+    def cancel(self, value:str, key:str):
+        """
+        Drops the callback registered for `value` under `key`, if any
+        """
+        with self._lock:
+            callbacks = self._callbacks.get(value, {})
+            callbacks.pop(key, None)
+            if not callbacks:
+                self._callbacks.pop(value, None)
+
+    def notifies(self, value:str, key:str) -> bool:
+        """
+        Whether a callback is registered for `value` under `key`
+        """
+        with self._lock:
+            return key in self._callbacks.get(value, {})
+
+    def waiting(self, value:str) -> int:
+        """
+        Number of coroutines waiting on `value`
+        """
+        with self._lock:
+            return len(self._waiters.get(value, ()))
+
+    async def events(
+            self,
+            value:str,
+            not_found_timeout:float=None,
+            match:Callable[[Any], bool]=None
+        ) -> AsyncIterator[dict]:
+        """
+        Yields the cached objects for `value`, then every change to them,
+        optionally narrowed down to the ones passing `match`.
+        If no object shows up within `not_found_timeout` seconds it
+        stops, once one has been seen it waits for as long as needed
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._waiters.setdefault(value, set()).add(waiter)
+        try:
+            cached = [
+                obj for obj in self.informer.by_index(self.index, value)
+                if match is None or match(obj)
+            ]
+            for obj in cached:
+                yield {"type": "ADDED", "object": obj}
+            seen = bool(cached)
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        waiter[1].get(), None if seen else not_found_timeout
+                    )
+                except asyncio.TimeoutError:
+                    return
+                if match is not None and not match(event["object"]):
+                    continue
+                seen = True
+                yield event
+        finally:
+            with self._lock:
+                self._waiters[value].discard(waiter)
+                if not self._waiters[value]:
+                    del self._waiters[value]
+
+    def _dispatch(self, event_type:str, obj:Any):
+        event = {"type": event_type, "object": obj}
+        for value in self.informer.indexers[self.index](obj):
+            with self._lock:
+                waiters = list(self._waiters.get(value, ()))
+                callbacks = self._callbacks.get(value, {})
+                fired = [
+                    callbacks.pop(key) for key, (_, match) in list(callbacks.items())
+                    if match is None or match(event)
+                ]
+                if not callbacks:
+                    self._callbacks.pop(value, None)
+            for loop, queue in waiters:
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+                except RuntimeError:
+                    # Loop closed, the waiter is gone
+                    pass
+            for callback, _ in fired:
+                callback()
+
+
+def decode_secret_data(data:dict | None) -> dict[str, str]:
+    """
+    Decodes the base64 values of a secret. Binary
+    values, not being text, are kept as bytes
+    """
+    decoded = {}
+    for key, value in (data or {}).items():
+        decoded[key] = base64.b64decode(value.encode())
+        try:
+            decoded[key] = decoded[key].decode()
+        except UnicodeDecodeError:
+            pass
+    return decoded
+
+
+def decode_secret(raw:dict) -> SimpleNamespace:
+    """
+    Keeps a secret's metadata, and its data already decoded,
+    so lookups don't decode it over and over
+    """
+    view = lean_decoder(LEAN_SECRET)(raw)
+    view.data = decode_secret_data(raw.get("data"))
+    return view
+
+
+def cached_secret(name:str, namespace:str=NAMESPACE) -> dict[str, str] | None:
+    """
+    Decoded data of a secret from the informer. None if it's not
+    there, or the informer hasn't synced yet, so it's not to be trusted
+    """
+    if namespace != NAMESPACE or not secrets_cache.has_synced:
+        return None
+    secret = secrets_cache.get(f"{namespace}/{name}")
+    return secret.data if secret else None
+
+
+def cached_secret_by_label(label:str, namespace:str=NAMESPACE) -> dict[str, str] | None:
+    """
+    Decoded data of the first secret with the label (`key=value`)
+    from the informer. None if it's not there, it's not an indexed
+    label, or the informer hasn't synced yet
+    """
+    key, _, value = label.partition("=")
+    if namespace != NAMESPACE or key not in secrets_cache.indexers or not secrets_cache.has_synced:
+        return None
+    secrets = secrets_cache.by_index(key, value)
+    return secrets[0].data if secrets else None
+
+
+# Fields of the pods and jobs the watchers read, nothing else is kept
+_LEAN_METADATA = {"name": None, "namespace": None, "labels": None, "resourceVersion": None}
+LEAN_POD = {"metadata": _LEAN_METADATA, "status": {"phase": None}}
+LEAN_SECRET = {"metadata": _LEAN_METADATA}
+LEAN_JOB = {
+    "metadata": _LEAN_METADATA,
+    "status": {
+        "active": None, "ready": None, "terminating": None,
+        "succeeded": None, "failed": None,
+        "startTime": None, "conditions": None,
+        "uncountedTerminatedPods": {"succeeded": None}
+    }
+}
+
+# Process-wide caches. The Analytics one is fed by the controller's
+# own watch, the others list and watch on their own once started
+analytics_cache = Informer("analytics")
+task_pods_cache = Informer(
+    "task-pods", KubernetesV1, "list_namespaced_pod", TASK_NAMESPACE,
+    label_selector="task_id",
+    indexers={"task_id": label_indexer("task_id")},
+    decoder=lean_decoder(LEAN_POD)
+)
+task_pods = InformerDispatcher(task_pods_cache, "task_id")
+jobs_cache = Informer(
+    "jobs", KubernetesV1Batch, "list_namespaced_job", NAMESPACE,
+    label_selector=f"{Analytics.domain}=fn-controller",
+    indexers={"crd": label_indexer("crd")},
+    decoder=lean_decoder(LEAN_JOB)
+)
+helper_jobs = InformerDispatcher(jobs_cache, "crd")
+# Helm keeps its releases as secrets, large and of no use here
+secrets_cache = Informer(
+    "secrets", KubernetesV1, "list_namespaced_secret", NAMESPACE,
+    field_selector="type!=helm.sh/release.v1",
+    indexers={"url": label_indexer("url")},
+    decoder=decode_secret
+)
+
+
+def start_informers():
+    """
+    Starts all of the self-watching informers
+    """
+    for informer in [task_pods_cache, jobs_cache, secrets_cache]:
+        informer.start()
+
+
+def stop_informers():
+    """
+    Stops all of the self-watching informers
+    """
+    for informer in [task_pods_cache, jobs_cache, secrets_cache]:
+        informer.stop()
@@ -0,0 +1,186 @@
+"""
+Lease based leader election, so more than one replica can run.
+    - all replicas watch and keep their caches warm
+    - only the one holding the Lease reconciles CRDs
+    - a leader losing the Lease drops its queued CRDs, and doesn't
+        start any further lifecycle step
+    - a standby takes over once the Lease hasn't been renewed
+        for its whole duration
+Disabled unless LEADER_ELECTION is set to "true", in which case
+the single replica is always considered the leader.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from uuid import uuid4
+
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+
+from const import (
+    LEADER_ELECTION, LEASE_NAME, NAMESPACE,
+    LEASE_DURATION, LEASE_RENEW_DEADLINE, LEASE_RETRY_PERIOD
+)
+from helpers.kubernetes_helper import KubernetesCoordination
+
+logger = logging.getLogger('leader_election')
+logger.setLevel(logging.INFO)
+
+
+class LeaderElector:
+    """
+    Keeps trying to acquire, or renew, a coordination.k8s.io Lease.
+    Expiry is judged on the local clock, from the last time the Lease
+    was seen changing, so clock skew across nodes doesn't matter.
+    `version` is bumped every time the leadership changes hands.
+    """
+    # pylint: disable=R0913
+    def __init__(
+            self,
+            lease_name:str=LEASE_NAME,
+            namespace:str=NAMESPACE,
+            identity:str=None,
+            enabled:bool=LEADER_ELECTION,
+            lease_duration:int=LEASE_DURATION,
+            renew_deadline:int=LEASE_RENEW_DEADLINE,
+            retry_period:int=LEASE_RETRY_PERIOD
+        ):
+        self.lease_name = lease_name
+        self.namespace = namespace
+        self.identity = identity or os.getenv("HOSTNAME") or uuid4().hex
+        self.enabled = enabled
+        self.lease_duration = lease_duration
+        self.renew_deadline = renew_deadline
+        self.retry_period = retry_period
+        self._leader = threading.Event()
+        self._stopped = threading.Event()
+        self._observed = (None, 0.0)
+        self._thread = None
+        self.version = 0
+
+    @property
+    def is_leader(self) -> bool:
+        """
+        Whether this replica should be reconciling
+        """
+        return not self.enabled or self._leader.is_set()
+
+    def owns(self, _name:str) -> bool:
+        """
+        The leader owns every CRD, standbys none
+        """
+        return self.is_leader
+
+    def start(self):
+        """
+        Starts the election loop, if enabled and not running already
+        """
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the election loop
+        """
+        self._stopped.set()
+
+    def try_acquire_or_renew(self) -> bool:
+        """
+        Single election round. Creates the Lease if missing, renews it
+        if we hold it, or takes it over if the holder let it expire.
+        Updates are sent with the resourceVersion that was read, so if
+        two replicas race for it, only one wins.
+        """
+        api = KubernetesCoordination()
+        now = datetime.now(timezone.utc)
+        try:
+            lease = api.read_namespaced_lease(self.lease_name, self.namespace)
+        except ApiException as exc:
+            if exc.status != HTTPStatus.NOT_FOUND:
+                raise exc
+            return self._create(api, now)
+
+        spec = lease.spec
+        self._observe(lease.metadata.resource_version)
+        if spec.holder_identity and spec.holder_identity != self.identity:
+            expiry = self._observed[1] + (spec.lease_duration_seconds or self.lease_duration)
+            if time.monotonic() < expiry:
+                if self._leader.is_set():
+                    logger.warning(
+                        "%s lost the leadership to %s", self.identity, spec.holder_identity
+                    )
+                    self._leader.clear()
+                    self.version += 1
+                return False
+            logger.info("Lease held by %s expired, taking over", spec.holder_identity)
+
+        if spec.holder_identity != self.identity:
+            spec.holder_identity = self.identity
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.renew_time = now
+        spec.lease_duration_seconds = self.lease_duration
+        try:
+            updated = api.replace_namespaced_lease(self.lease_name, self.namespace, lease)
+        except ApiException as exc:
+            if exc.status == HTTPStatus.CONFLICT:
+                return False
+            raise exc
+        self._observe(updated.metadata.resource_version)
+        return True
+
+    def _create(self, api:KubernetesCoordination, now:datetime) -> bool:
+        lease = client.V1Lease(
+            metadata=client.V1ObjectMeta(name=self.lease_name, namespace=self.namespace),
+            spec=client.V1LeaseSpec(
+                holder_identity=self.identity,
+                lease_duration_seconds=self.lease_duration,
+                acquire_time=now,
+                renew_time=now,
+                lease_transitions=0
+            )
+        )
+        try:
+            created = api.create_namespaced_lease(self.namespace, lease)
+        except ApiException as exc:
+            if exc.status == HTTPStatus.CONFLICT:
+                return False
+            raise exc
+        self._observe(created.metadata.resource_version)
+        return True
+
+    def _observe(self, resource_version:str):
+        if resource_version != self._observed[0]:
+            self._observed = (resource_version, time.monotonic())
+
+    def _run(self):
+        last_renew = 0.0
+        while not self._stopped.is_set():
+            try:
+                acquired = self.try_acquire_or_renew()
+            # pylint: disable=W0718
+            except Exception as exc:
+                logger.error("Leader election failed: %s", exc)
+                acquired = False
+
+            if acquired:
+                last_renew = time.monotonic()
+                if not self._leader.is_set():
+                    logger.info("%s is now the leader", self.identity)
+                    self._leader.set()
+                    self.version += 1
+            elif self._leader.is_set() and time.monotonic() - last_renew > self.renew_deadline:
+                logger.warning("%s lost the leadership", self.identity)
+                self._leader.clear()
+                self.version += 1
+            self._stopped.wait(self.retry_period)
+
+
+leader_elector = LeaderElector()
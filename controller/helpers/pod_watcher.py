@@ -1,22 +1,26 @@
 """
 Collection of job and pod watchers.
-    - Pod watcher monitors the actual task lifecycle
+    - Pod watcher monitors the actual task lifecycle, queueing the CRD
+        again when its pod completes rather than waiting on it
     - Job watcher is mostly to focus on user sync
+Both rely on the shared informers' watches, rather than opening their own
 """
 
-import asyncio
-import base64
 import logging
 import re
 import subprocess
-import httpx
-from kubernetes.watch import Watch
+import time
+from contextlib import aclosing
 from kubernetes.client.models.v1_job_status import V1JobStatus
 
-from const import TASK_NAMESPACE, NAMESPACE
+from const import NAMESPACE
 from exceptions import KubernetesException, PodWatcherException
-from helpers.kubernetes_helper import KubernetesV1Batch, KubernetesCRD, KubernetesV1
-from helpers.request_helper import client as requests
+from helpers.kubernetes_helper import (
+    AsyncKubernetesV1Batch, AsyncKubernetesV1,
+    annotation_writer, helper_jobs, task_pods
+)
+from helpers.request_helper import delivery
+from helpers.retry_scheduler import retry_scheduler
 from helpers.task_helper import get_results
 from models.crd import Analytics
 
@@ -25,145 +29,177 @@ logger = logging.getLogger('pod_watcher')
 logger.setLevel(logging.INFO)
 
 MAX_TIMEOUT = 60
+TERMINAL_PHASES = ("Succeeded", "Failed")
+# task_id -> when the controller started looking for its pod
+_pod_waits: dict[str, float] = {}
 
 
-async def watch_task_pod(crd: Analytics, task_id:str, user_token:str, annotations:dict):
+def completed_task_pod(crd: Analytics, task_id:str):
     """
-    Given a task id, checks for active pods with
-    task_id label, and once completed, trigger the results fetching
+    Looks up the pod with the task_id label in the shared task pods
+    cache, and returns it once it has completed.
+    Until then it returns None, having arranged for the CRD to be
+    queued again as soon as the pod changes, so no worker is held for
+    as long as the task runs. Only a pod that can't be found times out
     """
-    pod = None
+    def wake_up():
+        retry_scheduler.schedule(crd.name, 0)
+
+    # Registered before looking, so a change landing in between isn't missed
+    task_pods.notify(task_id, crd.name, wake_up)
+    pods = task_pods.informer.by_index(task_pods.index, task_id)
+    if pods:
+        _pod_waits.pop(task_id, None)
+        pod = pods[0]
+        if pod.status.phase in TERMINAL_PHASES:
+            task_pods.cancel(task_id, crd.name)
+            logger.info("Found pod! %s", pod.metadata.name)
+            return pod
+        logger.info("%s Status: %s", pod.metadata.name, pod.status.phase)
+        task_pods.notify(task_id, crd.name, wake_up, match=_task_pod_settled)
+        return None
+
+    if not task_pods.informer.has_synced:
+        # Can't tell yet whether the pod exists
+        retry_scheduler.schedule(crd.name, MAX_TIMEOUT)
+        return None
+    now = time.monotonic()
+    waited = now - _pod_waits.setdefault(task_id, now)
+    if waited >= MAX_TIMEOUT:
+        _pod_waits.pop(task_id, None)
+        task_pods.cancel(task_id, crd.name)
+        raise KubernetesException(f"Timeout. Pod for task {task_id} not found")
+    logger.info("Looking for pod with task_id: %s", task_id)
+    retry_scheduler.schedule(crd.name, MAX_TIMEOUT - waited)
+    return None
+
+
+def _task_pod_settled(event:dict) -> bool:
+    return event["type"] == "DELETED" or event["object"].status.phase in TERMINAL_PHASES
+
+
+async def deliver_results(crd: Analytics, pod, user_token:str, annotations:dict):
+    """
+    Given a completed task pod, trigger the results fetching and
+    their delivery.
+    Returns the patched CRD, if the results were delivered from here
+    """
+    task_id = pod.metadata.labels["task_id"]
+    patched = None
     git_info = crd.delivery.get("github", {})
     other_info = crd.delivery.get("other", {})
-    logger.info("Looking for pod with task_id: %s", task_id)
-    pod_watch = Watch()
-
-    for pod in pod_watch.stream(
-        KubernetesV1().list_namespaced_pod,
-        TASK_NAMESPACE,
-        label_selector=f"task_id={task_id}",
-        timeout_seconds=MAX_TIMEOUT
-    ):
-        logger.info("Found pod! %s", pod["object"].metadata.name)
-        match pod["object"].status.phase:
-            case "Succeeded":
-                annotations[f"{crd.domain}/results"] = "true"
-                fp = await get_results(task_id, user_token)
-                if fp is None:
-                    logging.info("Task needs a review")
-                    # Results to be approved. Waiting. No retries
-                    break
-                if git_info:
-                    KubernetesV1Batch().create_helper_job(
-                        name=f"task-{task_id}-results",
-                        script="push_to_github.sh",
-                        task_id=task_id,
-                        repository=git_info.get("repository"),
-                        crd_name=crd.name,
-                        user=crd.user
-                    )
-                elif other_info:
-                    auth = {}
-                    is_api = True
-
-                    # Remove the http(s) from the string and use it as a label filter
-                    url = re.sub(r"http(s)*://", "", other_info.get("url", ''))
-                    auth_secret = KubernetesV1().get_secret_by_label(
-                        namespace=NAMESPACE, label=f"url={url}"
-                    )
-                    creds = base64.b64decode(
-                        auth_secret.data["auth"].encode()
-                    ).decode()
-
-                    match other_info.get("auth_type", '').lower():
-                        case "bearer":
-                            auth["headers"] = {"Authorization": f"Bearer {creds}"}
-                        case "basic":
-                            auth["auth"] = tuple(creds.split(":"))
-                        case "azcopy":
-                            out = subprocess.run(
-                                ["azcopy", "copy", fp, creds],
-                                capture_output=True,
-                                check=False
-                            )
-                            if out.stderr:
-                                logger.error(out.stderr)
-                                raise PodWatcherException(
-                                    "Something went wrong with the result push"
-                                )
-                            logger.info(out.stdout)
-                            is_api = False
-                        case _:
-                            # This won't happen, as validation happend at CRD
-                            # creation at k8s api level
-                            pass
-                    if is_api:
-                        with open(fp, 'r', encoding="utf-8") as file:
-                            resp = httpx.post(
-                                other_info.get("url"),
-                                files={fp: file},
-                                **auth
-                            )
-                        if resp.status_code > 299:
-                            raise PodWatcherException("Failed to deliver results")
-                    # Add results annotation to let the controller know
-                    # we already handled results
-                    KubernetesCRD().patch_crd_annotations(crd.name, annotations)
-                else:
-                    raise PodWatcherException("No suitable delivery options available")
-                break
-            case "Failed":
-                raise KubernetesException(
-                    "Pod in failed status. Refreshing annotation on CRD to trigger a restart"
+
+    match pod.status.phase:
+        case "Succeeded":
+            annotations[f"{crd.domain}/results"] = "true"
+            fp = await get_results(task_id, user_token)
+            if fp is None:
+                logging.info("Task needs a review")
+                # Results to be approved. Waiting. No retries
+                return None
+            if git_info:
+                await AsyncKubernetesV1Batch().create_helper_job(
+                    name=f"task-{task_id}-results",
+                    script="push_to_github.sh",
+                    task_id=task_id,
+                    repository=git_info.get("repository"),
+                    crd_name=crd.name,
+                    user=crd.user
                 )
-            case _:
-                logger.info(
-                    "%s Status: %s",
-                    pod["object"].metadata.name,
-                    pod["object"].status.phase
+            elif other_info:
+                auth = {}
+                is_api = True
+
+                # Remove the http(s) from the string and use it as a label filter
+                url = re.sub(r"http(s)*://", "", other_info.get("url", ''))
+                auth_secret = await AsyncKubernetesV1().get_secret_by_label(
+                    namespace=NAMESPACE, label=f"url={url}"
                 )
-    logger.info("Stopping task %s pod watcher", task_id)
-    if not pod:
-        raise KubernetesException(f"Timeout. Pod for task {task_id} not found")
-    pod_watch.stop()
+                creds = auth_secret["auth"]
+
+                match other_info.get("auth_type", '').lower():
+                    case "bearer":
+                        auth["headers"] = {"Authorization": f"Bearer {creds}"}
+                    case "basic":
+                        auth["auth"] = tuple(creds.split(":"))
+                    case "azcopy":
+                        out = subprocess.run(
+                            ["azcopy", "copy", fp, creds],
+                            capture_output=True,
+                            check=False
+                        )
+                        if out.stderr:
+                            logger.error(out.stderr)
+                            raise PodWatcherException(
+                                "Something went wrong with the result push"
+                            )
+                        logger.info(out.stdout)
+                        is_api = False
+                    case _:
+                        # This won't happen, as validation happend at CRD
+                        # creation at k8s api level
+                        pass
+                if is_api:
+                    with open(fp, 'r', encoding="utf-8") as file:
+                        resp = await delivery.get().post(
+                            other_info.get("url"),
+                            files={fp: file},
+                            **auth
+                        )
+                    if resp.status_code > 299:
+                        raise PodWatcherException("Failed to deliver results")
+                # Add results annotation to let the controller know
+                # we already handled results
+                patched = await annotation_writer.write(
+                    crd, annotations
+                )
+            else:
+                raise PodWatcherException("No suitable delivery options available")
+        case "Failed":
+            raise KubernetesException(
+                "Pod in failed status. Refreshing annotation on CRD to trigger a restart"
+            )
+    return patched
 
 
-async def watch_user_pod(crd: Analytics, annotations:dict):
+async def watch_user_pod(crd: Analytics, annotations:dict, job_name:str):
     """
-    Given a task id, checks for active pods with
-    task_id label, and once completed, trigger the results fetching
+    Follows the user sync job, through the shared jobs watch,
+    and once completed, marks the user as synced on the CRD.
+    Returns the patched CRD
     """
-    pod_watch = Watch()
-    ls = ",".join(f"{lab[0]}={lab[1]}" for lab in crd.labels.items())
-    for job in pod_watch.stream(
-        KubernetesV1Batch().list_namespaced_job,
-        NAMESPACE,
-        label_selector=ls,
-        resource_version='',
-        watch=True,
-        timeout_seconds=MAX_TIMEOUT
-    ):
-        logger.info("Found job! %s", job["object"].metadata.name)
-        match await get_job_status(job["object"].status):
-            case "Succeeded":
-                annotations[f"{crd.domain}/user"] = "ok"
-                # Add results annotation to let the controller know
-                # we already handled the user
-                KubernetesCRD().patch_crd_annotations(crd.name, annotations)
-                break
-            case "Failed":
-                raise KubernetesException(
-                    "Job in failed status. Refreshing annotation on CRD to trigger a restart"
-                )
-            case _:
-                logger.info(
-                    "%s Status: %s",
-                    job["object"].metadata.name,
-                    await get_job_status(job["object"].status)
-                )
+    job_events = helper_jobs.events(
+        crd.owner_label["crd"],
+        not_found_timeout=MAX_TIMEOUT,
+        match=lambda job: job.metadata.name == job_name
+    )
+    job = patched = None
+    async with aclosing(job_events) as events:
+        async for job in events:
+            status = await get_job_status(job["object"].status)
+            logger.info("Found job! %s", job["object"].metadata.name)
+            match status:
+                case "Succeeded":
+                    annotations[f"{crd.domain}/user"] = "ok"
+                    # Add results annotation to let the controller know
+                    # we already handled the user
+                    patched = await annotation_writer.write(
+                        crd, annotations
+                    )
+                    break
+                case "Failed":
+                    raise KubernetesException(
+                        "Job in failed status. Refreshing annotation on CRD to trigger a restart"
+                    )
+                case _ if job["type"] == "DELETED":
+                    raise KubernetesException(f"Job {job_name} deleted before completing")
+                case _:
+                    logger.info("%s Status: %s", job["object"].metadata.name, status)
 
     logger.info("Stopping %s job watcher", " ".join(crd.user.values()))
-    pod_watch.stop()
+    if not job:
+        raise KubernetesException(f"Timeout. Job {job_name} not found")
+    return patched
 
 
 async def get_job_status(status:V1JobStatus) -> str:
@@ -175,6 +211,9 @@ async def get_job_status(status:V1JobStatus) -> str:
     for state in possible_status:
         if getattr(status, state.lower(), False):
             return state
+    # Just created, the job controller hasn't picked it up yet
+    if not getattr(status, "start_time", None) and not getattr(status, "conditions", None):
+        return "Pending"
     # Mostly for aks clusters
     if getattr(getattr(status, "uncounted_terminated_pods", V1JobStatus), "succeeded", []):
         return "Succeeded"
@@ -1,15 +1,84 @@
 """
-Simple override of certain requests args.
+Shared HTTP clients, one per upstream, so connections are kept
+alive and reused rather than opened, TLS handshake included, per request.
     - if the `DEVELOPMENT` env var is set, it will ignore SSL
-    - it also sets a global timeout to be 60 seconds
+    - requests time out after HTTP_TIMEOUT seconds, 60 by default
+    - each upstream keeps up to HTTP_MAX_CONNECTIONS connections,
+        HTTP_MAX_KEEPALIVE of which stay open once idle
+    - HTTP/2 is negotiated if HTTP2 is set to "true", and the
+        `h2` package is installed (httpx[http2])
 """
 
-import functools
-import requests
+import asyncio
+import importlib.util
+import logging
 
-from const import LOCAL_DEV
+import httpx
 
-client = requests.Session()
-client.request = functools.partial(client.request, timeout=60)
-if LOCAL_DEV:
-    client.verify = False
+from const import HTTP2, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_TIMEOUT, LOCAL_DEV
+
+logger = logging.getLogger('request_helper')
+logger.setLevel(logging.INFO)
+
+
+class SharedClient:
+    """
+    Lazily creates an httpx.AsyncClient, and hands the same one out
+    from then on. Connections belong to the event loop they were opened
+    on, so a new client is created if the controller restarts on a new loop
+    """
+    def __init__(self):
+        self._client: httpx.AsyncClient = None
+        self._loop: asyncio.AbstractEventLoop = None
+
+    def get(self) -> httpx.AsyncClient:
+        """
+        Returns the client for the running loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = new_client()
+            self._loop = loop
+        return self._client
+
+    async def aclose(self):
+        """
+        Closes the client, and its pooled connections
+        """
+        client, self._client = self._client, None
+        if client is not None and self._loop is asyncio.get_running_loop():
+            await client.aclose()
+
+
+def new_client() -> httpx.AsyncClient:
+    """
+    Builds a client with the pool limits, timeout and SSL settings
+    """
+    http2 = HTTP2 and importlib.util.find_spec("h2") is not None
+    if HTTP2 and not http2:
+        logger.warning("HTTP2 is enabled, but the h2 package is missing. Using HTTP/1.1")
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE
+        ),
+        verify=not LOCAL_DEV
+    )
+
+
+# The Federated Node API
+backend = SharedClient()
+# Keycloak, for tokens and users
+keycloak = SharedClient()
+# The API results are delivered to
+delivery = SharedClient()
+
+
+async def close_clients():
+    """
+    Closes every shared client
+    """
+    for shared in [backend, keycloak, delivery]:
+        await shared.aclose()
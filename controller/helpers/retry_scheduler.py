@@ -0,0 +1,127 @@
+"""
+In-process delay queue for CRDs whose reconciliation failed.
+    - each failed CRD gets a timer, and goes back in the work queue
+        once its cooldown is over
+    - due times outlive the event loop, so retries still pending when
+        the watch is restarted are re-armed on the next one
+    - the attempt and its due time are also saved on the CRD itself,
+        so a new controller pod picks them up from the annotations
+    - CRDs waiting on something else, like their task pod, are woken
+        up through it as well
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger('retry_scheduler')
+logger.setLevel(logging.INFO)
+
+
+class RetryScheduler:
+    """
+    Keeps one timer per CRD name. When it fires the name is handed
+    to the `submit` coroutine given to `attach`, which is expected
+    to fetch the latest version of the CRD and queue it.
+    """
+    def __init__(self):
+        self._due: dict[str, float] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._submit: Callable[[str], Awaitable] = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._tasks: set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name:str) -> bool:
+        return name in self._due
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def attach(self, submit:Callable[[str], Awaitable]):
+        """
+        Starts firing retries on the running loop, re-arming
+        the ones scheduled before the last `detach`
+        """
+        self._submit = submit
+        self._loop = asyncio.get_running_loop()
+        with self._lock:
+            names = list(self._due)
+        for name in names:
+            self._arm(name)
+
+    def detach(self):
+        """
+        Stops the timers, keeping the due times for the next `attach`
+        """
+        for handle in self._timers.values():
+            handle.cancel()
+        self._timers = {}
+        self._submit = None
+        self._loop = None
+
+    def schedule(self, name:str, delay:float):
+        """
+        Retries `name` in `delay` seconds, replacing any earlier schedule.
+        It can be called from other threads, i.e. the informers' ones
+        """
+        with self._lock:
+            self._due[name] = time.monotonic() + max(delay, 0)
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._arm(name)
+            return
+        try:
+            loop.call_soon_threadsafe(self._arm, name)
+        except RuntimeError:
+            # Loop closed, re-armed on the next attach
+            pass
+
+    def cancel(self, name:str):
+        """
+        Drops the pending retry for `name`, if any
+        """
+        with self._lock:
+            self._due.pop(name, None)
+        handle = self._timers.pop(name, None)
+        if handle:
+            handle.cancel()
+
+    def clear(self):
+        """
+        Drops every pending retry
+        """
+        self.detach()
+        with self._lock:
+            self._due = {}
+
+    def _arm(self, name:str):
+        handle = self._timers.pop(name, None)
+        if handle:
+            handle.cancel()
+        with self._lock:
+            due = self._due.get(name)
+        if due is None or self._submit is None:
+            return
+        delay = max(due - time.monotonic(), 0)
+        self._timers[name] = asyncio.get_running_loop().call_later(delay, self._fire, name)
+
+    def _fire(self, name:str):
+        self._timers.pop(name, None)
+        with self._lock:
+            self._due.pop(name, None)
+        logger.info("Queueing %s again", name)
+        task = asyncio.create_task(self._submit(name), name=f"retry-{name}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+retry_scheduler = RetryScheduler()
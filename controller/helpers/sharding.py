@@ -0,0 +1,265 @@
+"""
+Hash based sharding of the CRDs across active replicas.
+    - every replica keeps its own membership Lease alive
+    - the live members are placed on a consistent hash ring, and each
+        CRD name belongs to exactly one of them
+    - when replicas join or leave, only the CRDs on the affected
+        slices of the ring move to a different owner
+    - a replica gives up its Lease when it's terminated, and the ones
+        left behind by replicas that didn't are deleted once long expired
+Disabled unless SHARDING is set to "true", in which case
+the replica owns every CRD.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from uuid import uuid4
+
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+
+from const import (
+    SHARDING, SHARD_VNODES, LEASE_NAME, NAMESPACE,
+    LEASE_DURATION, LEASE_RETRY_PERIOD
+)
+from helpers.kubernetes_helper import KubernetesCoordination
+from models.crd import Analytics
+
+logger = logging.getLogger('sharding')
+logger.setLevel(logging.INFO)
+
+# Lease durations a member's Lease has to be expired
+# for, before it's deleted by the other replicas
+GC_AFTER = 4
+
+
+def _hash(value:str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode(), usedforsecurity=False).digest()[:8], "big")
+
+
+class ShardRing:
+    """
+    Consistent hash ring. Each member is placed `vnodes` times, which
+    spreads the keys evenly, and a key belongs to the first member
+    found going clockwise from its own hash.
+    """
+    def __init__(self, members:list[str], vnodes:int=SHARD_VNODES):
+        self.members = sorted(set(members))
+        points = sorted(
+            (_hash(f"{member}#{vnode}"), member)
+            for member in self.members for vnode in range(vnodes)
+        )
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+
+    def owner(self, key:str) -> str | None:
+        """
+        Returns the member owning `key`
+        """
+        if not self._owners:
+            return None
+        idx = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[idx]
+
+
+class ShardCoordinator:
+    """
+    Keeps this replica's membership Lease renewed, and the ring built
+    from the live members. A member is considered gone once its Lease
+    hasn't changed for its whole duration, on the local clock.
+
+    A CRD is owned only if both the latest and the settled ring agree.
+    This way a replica gives up a CRD as soon as it sees a new member, but
+    only picks one up once the membership has been stable for two retry
+    periods. By then the previous owner has dropped the CRD from its
+    queue, and checks ownership before starting any lifecycle step.
+    A step already running there is let finish, as cutting it short
+    could lose its outcome (i.e. the task id of a task just created).
+    `version` is bumped every time either ring changes.
+    """
+    # pylint: disable=R0913
+    def __init__(
+            self,
+            lease_prefix:str=LEASE_NAME,
+            namespace:str=NAMESPACE,
+            identity:str=None,
+            enabled:bool=SHARDING,
+            lease_duration:int=LEASE_DURATION,
+            retry_period:int=LEASE_RETRY_PERIOD,
+            vnodes:int=SHARD_VNODES
+        ):
+        self.lease_prefix = lease_prefix
+        self.namespace = namespace
+        self.identity = identity or os.getenv("HOSTNAME") or uuid4().hex
+        self.enabled = enabled
+        self.lease_duration = lease_duration
+        self.retry_period = retry_period
+        self.vnodes = vnodes
+        self.ring = None
+        self.latest = None
+        self.version = 0
+        self._changed_at = 0.0
+        self._observed: dict[str, tuple[str, float]] = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def lease_name(self) -> str:
+        """
+        Name of this replica's membership Lease
+        """
+        name = f"{self.lease_prefix}-{self.identity}".lower()
+        return re.sub(r'[^a-z0-9-]+', '-', name)[:63].strip("-")
+
+    @property
+    def member_label(self) -> dict:
+        """
+        Label shared by the membership Leases
+        """
+        return {f"{Analytics.domain}/shard": self.lease_prefix}
+
+    def owns(self, name:str) -> bool:
+        """
+        Whether the CRD `name` should be reconciled by this replica
+        """
+        if not self.enabled:
+            return True
+        if self.ring is None or self.latest is None:
+            return False
+        return self.ring.owner(name) == self.identity == self.latest.owner(name)
+
+    def start(self):
+        """
+        Starts the membership loop, if enabled and not running already
+        """
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="sharding", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the membership loop and gives up the Lease, so
+        the other replicas pick up this shard straight away
+        """
+        self._stopped.set()
+        try:
+            KubernetesCoordination().delete_namespaced_lease(self.lease_name, self.namespace)
+        except ApiException as exc:
+            logger.error("Failed to release the membership lease: %s", exc.reason)
+
+    def heartbeat(self):
+        """
+        Creates or renews this replica's membership Lease
+        """
+        api = KubernetesCoordination()
+        now = datetime.now(timezone.utc)
+        try:
+            lease = api.read_namespaced_lease(self.lease_name, self.namespace)
+        except ApiException as exc:
+            if exc.status != HTTPStatus.NOT_FOUND:
+                raise exc
+            api.create_namespaced_lease(self.namespace, client.V1Lease(
+                metadata=client.V1ObjectMeta(
+                    name=self.lease_name,
+                    namespace=self.namespace,
+                    labels=self.member_label
+                ),
+                spec=client.V1LeaseSpec(
+                    holder_identity=self.identity,
+                    lease_duration_seconds=self.lease_duration,
+                    acquire_time=now,
+                    renew_time=now
+                )
+            ))
+            return
+        lease.spec.renew_time = now
+        api.replace_namespaced_lease(self.lease_name, self.namespace, lease)
+
+    def live_members(self) -> list[str]:
+        """
+        Lists the membership Leases, and returns the identities
+        of the replicas that are still renewing them
+        """
+        leases = KubernetesCoordination().list_namespaced_lease(
+            self.namespace,
+            label_selector=",".join(f"{key}={val}" for key, val in self.member_label.items())
+        )
+        now = time.monotonic()
+        members = {self.identity}
+        observed = {}
+        for lease in leases.items:
+            version = lease.metadata.resource_version
+            seen_version, seen_at = self._observed.get(lease.metadata.name, (None, now))
+            if version != seen_version:
+                seen_at = now
+            observed[lease.metadata.name] = (version, seen_at)
+            duration = lease.spec.lease_duration_seconds or self.lease_duration
+            if now - seen_at < duration:
+                members.add(lease.spec.holder_identity)
+            elif now - seen_at > GC_AFTER * duration and lease.metadata.name != self.lease_name:
+                self.collect(lease)
+        self._observed = observed
+        return sorted(members)
+
+    def collect(self, lease:client.V1Lease):
+        """
+        Deletes the Lease of a replica that went away without
+        releasing it. The delete is conditional on the version that
+        was seen expiring, so a replica coming back isn't affected
+        """
+        logger.info("Deleting the expired membership lease %s", lease.metadata.name)
+        try:
+            KubernetesCoordination().delete_namespaced_lease(
+                lease.metadata.name,
+                self.namespace,
+                body=client.V1DeleteOptions(
+                    preconditions=client.V1Preconditions(
+                        resource_version=lease.metadata.resource_version
+                    )
+                )
+            )
+        except ApiException as exc:
+            # Already gone, or renewed meanwhile
+            if exc.status not in (HTTPStatus.NOT_FOUND, HTTPStatus.CONFLICT):
+                logger.error(
+                    "Failed to delete the membership lease %s: %s",
+                    lease.metadata.name, exc.reason
+                )
+
+    def update_ring(self, members:list[str]):
+        """
+        Keeps two rings: the latest one, built from what was just observed,
+        and the settled one, which only changes once the same members
+        have been seen for a couple of rounds
+        """
+        now = time.monotonic()
+        if self.latest is None or self.latest.members != members:
+            logger.info("Shard members changed: %s", ", ".join(members))
+            self.latest = ShardRing(members, self.vnodes)
+            self._changed_at = now
+            self.version += 1
+        elif self.ring is not self.latest and now - self._changed_at >= 2 * self.retry_period:
+            self.ring = self.latest
+            self.version += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.heartbeat()
+                self.update_ring(self.live_members())
+            # pylint: disable=W0718
+            except Exception as exc:
+                logger.error("Shard membership update failed: %s", exc)
+            self._stopped.wait(self.retry_period)
+
+
+shard_coordinator = ShardCoordinator()
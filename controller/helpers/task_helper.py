@@ -3,10 +3,10 @@ Collection of functions to assist in performing FN-task-related operations
 """
 import logging
 
-import httpx
 from const import BACKEND_HOST, GIT_HOME, PUBLIC_URL
 from exceptions import FederatedNodeException
-from helpers.keycloak_helper import get_user, impersonate_user
+from helpers.keycloak_helper import get_user, user_tokens
+from helpers.request_helper import backend
 from models.crd import Analytics
 
 logger = logging.getLogger('task_helpers')
@@ -17,18 +17,19 @@ async def get_user_token(user:dict) -> str:
     """
     Simply get a user's token through impersonation.
         It is expected for the argument to have at least one
-        key among `email` and `username`
+        key among `email` and `username`.
+        Tokens are cached per user, until they expire
     :returns: user's token
     """
     logger.info("Getting user's token")
     user_info = await get_user(**user)
-    return await impersonate_user(user_info["id"])
+    return await user_tokens.get(user_info["id"])
 
-def create_fn_task(crd: Analytics, user_token:str):
+async def create_fn_task(crd: Analytics, user_token:str):
     """
     Wrapper to call the Federated Node /tasks endpoint
     """
-    task_resp = httpx.post(
+    task_resp = await backend.get().post(
         f"{BACKEND_HOST}/tasks",
         json=crd.create_task_body(),
         headers={
@@ -47,7 +48,7 @@ async def get_results(task_id:str, token:str) -> str:
     if the request fails
     """
     logger.info("Getting task %s results", task_id)
-    res_resp = httpx.get(
+    res_resp = await backend.get().get(
         f"{BACKEND_HOST}/tasks/{task_id}/results",
         headers={
             "Authorization": f"Bearer {token}"
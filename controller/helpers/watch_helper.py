@@ -0,0 +1,337 @@
+"""
+Bridge between the blocking kubernetes Watch and the asyncio loop.
+    - each watch stream is consumed on its own daemon thread
+    - events are handed over through a bounded asyncio.Queue, so a slow
+        consumer blocks the thread instead of piling events up in memory
+    - the last resourceVersion seen is kept so a dropped watch can resume
+        from where it left off rather than replaying every object
+    - when there is nothing to resume from, objects are listed in pages,
+        each handed over as it arrives, before watching from the list
+    - a raw mode skips the model deserialization, keeping only the
+        fields the controller actually reads
+    - the resourceVersions produced by the controller's own writes are
+        remembered, so the events they cause can be told apart
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import re
+import threading
+from collections import OrderedDict
+from contextlib import aclosing
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable
+
+from kubernetes.watch import Watch
+
+from const import LIST_PAGE_SIZE, WATCH_QUEUE_SIZE
+
+logger = logging.getLogger('watch_helper')
+logger.setLevel(logging.INFO)
+
+# Marks the end of the stream on the queue
+_DONE = object()
+
+
+class ResumePoint:
+    """
+    Remembers the most recent resourceVersion observed on a watch,
+    including the ones only carried by BOOKMARK events.
+    It lives longer than the watch itself, so a new stream
+    can pick up from where the previous one dropped.
+    """
+    def __init__(self):
+        self.version = None
+
+    def observe(self, event:dict) -> None:
+        """
+        Records the resourceVersion of a watch event, if it has one
+        """
+        version = _resource_version(event.get("raw_object", event.get("object")))
+        if version:
+            self.version = version
+
+    def watch_kwargs(self) -> dict:
+        """
+        Arguments for the list function to request bookmarks and,
+        if known, to start from the last resourceVersion
+        """
+        kwargs = {"allow_watch_bookmarks": True}
+        if self.version:
+            kwargs["resource_version"] = self.version
+        return kwargs
+
+    def reset(self) -> None:
+        """
+        Forget the resourceVersion, the next watch will relist everything
+        """
+        self.version = None
+
+
+class SelfWrites:
+    """
+    Last known state of the objects the controller writes to: the
+    annotations it sent, along with the resourceVersion and generation
+    the API server answered with.
+    The expected annotations are set before the request is sent, so the
+    watch event it causes can't slip through before the answer is back.
+    Both objects and versions are bounded, least recently used first out.
+    """
+    def __init__(self, size:int=1024):
+        self.size = size
+        self._objects: OrderedDict[str, dict] = OrderedDict()
+        self._versions: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def expect(self, name:str, annotations:dict) -> dict | None:
+        """
+        Records the annotations about to be written to `name`.
+        Returns the previous state, to `restore` if the write fails
+        """
+        with self._lock:
+            previous = self._objects.get(name)
+            generation = previous["generation"] if previous else None
+            self._remember(self._objects, name, {
+                "annotations": dict(annotations), "generation": generation
+            })
+            return previous
+
+    def record(self, name:str, obj:Any) -> None:
+        """
+        Records the object returned by a successful write
+        """
+        version = _resource_version(obj)
+        generation = _field_of(obj, "generation")
+        with self._lock:
+            if version:
+                self._remember(self._versions, version, None)
+            if generation is not None and name in self._objects:
+                self._objects[name]["generation"] = generation
+
+    def restore(self, name:str, previous:dict | None) -> None:
+        """
+        Rolls back an `expect` whose write didn't go through
+        """
+        with self._lock:
+            if previous is None:
+                self._objects.pop(name, None)
+            else:
+                self._objects[name] = previous
+
+    def forget(self, name:str) -> None:
+        """
+        Drops what is known of `name`, i.e. once it's deleted
+        """
+        with self._lock:
+            self._objects.pop(name, None)
+
+    def clear(self) -> None:
+        """
+        Drops everything
+        """
+        with self._lock:
+            self._objects = OrderedDict()
+            self._versions = OrderedDict()
+
+    def is_own(self, event:dict) -> bool:
+        """
+        Whether the event brings nothing new compared to the controller's
+        own writes. That's only the case for the event caused by a write,
+        found by its resourceVersion or, if the answer isn't back yet, by
+        its annotations being exactly the ones expected. Any value changed
+        or removed since, i.e. an approval, gets through, and so does
+        a new generation, i.e. a spec change
+        """
+        obj = event.get("raw_object", event.get("object"))
+        with self._lock:
+            if _resource_version(obj) in self._versions:
+                return True
+            known = self._objects.get(_field_of(obj, "name"))
+            if known is None:
+                return False
+            generation = _field_of(obj, "generation")
+            if known["generation"] is not None and generation != known["generation"]:
+                return False
+            return (_field_of(obj, "annotations") or {}) == known["annotations"]
+
+    def _remember(self, store:OrderedDict, key:str, value:Any):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.size:
+            store.popitem(last=False)
+
+
+def _field_of(obj:Any, field:str) -> Any:
+    """
+    Reads a metadata field from either a raw dictionary or a kubernetes model
+    """
+    if isinstance(obj, dict):
+        return (obj.get("metadata") or {}).get(field)
+    return getattr(getattr(obj, "metadata", None), field, None)
+
+
+def _resource_version(obj:Any) -> str | None:
+    if isinstance(obj, dict):
+        version = (obj.get("metadata") or {}).get("resourceVersion")
+    else:
+        version = getattr(getattr(obj, "metadata", None), "resource_version", None)
+    return version if isinstance(version, str) and version else None
+
+
+class RawWatch(Watch):
+    """
+    Watch yielding the objects as decoded JSON, skipping the
+    kubernetes models deserialization of every event
+    """
+    def unmarshal_event(self, data, return_type):
+        event = super().unmarshal_event(data, None)
+        if isinstance(event, dict) and isinstance(event.get("object"), dict):
+            version = (event["object"].get("metadata") or {}).get("resourceVersion")
+            if version:
+                # Picked up by the watch when it reconnects by itself
+                self.resource_version = version
+        return event
+
+
+def lean_decoder(shape:dict) -> Callable[[dict], SimpleNamespace]:
+    """
+    Returns a function turning an object's raw JSON into a light view
+    holding only the fields listed in `shape`. Keys are converted to
+    snake_case, so the view reads like the kubernetes models, e.g.
+        {"metadata": {"name": None}, "status": {"phase": None}}
+    gives `view.metadata.name` and `view.status.phase`.
+    Missing fields are None, missing sections are still there, but empty
+    """
+    def decode(raw:dict | None, fields:dict=shape) -> SimpleNamespace:
+        raw = raw or {}
+        view = SimpleNamespace()
+        for key, sub_fields in fields.items():
+            value = raw.get(key)
+            if isinstance(sub_fields, dict):
+                value = decode(value, sub_fields)
+            setattr(view, re.sub(r'(?<!^)(?=[A-Z])', '_', key).lower(), value)
+        return view
+    return decode
+
+
+class _StreamFailure:
+    """
+    Carries an exception raised by the stream across the thread boundary
+    """
+    def __init__(self, exc:BaseException):
+        self.exc = exc
+
+
+async def stream_events(
+        watcher:Watch,
+        func:Callable,
+        *args,
+        max_pending:int=WATCH_QUEUE_SIZE,
+        **kwargs
+    ) -> AsyncIterator[dict]:
+    """
+    Async version of `watcher.stream(func, *args, **kwargs)`.
+    The stream runs on a separate thread, and at most `max_pending`
+    events are buffered before the thread waits for the consumer.
+    Exceptions raised by the stream are re-raised on the consumer side.
+
+    Use it with `contextlib.aclosing` so the watcher is stopped
+    as soon as the consumer stops iterating.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max(max_pending, 1))
+    stopped = threading.Event()
+
+    def handoff(item) -> None:
+        if stopped.is_set():
+            return
+        put = queue.put(item)
+        try:
+            future = asyncio.run_coroutine_threadsafe(put, loop)
+        except RuntimeError:
+            # Loop is closed, nobody is listening anymore
+            put.close()
+            stopped.set()
+            return
+        while not stopped.is_set():
+            try:
+                future.result(timeout=0.5)
+                return
+            except concurrent.futures.TimeoutError:
+                continue
+            except concurrent.futures.CancelledError:
+                stopped.set()
+                return
+        future.cancel()
+
+    def produce() -> None:
+        try:
+            for event in watcher.stream(func, *args, **kwargs):
+                if stopped.is_set():
+                    break
+                handoff(event)
+        # pylint: disable=W0718
+        except Exception as exc:
+            handoff(_StreamFailure(exc))
+        finally:
+            handoff(_DONE)
+
+    thread = threading.Thread(
+        target=produce,
+        name=f"watch-{getattr(func, '__name__', 'stream')}",
+        daemon=True
+    )
+    thread.start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StreamFailure):
+                raise item.exc
+            yield item
+    finally:
+        stopped.set()
+        watcher.stop()
+
+
+async def list_and_watch(
+        watcher:Watch,
+        resume_point:ResumePoint,
+        func:Callable,
+        *args,
+        page_size:int=LIST_PAGE_SIZE,
+        **kwargs
+    ) -> AsyncIterator[dict]:
+    """
+    Lists the objects `page_size` at a time, yielding them as ADDED
+    events as each page comes in, so only one page is held in memory.
+    Then watches, through `stream_events`, from the resourceVersion of
+    the list. If `resume_point` already has a version, it goes straight
+    to the watch. `resume_point` follows every event watched.
+
+    As with `stream_events`, use it with `contextlib.aclosing`
+    """
+    if not resume_point.version:
+        token = None
+        while True:
+            page = await asyncio.to_thread(func, *args, limit=page_size, _continue=token, **kwargs)
+            for obj in page.get("items") or []:
+                yield {"type": "ADDED", "object": obj}
+            token = (page.get("metadata") or {}).get("continue")
+            if not token:
+                break
+        # Only set once the last page is through, an interrupted
+        # list has to start over rather than resume halfway
+        resume_point.version = (page.get("metadata") or {}).get("resourceVersion")
+
+    async with aclosing(stream_events(
+        watcher, func, *args, **resume_point.watch_kwargs(), **kwargs
+    )) as events:
+        async for event in events:
+            resume_point.observe(event)
+            yield event
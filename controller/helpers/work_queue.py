@@ -0,0 +1,209 @@
+"""
+Rate limited work queue, modelled after the client-go one.
+    - items are keyed (by CRD name), and a key is queued at most once:
+        further adds only replace the pending item with the latest one
+    - a key being processed is never handed to another worker, new items
+        for it are held until the current one is done
+    - every add goes through a rate limiter, combining a per-key
+        exponential backoff with a global token bucket
+"""
+
+import asyncio
+import time
+from typing import Any
+
+from const import QUEUE_BASE_DELAY, QUEUE_MAX_DELAY, QUEUE_QPS, QUEUE_BURST
+
+
+class RateLimiter:
+    """
+    Decides how long a key has to wait before being queued.
+    The first add of a key is free, every following one doubles the wait,
+    up to `max_delay`, until the key is forgotten. On top of that a token
+    bucket, shared by all the keys, caps the overall rate to `qps`
+    allowing bursts of `burst` items.
+    """
+    def __init__(
+            self,
+            base_delay:float=QUEUE_BASE_DELAY,
+            max_delay:float=QUEUE_MAX_DELAY,
+            qps:float=QUEUE_QPS,
+            burst:int=QUEUE_BURST
+        ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.qps = qps
+        self.burst = burst
+        self._requeues: dict[str, int] = {}
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+
+    def when(self, key:str) -> float:
+        """
+        Seconds to wait before `key` can be queued
+        """
+        requeues = self._requeues.get(key, 0)
+        self._requeues[key] = requeues + 1
+        item_delay = 0
+        if requeues:
+            item_delay = min(self.base_delay * 2 ** (requeues - 1), self.max_delay)
+        return max(item_delay, self._reserve())
+
+    def forget(self, key:str):
+        """
+        Resets the backoff for `key`
+        """
+        self._requeues.pop(key, None)
+
+    def requeues(self, key:str) -> int:
+        """
+        How many times `key` has been added since it was last forgotten
+        """
+        return self._requeues.get(key, 0)
+
+    def _reserve(self) -> float:
+        # Tokens can go negative, which is how long the
+        # caller has to wait for its own token to be refilled
+        if self.qps <= 0:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.qps)
+        self._last = now
+        self._tokens -= 1
+        return 0 if self._tokens >= 0 else -self._tokens / self.qps
+
+
+class WorkQueue:
+    """
+    Deduplicating queue of keys, each carrying the latest item added for it
+    """
+    def __init__(self, limiter:RateLimiter=None):
+        self.limiter = limiter or RateLimiter()
+        self._ready = asyncio.Queue()
+        self._items: dict[str, Any] = {}
+        self._waiting: dict[str, asyncio.TimerHandle] = {}
+        self._not_before: dict[str, float] = {}
+        self._queued = set()
+        self._processing = set()
+        self._changed = asyncio.Condition()
+
+    def __len__(self) -> int:
+        """
+        Number of keys waiting to be picked up
+        """
+        return len(self._items)
+
+    def __contains__(self, key:str) -> bool:
+        return key in self._items
+
+    def active(self, key:str) -> bool:
+        """
+        Whether `key` is pending or being processed
+        """
+        return key in self._items or key in self._processing
+
+    def add(self, key:str, item:Any):
+        """
+        Adds `item` for `key`. If the key is already pending the item
+        replaces the old one, keeping its place and its scheduled time.
+        """
+        pending = key in self._items
+        self._items[key] = item
+        if pending:
+            return
+
+        delay = self.limiter.when(key)
+        if key in self._processing:
+            # Picked up again once the current worker is done with it
+            self._not_before[key] = time.monotonic() + delay
+        else:
+            self._schedule(key, delay)
+
+    def requeue(self, key:str, item:Any):
+        """
+        Adds `item` for `key` without the backoff, for a key that just
+        made progress rather than one getting events in a loop
+        """
+        self.limiter.forget(key)
+        self.add(key, item)
+
+    async def get(self) -> tuple[str, Any]:
+        """
+        Waits for the next ready key, and hands it over along with its
+        latest item. The key stays reserved until `done` is called.
+        """
+        while True:
+            key = await self._ready.get()
+            self._queued.discard(key)
+            if key in self._items:
+                break
+        self._processing.add(key)
+        item = self._items.pop(key)
+        async with self._changed:
+            self._changed.notify_all()
+        return key, item
+
+    async def done(self, key:str):
+        """
+        Releases `key`. If new items arrived while it was being
+        processed it goes back in the queue, otherwise its backoff is reset
+        """
+        self._processing.discard(key)
+        if key in self._items:
+            delay = max(self._not_before.pop(key, 0) - time.monotonic(), 0)
+            self._schedule(key, delay)
+        else:
+            self.limiter.forget(key)
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def discard(self, key:str):
+        """
+        Drops the item pending for `key`, if any. A key being
+        processed isn't interrupted
+        """
+        if self._items.pop(key, None) is None:
+            return
+        self._not_before.pop(key, None)
+        handle = self._waiting.pop(key, None)
+        if handle:
+            handle.cancel()
+        if key not in self._processing:
+            self.limiter.forget(key)
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def wait_for_room(self, limit:int):
+        """
+        Blocks until fewer than `limit` keys are pending
+        """
+        async with self._changed:
+            await self._changed.wait_for(lambda: len(self._items) < max(limit, 1))
+
+    async def wait_idle(self):
+        """
+        Blocks until nothing is pending or being processed
+        """
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self._items and not self._processing)
+
+    def shutdown(self):
+        """
+        Cancels the delayed keys
+        """
+        for handle in self._waiting.values():
+            handle.cancel()
+        self._waiting = {}
+
+    def _schedule(self, key:str, delay:float):
+        if delay <= 0:
+            self._enqueue(key)
+        else:
+            self._waiting[key] = asyncio.get_running_loop().call_later(delay, self._enqueue, key)
+
+    def _enqueue(self, key:str):
+        self._waiting.pop(key, None)
+        if key in self._queued or key not in self._items:
+            return
+        self._queued.add(key)
+        self._ready.put_nowait(key)
@@ -0,0 +1,117 @@
+"""
+Bounded pool of asyncio workers used to reconcile CRDs.
+    - events for the same key (the CRD name) are processed in order, one at a time
+    - events for different keys are processed in parallel, up to the pool size
+    - events arriving for a key that is already pending collapse into the
+        latest one, and keys are rate limited through the work queue
+    - at most `max_pending` keys can be waiting, after which `submit`
+        waits, pushing back on the watch stream feeding the pool
+    - a handler can return a follow-up item, which goes straight back
+        in the queue for the same key, e.g. the next lifecycle step
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from const import CONTROLLER_WORKERS, WATCH_QUEUE_SIZE
+from helpers.work_queue import WorkQueue
+
+logger = logging.getLogger('workers')
+logger.setLevel(logging.INFO)
+
+
+class WorkerPool:
+    """
+    Fixed size set of workers fed by the watch loop.
+    Only one worker at a time can hold a key, so per-CRD ordering
+    is preserved while different CRDs don't wait on each other.
+    """
+    def __init__(
+            self,
+            handler:Callable[[Any], Awaitable],
+            size:int=CONTROLLER_WORKERS,
+            max_pending:int=WATCH_QUEUE_SIZE,
+            queue:WorkQueue=None,
+            follow_ups:bool=True,
+            on_error:Callable[[BaseException], Any]=None
+        ):
+        self.handler = handler
+        self.size = max(size, 1)
+        self.max_pending = max_pending
+        self.queue = queue or WorkQueue()
+        self.follow_ups = follow_ups
+        self.on_error = on_error
+        self.error = None
+        self._workers: list[asyncio.Task] = []
+
+    def start(self):
+        """
+        Spawns the workers on the running loop
+        """
+        self._workers = [
+            asyncio.create_task(self._work(), name=f"reconcile-worker-{n}")
+            for n in range(self.size)
+        ]
+
+    async def submit(self, key:str, item:Any):
+        """
+        Queues an item for its key. If the key is already waiting, the
+        item takes the place of the previous one, as it's a more recent
+        view of the same CRD
+        """
+        self.raise_if_failed()
+        if key not in self.queue:
+            await self.queue.wait_for_room(self.max_pending)
+        self.queue.add(key, item)
+
+    async def discard(self, key:str):
+        """
+        Drops whatever is waiting for `key`, i.e. once it's
+        owned by a different replica
+        """
+        await self.queue.discard(key)
+
+    async def join(self):
+        """
+        Waits until every submitted item has been handled
+        """
+        await self.queue.wait_idle()
+        self.raise_if_failed()
+
+    async def stop(self):
+        """
+        Cancels the workers, dropping anything still queued
+        """
+        self.queue.shutdown()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def raise_if_failed(self):
+        """
+        Handlers are expected to deal with their own errors, anything
+        that escapes them is considered fatal and re-raised to the caller.
+        The caller can also be told straight away through `on_error`
+        """
+        if self.error is not None:
+            raise self.error
+
+    async def _work(self):
+        while True:
+            key, item = await self.queue.get()
+            try:
+                follow_up = await self.handler(item)
+                if follow_up is not None and self.follow_ups:
+                    # Supersedes whatever was queued for the key meanwhile
+                    self.queue.requeue(key, follow_up)
+            # pylint: disable=W0718
+            except Exception as exc:
+                logger.error("Worker failed to process %s: %s", key, exc)
+                if self.error is None:
+                    self.error = exc
+                    if self.on_error is not None:
+                        self.on_error(exc)
+            finally:
+                await self.queue.done(key)
@@ -1,16 +1,32 @@
-import json
+from datetime import datetime, timedelta, timezone
 from math import exp
 import os
+import random
 import re
 
 from const import CRD_GROUP
 from exceptions import CRDException
+from models.delivery import delivery_config
 
 MAX_RETRIES = 5
+# Each retry cooldown is randomly stretched or shrunk up to this fraction
+RETRY_JITTER = 0.2
+# Status conditions, and the lifecycle annotation each of them mirrors
+CONDITIONS = {
+    "UserSynced": "user",
+    "TaskTriggered": "done",
+    "ResultsDelivered": "results"
+}
 
 
 class Analytics:
     domain = CRD_GROUP
+    __slots__ = (
+        "name", "annotations", "image", "user", "proj_name",
+        "dataset", "env", "outputs", "inputs", "source", "query",
+        "delivery", "is_delete", "generation", "conditions",
+        "_labels", "_task_body"
+    )
 
     def __init__(
             self,
@@ -36,9 +52,40 @@ class Analytics:
         self.inputs = crd_definition["object"]["spec"].get("inputs", {})
         self.source = crd_definition["object"]["spec"].get("source", {})
         self.query = crd_definition["object"]["spec"].get("db_query")
-        self.delivery = json.load(open("controller/delivery.json"))
-        self.create_labels()
+        self.delivery = delivery_config.get()
         self.is_delete = (crd_definition["type"] == "DELETED" or crd_definition["object"]["metadata"].get("deletionTimestamp"))
+        self.generation = crd_definition["object"]["metadata"].get("generation", 0)
+        self.conditions = (crd_definition["object"].get("status") or {}).get("conditions", [])
+        self._labels = None
+        self._task_body = None
+
+    @classmethod
+    def skip_event(cls, crd_definition:dict) -> bool:
+        """
+        Same outcome as `should_skip`, but straight from the watch event,
+        so deleted and completed CRDs are dropped without being parsed
+        """
+        metadata = crd_definition["object"].get("metadata") or {}
+        return bool(
+            crd_definition["type"] == "DELETED" or metadata.get("deletionTimestamp")
+            or (metadata.get("annotations") or {}).get(f"{cls.domain}/results")
+        )
+
+    @classmethod
+    def unchanged(cls, previous:dict, current:dict) -> bool:
+        """
+        Whether nothing the lifecycle depends on changed between two
+        versions of the same object, e.g. when only its status was written.
+        The spec is covered by the generation, which status writes don't bump
+        """
+        if previous is None:
+            return False
+        before = previous.get("metadata") or {}
+        after = current.get("metadata") or {}
+        return all(
+            before.get(field) == after.get(field)
+            for field in ("generation", "annotations", "deletionTimestamp")
+        )
 
     def needs_user_sync(self) -> bool:
         return not self.annotations.get(f"{self.domain}/user")
@@ -64,33 +111,61 @@ class Analytics:
                 self.annotations.get(f"{self.domain}/approved", "false").lower() != "true"
             )
 
+    def has_next_step(self) -> bool:
+        """
+        Whether a lifecycle step can run now, rather than
+        the CRD being over or waiting on a review
+        """
+        return bool(self.needs_user_sync() or self.can_trigger_task() or self.can_deliver_results())
+
     def should_skip(self) -> bool:
         return bool(self.is_delete or self.annotations.get(f"{self.domain}/results"))
 
-    def create_labels(self):
+    @property
+    def labels(self) -> dict:
+        """
+        Labels set, only built the first time it's needed
+        """
+        if self._labels is None:
+            self._labels = self.create_labels()
+        return self._labels
+
+    def create_labels(self) -> dict:
         """
         Given the crd spec dictionary, creates a dictionary
         to be used as a labels set. Trims each field to
         64 chars as that's k8s limit
         """
-        self.labels = {}
+        labels = {}
         if self.dataset:
-            self.labels["dataset"] = "-".join(self.dataset.values())[:63]
+            labels["dataset"] = "-".join(self.dataset.values())[:63]
 
-        self.labels.update(self.user)
-        self.labels["repository"] = self.source["repository"].replace("/", "-")[:63]
+        labels.update(self.user)
+        labels["repository"] = self.source["repository"].replace("/", "-")[:63]
         if self.delivery.get("github"):
-            self.labels["repository_results"] = self.delivery["github"]["repository"].replace("/", "-")[:63]
+            labels["repository_results"] = self.delivery["github"]["repository"].replace("/", "-")[:63]
         else:
-            self.labels["results"] = self.delivery["other"].get("url") or self.delivery["other"]["auth_type"]
-        self.labels["image"] = re.sub(r'(\/|:)', '-', self.image)[:63]
+            labels["results"] = self.delivery["other"].get("url") or self.delivery["other"]["auth_type"]
+        labels["image"] = re.sub(r'(\/|:)', '-', self.image)[:63]
+        return labels
+
+    @property
+    def owner_label(self) -> dict:
+        """
+        Label set on the helper jobs created for this CRD,
+        so their events can be traced back to it
+        """
+        return {"crd": self.name[:63].rstrip("-_.")}
 
     def create_task_body(self) -> dict:
         """
         The task body is fairly strict, so we are going to inject few
         custom data in it, like a docker image, a user, a project name and the dataset
-        to run the task on
+        to run the task on. Built once per CRD
         """
+        if self._task_body is not None:
+            return self._task_body
+
         base = {
             "name": self.user.get("username") or self.user.get("email"),
             "executors": [
@@ -114,31 +189,63 @@ class Analytics:
         if self.query:
             base["db_query"] = self.query
 
+        self._task_body = base
         return base
 
-    def prepare_update_job(self) -> dict:
+    def next_retry(self) -> dict:
         """
-        Wrapper to create a job that updates the CRD
-        with an increasing delay. It will retry up to
-        MAX_RETRIES times.
+        Returns the annotations recording the next retry attempt
+        and when it's due. The cooldown grows exponentially with each
+        try, and is jittered so CRDs failing together don't all come
+        back at the same time. It will retry up to MAX_RETRIES times.
         """
-        annotation_check = f"{self.domain}/tries"
-        current_try = int(self.annotations.get(annotation_check, 0)) + 1
+        current_try = int(self.annotations.get(f"{self.domain}/tries", 0)) + 1
 
         if current_try > MAX_RETRIES:
             raise CRDException("Max retries reached. Skipping")
-        cooldown = int(exp(current_try))
-
-        cmd = f"sleep {cooldown} && " \
-            f"kubectl annotate --overwrite analytics {self.name} {annotation_check}={current_try}"
+        cooldown = exp(current_try) * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
 
         return {
-            "name": f"update-annotation-{self.name}",
-            "command": cmd,
-            "run": True,
-            "labels": {
-                "cooldown": f"{cooldown}s",
-                "crd": self.name
-            },
-            "image": "alpine/k8s:1.29.4"
+            f"{self.domain}/tries": str(current_try),
+            f"{self.domain}/retry_at": (
+                datetime.now(timezone.utc) + timedelta(seconds=cooldown)
+            ).isoformat()
         }
+
+    def retry_in(self) -> float:
+        """
+        Seconds left before the pending retry is due, 0 if there is none
+        """
+        retry_at = self.annotations.get(f"{self.domain}/retry_at")
+        if not retry_at:
+            return 0
+        try:
+            due = datetime.fromisoformat(retry_at)
+        except ValueError:
+            return 0
+        return max((due - datetime.now(timezone.utc)).total_seconds(), 0)
+
+    def lifecycle_status(self) -> dict:
+        """
+        Status mirroring the lifecycle annotations, with one condition
+        per step. The annotations stay the source of truth, as some are
+        set outside of the controller (i.e. approved, by the FN API).
+        A condition's transition time is kept until its status changes
+        """
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        previous = {condition.get("type"): condition for condition in self.conditions}
+        tries = self.annotations.get(f"{self.domain}/tries")
+        conditions = []
+        for condition_type, annotation in CONDITIONS.items():
+            reached = bool(self.annotations.get(f"{self.domain}/{annotation}"))
+            status = "True" if reached else "False"
+            last = previous.get(condition_type) or {}
+            conditions.append({
+                "type": condition_type,
+                "status": status,
+                "reason": "Completed" if reached else ("Retrying" if tries else "Pending"),
+                "message": f"Attempt {tries} of {MAX_RETRIES}" if tries and not reached else "",
+                "observedGeneration": self.generation,
+                "lastTransitionTime": last.get("lastTransitionTime") if last.get("status") == status else now
+            })
+        return {"observedGeneration": self.generation, "conditions": conditions}
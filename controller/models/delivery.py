@@ -0,0 +1,73 @@
+"""
+Results delivery configuration, mounted from a ConfigMap.
+    - parsed once, and shared by every CRD as a read-only mapping
+    - reloaded only when the file on disk changes, which is checked
+        through its stat (mtime, size and inode)
+"""
+
+import json
+import logging
+import os
+import threading
+from types import MappingProxyType
+from typing import Any, Mapping
+
+from const import DELIVERY_CONFIG
+
+logger = logging.getLogger('delivery')
+logger.setLevel(logging.INFO)
+
+
+def _freeze(value:Any) -> Any:
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(val) for key, val in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(val) for val in value)
+    return value
+
+
+class DeliveryConfig:
+    """
+    Holds the last parsed version of the delivery file.
+    ConfigMap volumes swap the file through a symlink when updated,
+    so a different stat means the content has to be read again.
+    If the file can't be stat'd it's read every time, as there's
+    no telling whether it changed.
+    """
+    def __init__(self, path:str=DELIVERY_CONFIG):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._config: Mapping = None
+
+    def get(self) -> Mapping:
+        """
+        Returns the current configuration
+        """
+        signature = self._stat()
+        with self._lock:
+            if signature is None or signature != self._signature or self._config is None:
+                with open(self.path, encoding="utf-8") as file:
+                    self._config = _freeze(json.load(file))
+                if self._signature is not None:
+                    logger.info("Delivery configuration reloaded")
+                self._signature = signature
+            return self._config
+
+    def reset(self):
+        """
+        Forgets the parsed configuration
+        """
+        with self._lock:
+            self._signature = None
+            self._config = None
+
+    def _stat(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+delivery_config = DeliveryConfig()
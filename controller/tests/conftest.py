@@ -9,7 +9,12 @@ from kubernetes import client
 from unittest.mock import MagicMock, Mock, mock_open
 
 from const import KC_USER
-from helpers.keycloak_helper import KEYCLOAK_CLIENT
+from controller import crd_resume_point
+from helpers.kubernetes_helper import (
+    analytics_cache, task_pods_cache, jobs_cache, secrets_cache, crd_writes, reset_api_client
+)
+from helpers.keycloak_helper import KEYCLOAK_CLIENT, admin_token, user_directory, user_tokens
+from helpers.retry_scheduler import retry_scheduler
 from models.crd import Analytics
 
 def base_crd_object(name:str, type:str="ADDED", udpid:str=""):
@@ -44,31 +49,13 @@ def crd_object_mock(crd_name, user_idp_id):
     crd_obj= base_crd_object(name=crd_name, udpid=user_idp_id)
     return Analytics(crd_obj)
 
-def pod_object_response():
-    return {
-        "object": Mock(
-            name="job_obj_resp",
-            metadata=Mock(name="job1"),
-            status=Mock(
-                phase="Succeeded"
-            )
-        )
-    }
-
-def job_object_response():
-    return {
-        "object": Mock(
-            name="job_obj_resp",
-            metadata=Mock(name="job1"),
-            status=Mock(
-                succeeded=1,
-                ready=0,
-                terminating=0,
-                active=0,
-                failed=0
-            )
-        )
-    }
+def build_task_pod(phase:str="Succeeded", task_id:str="1"):
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(
+            name=f"task-{task_id}", namespace="analytics", labels={"task_id": task_id}
+        ),
+        status=client.V1PodStatus(phase=phase)
+    )
 
 @pytest_asyncio.fixture
 async def domain():
@@ -177,10 +164,82 @@ async def mock_crd_api_basic_done(mock_crd_task_done):
 @pytest.fixture(autouse=True)
 def k8s_config(mocker):
     mocker.patch('kubernetes.config.load_kube_config', return_value=Mock())
-    mocker.patch('helpers.kubernetes_helper.load_kube_config', return_value=Mock())
+    load_mock = mocker.patch('helpers.kubernetes_helper.load_kube_config', return_value=Mock())
+    reset_api_client()
+    yield load_mock
+    reset_api_client()
+
+@pytest.fixture(autouse=True)
+def informers(mocker):
+    """
+    Informers would list and watch in the background, so they
+    are kept stopped and empty. Lookups fall back to the API, unless
+    a test fills a cache through `replace`/`apply`
+    """
+    mocker.patch('helpers.kubernetes_helper.Informer.start')
+    caches = {
+        "analytics": analytics_cache,
+        "task_pods": task_pods_cache,
+        "jobs": jobs_cache,
+        "secrets": secrets_cache
+    }
+    yield caches
+    for cache in caches.values():
+        cache.clear()
+        cache.resume_point.reset()
+
+@pytest.fixture(autouse=True)
+def reset_resume_point():
+    """
+    The CRD watch resume point outlives `start`, so it's
+    cleared to keep tests independent
+    """
+    yield
+    crd_resume_point.reset()
+
+@pytest.fixture(autouse=True)
+def reset_retries():
+    """
+    Scheduled retries outlive `start` as well
+    """
+    yield
+    retry_scheduler.clear()
+
+@pytest.fixture(autouse=True)
+def reset_self_writes():
+    """
+    So do the CRD writes the controller remembers
+    """
+    yield
+    crd_writes.clear()
+
+@pytest.fixture(autouse=True)
+def reset_tokens():
+    """
+    And the Keycloak tokens and users
+    """
+    yield
+    admin_token.clear()
+    user_tokens.clear()
+    user_directory.clear()
+
+@pytest.fixture(autouse=True)
+def user_prefetch(mocker):
+    """
+    The Keycloak users would be listed in the background,
+    so lookups go to the, mocked, API one by one instead
+    """
+    return mocker.patch('helpers.keycloak_helper.UserDirectory.start')
+
+@pytest_asyncio.fixture
+async def crd_list_mock(mocker):
+    return mocker.patch(
+        'helpers.kubernetes_helper.KubernetesCRD.list_cluster_custom_object',
+        return_value={"items": [], "metadata": {"resourceVersion": "1"}}
+    )
 
 @pytest_asyncio.fixture
-async def k8s_watch_mock(mocker):
+async def k8s_watch_mock(mocker, crd_list_mock):
     return mocker.patch(
         'controller.Watch',
         return_value=Mock(stream=Mock(return_value=[base_crd_object("crd1")]))
@@ -205,11 +264,11 @@ async def v1_mock(mocker, job_spec_mock, encoded_bearer):
             'helpers.kubernetes_helper.KubernetesV1.read_namespaced_secret'
         ),
         "list_namespaced_secret": mocker.patch(
-            'helpers.pod_watcher.KubernetesV1.list_namespaced_secret',
+            'helpers.kubernetes_helper.KubernetesV1.list_namespaced_secret',
             return_value=Mock(items=[Mock(data={"auth": encoded_bearer})])
         ),
         "list_namespaced_pod": mocker.patch(
-            'helpers.pod_watcher.KubernetesV1.list_namespaced_pod',
+            'helpers.kubernetes_helper.KubernetesV1.list_namespaced_pod',
             return_value=Mock(items=[])
         )
     }
@@ -228,6 +287,10 @@ async def v1_crd_mock(mocker):
         "patch_cluster_custom_object_mock": mocker.patch(
             'helpers.kubernetes_helper.KubernetesCRD.patch_cluster_custom_object', return_value=Mock(
             name="patch_cluster_custom_object_mock")
+        ),
+        "patch_cluster_custom_object_status_mock": mocker.patch(
+            'helpers.kubernetes_helper.KubernetesCRD.patch_cluster_custom_object_status',
+            return_value={"metadata": {}}
         )
     }
 
@@ -255,24 +318,32 @@ async def keycloak_url(mocker):
 async def keycloak_realm(mocker):
     return "FederatedNode"
 
+@pytest.fixture
+def task_pod():
+    return build_task_pod
+
 @pytest_asyncio.fixture
-async def mock_pod_watch(mocker, k8s_client, encoded_bearer):
-    return {
-        "watch": mocker.patch(
-            'helpers.pod_watcher.Watch',
-            return_value=Mock(stream=Mock(return_value=[pod_object_response()]))
-        )
-    }
+async def mock_pod_watch(k8s_client, encoded_bearer, informers):
+    """
+    Task pods are followed through the shared informer,
+    which starts off knowing about a completed pod for task 1
+    """
+    informers["task_pods"].replace([build_task_pod()])
+    return {"cache": informers["task_pods"]}
 
 @pytest_asyncio.fixture
-async def mock_job_watch(mocker, k8s_client):
-    mocker.patch(
-        'helpers.pod_watcher.KubernetesV1Batch',
-    )
-    mocker.patch(
-        'helpers.pod_watcher.Watch',
-        return_value=Mock(stream=Mock(return_value=[job_object_response()]))
-    )
+async def mock_job_watch(k8s_client, informers):
+    """
+    Every job created shows up in the shared jobs informer,
+    with the status set here, completed by default
+    """
+    job_watch = {"status": client.V1JobStatus(succeeded=1)}
+
+    def created(namespace, body, **kwargs):
+        body.status = job_watch["status"]
+        informers["jobs"].apply("ADDED", body)
+    k8s_client["create_namespaced_job_mock"].side_effect = created
+    return job_watch
 
 @pytest_asyncio.fixture
 async def fn_task_request(backend_url, respx_mock):
@@ -310,7 +381,9 @@ async def get_user_request(respx_mock, user_idp_id, keycloak_url, keycloak_realm
 @pytest_asyncio.fixture
 async def impersonate_request(respx_mock, keycloak_url, keycloak_realm):
     return respx_mock.post(f"{keycloak_url}/realms/{keycloak_realm}/protocol/openid-connect/token").mock(
-        return_value=httpx.Response(status_code=200, json={"refresh_token": "refresh_token"})
+        return_value=httpx.Response(status_code=200, json={
+            "refresh_token": "refresh_token", "access_token": "access_token", "expires_in": 300
+        })
     )
 
 @pytest.fixture(autouse=True)
@@ -320,7 +393,7 @@ def delivery_open(request, mocker):
     file_contents = {"github": {"repository": "org/repo"}}
     if getattr(request, "param", None):
         file_contents = request.param
-    return mocker.patch("models.crd.open", mock_open(read_data=json.dumps(file_contents)))
+    return mocker.patch("models.delivery.open", mock_open(read_data=json.dumps(file_contents)))
 
 @pytest_asyncio.fixture
 async def review_env(monkeypatch):
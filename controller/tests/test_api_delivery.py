@@ -43,14 +43,12 @@ class TestWatcherApiDelivery:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_called_with(
             'tasks.federatednode.com', 'v1', 'analytics', crd_name,
-            [{'op': 'add', 'path': '/metadata/annotations', 'value':
+            {"metadata": {"annotations":
                 {
-                    f"{domain}/user": "ok",
-                    f"{domain}/done": "true",
-                    f"{domain}/results": "true",
-                    f"{domain}/task_id": "1"
+                    f"{domain}/results": "true"
                 }
-            }]
+            }},
+            _content_type='application/merge-patch+json'
         )
 
     @mark.asyncio
@@ -89,22 +87,22 @@ class TestWatcherApiDelivery:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_called_with(
             'tasks.federatednode.com', 'v1', 'analytics', crd_name,
-            [{'op': 'add', 'path': '/metadata/annotations', 'value':
+            {"metadata": {"annotations":
                 {
-                    f"{domain}/user": "ok",
-                    f"{domain}/done": "true",
-                    f"{domain}/results": "true",
-                    f"{domain}/task_id": "1"
+                    f"{domain}/results": "true"
                 }
-            }]
+            }},
+            _content_type='application/merge-patch+json'
         )
 
     @mark.asyncio
     @mark.parametrize('delivery_open', [delivery_content], indirect=True)
+    @mock.patch('controller.schedule_retry')
     @mock.patch('helpers.actions.get_user_token', return_value="token")
     async def test_get_results_api_delivery_fails(
             self,
             token_mock,
+            schedule_retry_mock,
             k8s_client,
             k8s_watch_mock,
             v1_batch_mock,
@@ -117,7 +115,7 @@ class TestWatcherApiDelivery:
         ):
         """
         Tests that once the task's pod is completed,
-        the results fail to be sent, and will trigger the retry job
+        the results fail to be sent, and will schedule a retry
         """
         k8s_watch_mock.return_value.stream.return_value = [mock_crd_task_done]
 
@@ -131,5 +129,5 @@ class TestWatcherApiDelivery:
 
         # CRD not patched immediately
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
-        # The retry job is triggered
-        v1_batch_mock["create_namespaced_job_mock"].assert_called()
+        # The retry is scheduled
+        schedule_retry_mock.assert_called()
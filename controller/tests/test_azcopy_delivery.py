@@ -34,14 +34,12 @@ class TestWatcherAzCopyDelivery:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_called_with(
             'tasks.federatednode.com', 'v1', 'analytics', crd_name,
-            [{'op': 'add', 'path': '/metadata/annotations', 'value':
+            {"metadata": {"annotations":
                 {
-                    f"{domain}/user": "ok",
-                    f"{domain}/done": "true",
-                    f"{domain}/results": "true",
-                    f"{domain}/task_id": "1"
+                    f"{domain}/results": "true"
                 }
-            }]
+            }},
+            _content_type='application/merge-patch+json'
         )
         subprocees_mock.assert_called_with(
             [
@@ -54,12 +52,14 @@ class TestWatcherAzCopyDelivery:
 
     @pytest.mark.asyncio
     @mark.parametrize('delivery_open', [delivery_content], indirect=True)
+    @mock.patch('controller.schedule_retry')
     @mock.patch("subprocess.run", return_value=mock.Mock(stdout="In progress", stderr="Failed!"))
     @mock.patch('helpers.actions.get_user_token', return_value="token")
     async def test_get_results_azcopy_delivery_fails(
             self,
             token_mock,
             subprocees_mock,
+            schedule_retry_mock,
             k8s_client,
             k8s_watch_mock,
             v1_batch_mock,
@@ -72,7 +72,7 @@ class TestWatcherAzCopyDelivery:
         """
         Tests that once the task's pod is completed,
         the results fail to be sent through AzCopy to a storage account
-        and the retry job is triggered
+        and the retry is scheduled
         """
         k8s_watch_mock.return_value.stream.return_value = [mock_crd_task_done]
         await start(True)
@@ -87,4 +87,4 @@ class TestWatcherAzCopyDelivery:
         )
         # CRD not patched immediately
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
-        v1_batch_mock["create_namespaced_job_mock"].assert_called()
+        schedule_retry_mock.assert_called()
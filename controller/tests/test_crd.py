@@ -0,0 +1,124 @@
+import json
+import os
+import pytest
+from copy import deepcopy
+
+from controller import start
+from models.crd import Analytics
+from models.delivery import DeliveryConfig
+
+
+class TestAnalytics:
+    @pytest.mark.parametrize("event_type,metadata,skipped", [
+        ("MODIFIED", {}, False),
+        ("DELETED", {}, True),
+        ("MODIFIED", {"deletionTimestamp": "2024-01-01T00:00:00Z"}, True),
+        ("MODIFIED", {"annotations": {"tasks.federatednode.com/results": "true"}}, True),
+        ("MODIFIED", {"annotations": None}, False),
+    ])
+    def test_skip_event(self, event_type, metadata, skipped):
+        """
+        Tests that finished or deleted CRDs are recognised
+        straight from the watch event
+        """
+        event = {"type": event_type, "object": {"metadata": {"name": "crd1", **metadata}}}
+        assert Analytics.skip_event(event) == skipped
+
+    @pytest.mark.asyncio
+    async def test_skipped_events_are_not_parsed(self, k8s_watch_mock, mocker):
+        """
+        Tests that a completed CRD never gets an Analytics object built
+        """
+        event = deepcopy(k8s_watch_mock.return_value.stream.return_value[0])
+        event["object"]["metadata"]["annotations"]["tasks.federatednode.com/results"] = "true"
+        k8s_watch_mock.return_value.stream.return_value = [event]
+        init_mock = mocker.patch('controller.Analytics.__init__')
+
+        await start(True)
+
+        init_mock.assert_not_called()
+
+    def test_derived_fields_are_built_once(self, crd_object_mock, delivery_open):
+        """
+        Tests that labels and task body are only built when
+        first needed, and then reused
+        """
+        assert crd_object_mock._labels is None
+        labels = crd_object_mock.labels
+        assert crd_object_mock.labels is labels
+        assert crd_object_mock.create_task_body() is crd_object_mock.create_task_body()
+        assert not hasattr(crd_object_mock, "__dict__")
+
+    def test_status_keeps_transition_times(self, mock_crd, domain, delivery_open):
+        """
+        Tests that conditions follow the annotations, and only get
+        a new transition time when their status changes
+        """
+        mock_crd["object"]["metadata"]["generation"] = 2
+        mock_crd["object"]["metadata"]["annotations"] = {f"{domain}/tries": "1"}
+        mock_crd["object"]["status"] = {"conditions": [
+            {"type": "UserSynced", "status": "False", "lastTransitionTime": "2024-01-01T00:00:00Z"},
+            {"type": "TaskTriggered", "status": "True", "lastTransitionTime": "2024-01-01T00:00:00Z"}
+        ]}
+
+        status = Analytics(mock_crd).lifecycle_status()
+
+        assert status["observedGeneration"] == 2
+        user, task, results = status["conditions"]
+        assert (user["reason"], user["message"]) == ("Retrying", "Attempt 1 of 5")
+        assert user["lastTransitionTime"] == "2024-01-01T00:00:00Z"
+        assert task["lastTransitionTime"] != "2024-01-01T00:00:00Z"
+        assert results["status"] == "False"
+
+    @pytest.mark.parametrize("change,unchanged", [
+        ({}, True),
+        ({"generation": 2}, False),
+        ({"annotations": {"tasks.federatednode.com/approved": "true"}}, False),
+        ({"deletionTimestamp": "2024-01-01T00:00:00Z"}, False),
+    ])
+    def test_unchanged(self, change, unchanged):
+        """
+        Tests that only changes to the spec, annotations or deletion
+        are considered relevant to the lifecycle
+        """
+        previous = {"metadata": {"name": "crd1", "generation": 1, "annotations": {}}}
+        current = {"metadata": {**previous["metadata"], "resourceVersion": "2", **change}, "status": {}}
+
+        assert Analytics.unchanged(previous, current) == unchanged
+        assert not Analytics.unchanged(None, current)
+
+
+class TestDeliveryConfig:
+    @pytest.fixture(autouse=True)
+    def real_file(self, mocker):
+        """
+        The delivery file is mocked for every other test
+        """
+        mocker.patch("models.delivery.open", open)
+
+    def test_parsed_once_until_changed(self, tmp_path, mocker):
+        """
+        Tests that the file is only parsed again once it changes
+        """
+        path = tmp_path / "delivery.json"
+        path.write_text(json.dumps({"github": {"repository": "org/repo"}}))
+        load_spy = mocker.spy(json, "load")
+        config = DeliveryConfig(str(path))
+
+        assert config.get() is config.get()
+        assert load_spy.call_count == 1
+
+        path.write_text(json.dumps({"other": {"url": "https://results.com"}}))
+        os.utime(path, ns=(0, 0))
+        assert config.get()["other"]["url"] == "https://results.com"
+        assert load_spy.call_count == 2
+
+    def test_config_is_read_only(self, tmp_path):
+        """
+        Tests that the configuration shared by all CRDs can't be changed
+        """
+        path = tmp_path / "delivery.json"
+        path.write_text(json.dumps({"github": {"repository": "org/repo"}}))
+
+        with pytest.raises(TypeError):
+            DeliveryConfig(str(path)).get()["github"]["repository"] = "other/repo"
@@ -0,0 +1,251 @@
+import asyncio
+import base64
+import json
+import pytest
+import threading
+from contextlib import aclosing
+from unittest import mock
+from kubernetes import client
+
+from const import NAMESPACE
+from helpers.kubernetes_helper import (
+    LEAN_POD, AsyncKubernetesV1, Informer, InformerDispatcher,
+    decode_secret, label_indexer, secrets_cache
+)
+from helpers.watch_helper import lean_decoder
+
+
+def pod(name:str, phase:str, **labels):
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name, namespace="tasks", labels=labels),
+        status=client.V1PodStatus(phase=phase)
+    )
+
+
+class TestInformer:
+    def informer(self, *args, **kwargs) -> Informer:
+        return Informer(
+            "pods", *args,
+            indexers={"task_id": label_indexer("task_id")},
+            **kwargs
+        )
+
+    def test_indexes_follow_updates(self):
+        """
+        Tests that modified objects are moved across
+        index values, and deleted ones are dropped
+        """
+        cache = self.informer()
+        cache.apply("ADDED", pod("pod1", "Pending", task_id="1"))
+        cache.apply("ADDED", pod("pod2", "Running", task_id="2"))
+
+        assert [p.metadata.name for p in cache.by_index("task_id", "1")] == ["pod1"]
+
+        cache.apply("MODIFIED", pod("pod1", "Succeeded", task_id="3"))
+        assert cache.by_index("task_id", "1") == []
+        assert cache.by_index("task_id", "3")[0].metadata.name == "pod1"
+        assert cache.get("tasks/pod1").status.phase == "Succeeded"
+
+        cache.apply("DELETED", pod("pod1", "Succeeded", task_id="3"))
+        assert cache.by_index("task_id", "3") == []
+        assert [p.metadata.name for p in cache.list()] == ["pod2"]
+
+    def test_replace_marks_synced(self):
+        """
+        Tests that the cache is only trusted after a full list
+        """
+        cache = self.informer()
+        cache.apply("ADDED", pod("old", "Running", task_id="1"))
+        assert not cache.has_synced
+
+        cache.replace([pod("pod2", "Running", task_id="2")])
+        assert cache.has_synced
+        assert cache.by_index("task_id", "1") == []
+
+        cache.clear()
+        assert not cache.has_synced
+
+    def test_custom_objects_are_indexed(self):
+        """
+        Tests that raw dictionaries, like the Analytics objects, are supported
+        """
+        cache = Informer("crds", indexers={"user": lambda crd: list(crd["spec"]["user"].values())})
+        cache.apply("ADDED", {"metadata": {"name": "crd1"}, "spec": {"user": {"username": "user1"}}})
+
+        assert cache.get("crd1")["metadata"]["name"] == "crd1"
+        assert len(cache.by_index("user", "user1")) == 1
+
+    def test_list_then_watch(self, mocker):
+        """
+        Tests that the informer lists once, then watches
+        from the list resourceVersion
+        """
+        list_mock = mock.Mock(return_value=client.V1PodList(
+            items=[pod("pod1", "Pending", task_id="1")],
+            metadata=client.V1ListMeta(resource_version="10")
+        ))
+        k8s_client = mock.Mock(return_value=mock.Mock(list_namespaced_pod=list_mock))
+        cache = self.informer(k8s_client, "list_namespaced_pod", "tasks", label_selector="task_id")
+
+        def stream(*args, **kwargs):
+            yield {"type": "MODIFIED", "object": pod("pod1", "Running", task_id="1")}
+            yield {"type": "BOOKMARK", "object": {"metadata": {"resourceVersion": "12"}}}
+            cache.stop()
+        watch_mock = mocker.patch('helpers.kubernetes_helper.Watch')
+        watch_mock.return_value.stream.side_effect = stream
+
+        cache._run()
+
+        list_mock.assert_called_once_with("tasks", label_selector="task_id")
+        assert watch_mock.return_value.stream.call_args.kwargs["resource_version"] == "10"
+        assert cache.by_index("task_id", "1")[0].status.phase == "Running"
+        assert cache.resume_point.version == "12"
+
+
+    def test_lean_list_then_watch(self, mocker):
+        """
+        Tests that an informer with a decoder lists and watches raw
+        JSON, and only keeps the decoded view of each pod
+        """
+        raw_pod = {
+            "metadata": {"name": "pod1", "namespace": "tasks", "labels": {"task_id": "1"}},
+            "spec": {"containers": [{"name": "task"}]},
+            "status": {"phase": "Pending"}
+        }
+        list_mock = mock.Mock(return_value=mock.Mock(data=json.dumps({
+            "items": [raw_pod], "metadata": {"resourceVersion": "10"}
+        })))
+        k8s_client = mock.Mock(return_value=mock.Mock(list_namespaced_pod=list_mock))
+        cache = self.informer(
+            k8s_client, "list_namespaced_pod", "tasks",
+            decoder=lean_decoder(LEAN_POD), label_selector="task_id"
+        )
+
+        def stream(*args, **kwargs):
+            yield {"type": "MODIFIED", "object": {**raw_pod, "status": {"phase": "Running"}}}
+            cache.stop()
+        watch_mock = mocker.patch('helpers.kubernetes_helper.RawWatch')
+        watch_mock.return_value.stream.side_effect = stream
+
+        cache._run()
+
+        list_mock.assert_called_once_with("tasks", label_selector="task_id", _preload_content=False)
+        pod = cache.by_index("task_id", "1")[0]
+        assert pod.status.phase == "Running"
+        assert not hasattr(pod, "spec")
+
+
+class TestInformerDispatcher:
+    @pytest.mark.asyncio
+    async def test_events_reach_the_waiting_task(self):
+        """
+        Tests that changes applied by the informer thread are handed
+        to the coroutine waiting on that task id only
+        """
+        cache = Informer("pods", indexers={"task_id": label_indexer("task_id")})
+        dispatcher = InformerDispatcher(cache, "task_id")
+        cache.apply("ADDED", pod("pod1", "Running", task_id="1"))
+
+        def informer_thread():
+            cache.apply("MODIFIED", pod("pod2", "Running", task_id="2"))
+            cache.apply("MODIFIED", pod("pod1", "Succeeded", task_id="1"))
+
+        phases = []
+        async with aclosing(dispatcher.events("1", not_found_timeout=1)) as events:
+            async for event in events:
+                phases.append(event["object"].status.phase)
+                if len(phases) == 1:
+                    threading.Thread(target=informer_thread).start()
+                else:
+                    break
+
+        assert phases == ["Running", "Succeeded"]
+        assert dispatcher.waiting("1") == 0
+
+    @pytest.mark.asyncio
+    async def test_missing_object_times_out(self):
+        """
+        Tests that waiting stops if nothing shows up in time
+        """
+        cache = Informer("pods", indexers={"task_id": label_indexer("task_id")})
+        dispatcher = InformerDispatcher(cache, "task_id")
+
+        events = [event async for event in dispatcher.events("1", not_found_timeout=0.05)]
+
+        assert events == []
+
+    @pytest.mark.asyncio
+    async def test_callbacks_fire_once_on_match(self):
+        """
+        Tests that a registered callback is called on the loop, only for
+        the first matching event, and that registering again replaces it
+        """
+        cache = Informer("pods", indexers={"task_id": label_indexer("task_id")})
+        dispatcher = InformerDispatcher(cache, "task_id")
+        calls = []
+        dispatcher.notify("1", "crd1", lambda: calls.append("old"))
+        dispatcher.notify(
+            "1", "crd1", lambda: calls.append("new"),
+            match=lambda event: event["object"].status.phase == "Succeeded"
+        )
+
+        thread = threading.Thread(target=lambda: [
+            cache.apply("MODIFIED", pod("pod1", "Running", task_id="1")),
+            cache.apply("MODIFIED", pod("pod1", "Succeeded", task_id="1")),
+            cache.apply("MODIFIED", pod("pod1", "Succeeded", task_id="1"))
+        ])
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0)
+
+        assert calls == ["new"]
+
+    @pytest.mark.asyncio
+    async def test_relist_without_the_pod_fires_callbacks(self):
+        """
+        Tests that a pod deleted while the watch was down, so only
+        missing from the relist, still fires the callbacks waiting on it
+        """
+        cache = Informer("pods", indexers={"task_id": label_indexer("task_id")})
+        dispatcher = InformerDispatcher(cache, "task_id")
+        cache.replace([pod("pod1", "Running", task_id="1"), pod("pod2", "Running", task_id="2")])
+        deleted = []
+        dispatcher.notify(
+            "1", "crd1", lambda: deleted.append("1"),
+            match=lambda event: event["type"] == "DELETED"
+        )
+
+        cache.replace([pod("pod2", "Running", task_id="2")])
+
+        assert deleted == ["1"]
+        assert cache.by_index("task_id", "1") == []
+        assert cache.has_synced
+
+
+def secret(name:str, **data):
+    return decode_secret({
+        "metadata": {"name": name, "namespace": NAMESPACE, "labels": {"url": f"{name}.com"}},
+        "data": {key: base64.b64encode(value).decode() for key, value in data.items()}
+    })
+
+
+class TestSecretsCache:
+    @pytest.mark.asyncio
+    async def test_secrets_are_read_from_the_cache(self, k8s_client):
+        """
+        Tests that secrets the informer has are decoded once, and returned
+        without calling the API, by name or label, as they change
+        """
+        secrets_cache.replace([secret("kc-secrets", KEYCLOAK_SECRET=b"abc"), secret("api", auth=b"token")])
+        k8s = AsyncKubernetesV1()
+
+        assert await k8s.get_secret("kc-secrets", "KEYCLOAK_SECRET") == "abc"
+        assert await k8s.get_secret_by_label("url=api.com") == {"auth": "token"}
+        secrets_cache.apply("MODIFIED", secret("api", auth=b"new", cert=b"\xff"))
+        assert await k8s.get_secret_by_label("url=api.com") == {"auth": "new", "cert": b"\xff"}
+        k8s_client["read_namespaced_secret"].assert_not_called()
+        k8s_client["list_namespaced_secret"].assert_not_called()
+
+        secrets_cache.apply("DELETED", secret("api"))
+        assert await k8s.get_secret_by_label("url=api.com") == {"auth": "token"}
+        k8s_client["list_namespaced_secret"].assert_called_once()
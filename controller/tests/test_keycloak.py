@@ -1,9 +1,11 @@
+import asyncio
 import httpx
 import pytest
 import responses
 from unittest import mock
 from controller import start
-from exceptions import CRDException
+from exceptions import CRDException, KeycloakException
+from helpers.keycloak_helper import TokenCache, UserDirectory, UserTokens, admin_token, with_admin_token
 
 
 class TestKeycloakRequests:
@@ -69,13 +71,13 @@ class TestKeycloakRequests:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_called_with(
             'tasks.federatednode.com', 'v1', 'analytics', crd_name,
-            [{'op': 'add', 'path': '/metadata/annotations', 'value':
+            {"metadata": {"annotations":
                 {
-                    f"{domain}/user": "ok",
                     f"{domain}/done": "true",
                     f"{domain}/task_id": "1"
                 }
-            }]
+            }},
+            _content_type='application/merge-patch+json'
         )
 
     @pytest.mark.asyncio
@@ -108,20 +110,22 @@ class TestKeycloakRequests:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_called_with(
             'tasks.federatednode.com', 'v1', 'analytics', crd_name,
-            [{'op': 'add', 'path': '/metadata/annotations', 'value':
+            {"metadata": {"annotations":
                 {
-                    f"{domain}/user": "ok",
                     f"{domain}/done": "true",
                     f"{domain}/task_id": "1"
                 }
-            }]
+            }},
+            _content_type='application/merge-patch+json'
         )
 
     @pytest.mark.asyncio
+    @mock.patch('controller.schedule_retry')
     @mock.patch('helpers.actions.create_fn_task')
     async def test_user_not_found(
             self,
             create_task_mock,
+            schedule_retry_mock,
             mock_crd_user_synched,
             k8s_client,
             user_email,
@@ -167,3 +171,193 @@ class TestKeycloakRequests:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
         create_task_mock.assert_not_called()
+
+
+class TestAdminToken:
+    @pytest.mark.asyncio
+    async def test_concurrent_callers_share_a_request(self, mocker):
+        """
+        Tests that callers finding no token share the same
+        request, and the token is reused until close to its expiry
+        """
+        monotonic = mocker.patch('helpers.keycloak_helper.time.monotonic', return_value=100.0)
+
+        async def fetch():
+            await asyncio.sleep(0)
+            return f"token{fetch_mock.call_count}", 60
+        fetch_mock = mock.AsyncMock(side_effect=fetch)
+        tokens = TokenCache(fetch_mock, leeway=30)
+
+        assert await asyncio.gather(tokens.get(), tokens.get(), tokens.get()) == ["token1"] * 3
+        monotonic.return_value = 129.0
+        assert await tokens.get() == "token1"
+        monotonic.return_value = 131.0
+        assert await tokens.get() == "token2"
+        assert fetch_mock.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_rejected_token_is_renewed_once(self, mocker):
+        """
+        Tests that a 401 gets the admin token renewed, and
+        the request sent again, only once
+        """
+        fetch_mock = mocker.patch(
+            'helpers.keycloak_helper.request_admin_token',
+            side_effect=[("old", 300), ("new", 300)]
+        )
+        mocker.patch.object(admin_token, "fetch", fetch_mock)
+        send = mock.AsyncMock(side_effect=[
+            httpx.Response(status_code=401), httpx.Response(status_code=401)
+        ])
+
+        response = await with_admin_token(send)
+
+        assert response.status_code == 401
+        assert [call.args[0] for call in send.call_args_list] == ["old", "new"]
+        assert await admin_token.get() == "new"
+
+
+class TestUserTokens:
+    @pytest.mark.asyncio
+    async def test_user_is_impersonated_once(self, mocker):
+        """
+        Tests that access tokens are minted from the cached refresh
+        token, and only the least recently used users are dropped
+        """
+        exchange_mock = mocker.patch(
+            'helpers.keycloak_helper.impersonate_user',
+            side_effect=lambda user_id: (f"refresh-{user_id}", 1800)
+        )
+        refresh_mock = mocker.patch(
+            'helpers.keycloak_helper.refresh_user_token',
+            side_effect=lambda token: (token.replace("refresh", "access"), 300)
+        )
+        tokens = UserTokens(size=2)
+
+        assert await tokens.get("user1") == "access-user1"
+        assert await tokens.get("user1") == "access-user1"
+        assert exchange_mock.call_count == refresh_mock.call_count == 1
+
+        await tokens.get("user2")
+        await tokens.get("user1")
+        await tokens.get("user3")
+        assert len(tokens) == 2
+        await tokens.get("user1")
+        await tokens.get("user2")
+        assert [call.args[0] for call in exchange_mock.call_args_list] == [
+            "user1", "user2", "user3", "user2"
+        ]
+
+    @pytest.mark.asyncio
+    async def test_rejected_refresh_token_is_replaced(self, mocker):
+        """
+        Tests that a refresh token that no longer works, i.e. the
+        session ended, gets the user impersonated again
+        """
+        exchange_mock = mocker.patch(
+            'helpers.keycloak_helper.impersonate_user',
+            side_effect=[("refresh1", 1800), ("refresh2", 1800)]
+        )
+        mocker.patch(
+            'helpers.keycloak_helper.refresh_user_token',
+            side_effect=[KeycloakException("Session not active"), ("access2", 300)]
+        )
+
+        assert await UserTokens().get("user1") == "access2"
+        assert exchange_mock.call_count == 2
+
+
+class TestUserDirectory:
+    @pytest.mark.asyncio
+    async def test_missing_user_is_looked_up_once(self, mocker):
+        """
+        Tests that a burst of lookups for a user that doesn't exist
+        costs one request, until the miss expires
+        """
+        monotonic = mocker.patch('helpers.keycloak_helper.time.monotonic', return_value=100.0)
+
+        async def query(_params):
+            await asyncio.sleep(0)
+            return []
+        query_mock = mocker.patch('helpers.keycloak_helper.query_users', side_effect=query)
+        directory = UserDirectory(miss_ttl=30)
+
+        results = await asyncio.gather(
+            *[directory.get("email", "user@email.com") for _ in range(5)],
+            return_exceptions=True
+        )
+        assert all(isinstance(result, KeycloakException) for result in results)
+        with pytest.raises(KeycloakException):
+            await directory.get("email", "User@Email.com")
+        query_mock.assert_called_once_with({"email": "user@email.com", "exact": True})
+
+        monotonic.return_value = 131.0
+        with pytest.raises(KeycloakException):
+            await directory.get("email", "user@email.com")
+        assert query_mock.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_prefetch_indexes_every_page(self, mocker):
+        """
+        Tests that the users listed, a page at a time, are found
+        by any of their keys without further requests, while
+        idpIds not listed are looked up, and then indexed too
+        """
+        users = [
+            {"id": "1", "email": "one@email.com", "username": "one"},
+            {"id": "2", "email": "two@email.com", "username": "two"},
+            {"id": "3", "email": "three@email.com", "username": "three"}
+        ]
+        query_mock = mocker.patch(
+            'helpers.keycloak_helper.query_users',
+            side_effect=[users[:2], users[2:], [users[1]]]
+        )
+        directory = UserDirectory(page_size=2)
+
+        await directory.prefetch()
+        assert [call.args[0] for call in query_mock.call_args_list] == [
+            {"first": 0, "max": 2}, {"first": 2, "max": 2}
+        ]
+        assert await directory.get("email", "three@email.com") == users[2]
+        assert await directory.get("username", "one") == users[0]
+
+        assert await directory.get("idpId", "gh-2") == users[1]
+        assert await directory.get("idpId", "gh-2") == users[1]
+        assert query_mock.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_failed_prefetch_falls_back_to_lookups(self, mocker):
+        """
+        Tests that a failing bulk listing is retried on the next
+        start, rather than bringing the controller down
+        """
+        mocker.patch('helpers.keycloak_helper.query_users', side_effect=httpx.ConnectError("refused"))
+        directory = UserDirectory()
+
+        await directory.prefetch()
+
+        assert len(directory) == 0
+        assert not directory._prefetched
+
+    @pytest.mark.asyncio
+    async def test_expired_entries_are_pruned(self, mocker):
+        """
+        Tests that users and misses past their expiry are dropped
+        from the index, once another user is looked up
+        """
+        monotonic = mocker.patch('helpers.keycloak_helper.time.monotonic', return_value=100.0)
+        mocker.patch(
+            'helpers.keycloak_helper.query_users',
+            side_effect=[[{"id": "1", "email": "one@email.com"}], [], []]
+        )
+        directory = UserDirectory(ttl=300, miss_ttl=30)
+        await directory.get("email", "one@email.com")
+        with pytest.raises(KeycloakException):
+            await directory.get("email", "missing@email.com")
+        assert len(directory) == 3
+
+        monotonic.return_value = 131.0
+        with pytest.raises(KeycloakException):
+            await directory.get("idpId", "other")
+        assert len(directory) == 3
+        assert ("email", "missing@email.com") not in directory._entries
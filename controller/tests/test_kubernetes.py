@@ -1,9 +1,16 @@
+import asyncio
 import pytest
+import threading
+from datetime import datetime, timedelta, timezone
+from math import exp
+from kubernetes import client
 from kubernetes.client.exceptions import ApiException
 from unittest import mock
 from models.crd import MAX_RETRIES
 from controller import start
 from exceptions import KubernetesException
+from helpers.kubernetes_helper import AnnotationWriter, AsyncKubernetesV1, KubernetesCRD, KubernetesV1Batch
+from helpers.retry_scheduler import RetryScheduler, retry_scheduler
 
 
 class TestKubernetesHelper:
@@ -26,10 +33,10 @@ class TestKubernetesHelper:
         k8s_client["patch_cluster_custom_object_mock"].assert_called()
 
     @pytest.mark.asyncio
-    @mock.patch('controller.create_retry_job')
+    @mock.patch('controller.schedule_retry')
     async def test_job_pv_creation_fails(
         self,
-        create_bare_job_mock,
+        schedule_retry_mock,
         k8s_client,
         k8s_watch_mock,
         job_spec_mock,
@@ -47,10 +54,10 @@ class TestKubernetesHelper:
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
 
     @pytest.mark.asyncio
-    @mock.patch('controller.create_retry_job')
+    @mock.patch('controller.schedule_retry')
     async def test_job_creation_fails(
         self,
-        create_bare_job_mock,
+        schedule_retry_mock,
         k8s_client,
         k8s_watch_mock,
         mock_job_watch,
@@ -67,42 +74,36 @@ class TestKubernetesHelper:
 
     @pytest.mark.asyncio
     @mock.patch('controller.sync_users')
-    @mock.patch('helpers.actions.KubernetesV1Batch.create_bare_job')
-    async def test_on_crd_exceptions_create_retry_job(
+    @mock.patch('models.crd.random.uniform', return_value=1)
+    async def test_on_crd_exceptions_schedule_retry(
             self,
-            create_bare_job_mock,
+            uniform_mock,
             sync_mock,
             k8s_client,
             k8s_watch_mock,
             mock_job_watch,
+            domain
         ):
         """
         When an exception occurs during the CRD lifecycle
         it should be put back in a retry queue with an
-        exponential cooldown
+        exponential cooldown, recorded on the CRD
         """
         crd_name = k8s_watch_mock.return_value.stream.return_value[0]["object"]["metadata"]["name"]
         sync_mock.side_effect=KubernetesException('Error')
         await start(True)
-        create_bare_job_mock.assert_called_with(
-            **{
-                "name": f"update-annotation-{crd_name}",
-                "command": "sleep 2 && " \
-                    f"kubectl annotate --overwrite analytics {crd_name} tasks.federatednode.com/tries=1",
-                "run": True,
-                "labels": {
-                    "cooldown": "2s",
-                    "crd": crd_name
-                },
-                "image": "alpine/k8s:1.29.4"}
-        )
+
+        k8s_client["create_namespaced_job_mock"].assert_not_called()
+        assert crd_name in retry_scheduler
+        annotations = k8s_client["patch_cluster_custom_object_mock"].call_args.args[4]["metadata"]["annotations"]
+        assert annotations[f"{domain}/tries"] == "1"
+        cooldown = datetime.fromisoformat(annotations[f"{domain}/retry_at"]) - datetime.now(timezone.utc)
+        assert 2 < cooldown.total_seconds() <= exp(1)
 
     @pytest.mark.asyncio
     @mock.patch('controller.sync_users')
-    @mock.patch('helpers.actions.KubernetesV1Batch.create_bare_job')
-    async def test_on_crd_exceptions_doesnt_create_retry_job_if_another_is_running(
+    async def test_on_crd_exceptions_doesnt_schedule_retry_if_another_is_pending(
             self,
-            create_bare_job_mock,
             sync_mock,
             k8s_client,
             k8s_watch_mock,
@@ -112,20 +113,20 @@ class TestKubernetesHelper:
         When an exception occurs during the CRD lifecycle
         it should be put back in a retry queue with an
         exponential cooldown. This should not be done, if another
-        update annotation job is in progress for the same CRD
+        retry is already pending for the same CRD
         """
+        crd_name = k8s_watch_mock.return_value.stream.return_value[0]["object"]["metadata"]["name"]
         sync_mock.side_effect=KubernetesException('Error')
-        k8s_client["list_namespaced_pod"].return_value.items = [mock.Mock()]
+        retry_scheduler.schedule(crd_name, 60)
         await start(True)
 
-        create_bare_job_mock.assert_not_called()
+        sync_mock.assert_not_called()
+        k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
 
     @pytest.mark.asyncio
     @mock.patch('controller.sync_users')
-    @mock.patch('helpers.actions.KubernetesV1Batch.create_bare_job')
-    async def test_on_crd_exceptions_create_retry_job_max_retries(
+    async def test_on_crd_exceptions_schedule_retry_max_retries(
             self,
-            create_bare_job_mock,
             sync_mock,
             k8s_client,
             k8s_watch_mock,
@@ -139,7 +140,184 @@ class TestKubernetesHelper:
         """
         k8s_watch_mock.return_value.stream.return_value[0]\
             ["object"]["metadata"]["annotations"] \
-                ["tasks.federatednode.com/tries"] = MAX_RETRIES + 1
+                ["tasks.federatednode.com/tries"] = MAX_RETRIES
+        sync_mock.side_effect=KubernetesException('Error')
+
+        await start(True)
+        k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
+        assert len(retry_scheduler) == 0
 
+    @pytest.mark.asyncio
+    @mock.patch('controller.sync_users')
+    async def test_persisted_retry_is_resumed(
+            self,
+            sync_mock,
+            k8s_client,
+            k8s_watch_mock,
+            domain
+        ):
+        """
+        A CRD with a retry still due, e.g. after the controller
+        restarted, waits for it rather than being reconciled straight away
+        """
+        crd = k8s_watch_mock.return_value.stream.return_value[0]["object"]
+        crd["metadata"]["annotations"][f"{domain}/retry_at"] = (
+            datetime.now(timezone.utc) + timedelta(seconds=30)
+        ).isoformat()
         await start(True)
-        create_bare_job_mock.assert_not_called()
+
+        sync_mock.assert_not_called()
+        assert crd["metadata"]["name"] in retry_scheduler
+
+
+class TestSharedApiClient:
+    def test_clients_share_one_api_client(self, k8s_config):
+        """
+        Tests that the configuration is loaded once, and every
+        client reuses the same ApiClient and connection pool
+        """
+        clients = [KubernetesCRD(), KubernetesV1Batch(), KubernetesCRD()]
+
+        k8s_config.assert_called_once()
+        assert len({id(k8s.api_client) for k8s in clients}) == 1
+
+    def test_annotation_patch_leaves_shared_headers_alone(self, k8s_client):
+        """
+        Tests that the merge-patch content type is sent with the patch
+        request only, not set on the ApiClient other clients use
+        """
+        crd_client = KubernetesCRD()
+        crd_client.patch_crd_annotations("crd1", {"key": "value"})
+
+        assert "Content-Type" not in crd_client.api_client.default_headers
+        assert k8s_client["patch_cluster_custom_object_mock"].call_args.kwargs == {
+            "_content_type": "application/merge-patch+json"
+        }
+
+
+class TestAnnotationWriter:
+    @pytest.mark.asyncio
+    async def test_changes_are_coalesced(self, k8s_client, crd_object_mock, domain):
+        """
+        Tests that changes made within the window go out as a single
+        merge patch, with only the changed or removed keys
+        """
+        patch_mock = k8s_client["patch_cluster_custom_object_mock"]
+        crd_object_mock.annotations = {f"{domain}/user": "ok", f"{domain}/tries": "1"}
+        writer = AnnotationWriter(window=0.01)
+
+        results = await asyncio.gather(
+            writer.write(crd_object_mock, {f"{domain}/user": "ok", f"{domain}/done": "true"}),
+            writer.write(crd_object_mock, {
+                f"{domain}/user": "ok", f"{domain}/tries": "1", f"{domain}/task_id": "1"
+            })
+        )
+
+        patch_mock.assert_called_once()
+        assert patch_mock.call_args.args[4] == {"metadata": {"annotations": {
+            f"{domain}/done": "true", f"{domain}/tries": None, f"{domain}/task_id": "1"
+        }}}
+        assert results[0] is results[1]
+        assert crd_object_mock.name not in writer
+
+    @pytest.mark.asyncio
+    async def test_conflicts_are_retried(self, k8s_client, crd_object_mock, domain):
+        """
+        Tests that a conflicting patch is sent again, while
+        other errors are handed to the caller
+        """
+        patch_mock = k8s_client["patch_cluster_custom_object_mock"]
+        patch_mock.side_effect = [ApiException(status=409), {"metadata": {}}]
+        writer = AnnotationWriter(window=0)
+
+        assert await writer.write(crd_object_mock, {f"{domain}/user": "ok"}) == {"metadata": {}}
+        assert patch_mock.call_count == 2
+
+        patch_mock.side_effect = ApiException(status=422)
+        with pytest.raises(ApiException):
+            await writer.write(crd_object_mock, {f"{domain}/user": "ok"})
+
+
+class TestAsyncClients:
+    @pytest.mark.asyncio
+    async def test_calls_run_off_the_event_loop(self, mocker):
+        """
+        Tests that the awaitable clients forward the call, with its
+        arguments, to the sync client on a worker thread
+        """
+        loop_thread = threading.get_ident()
+        called_from = []
+
+        def get_secret(*args, **kwargs):
+            called_from.append(threading.get_ident())
+            return {"args": args, "kwargs": kwargs}
+        mocker.patch('helpers.kubernetes_helper.KubernetesV1.get_secret', side_effect=get_secret)
+
+        result = await AsyncKubernetesV1().get_secret("secret", "key", namespace="ns")
+
+        assert result == {"args": ("secret", "key"), "kwargs": {"namespace": "ns"}}
+        assert called_from and called_from[0] != loop_thread
+
+
+class TestRetryScheduler:
+    @pytest.mark.asyncio
+    async def test_retry_fires_after_delay(self):
+        """
+        Tests that a scheduled name is handed back once its delay is over
+        """
+        fired = []
+
+        async def submit(name):
+            fired.append(name)
+
+        scheduler = RetryScheduler()
+        scheduler.attach(submit)
+        scheduler.schedule("crd1", 0.05)
+        await asyncio.sleep(0.01)
+        assert fired == []
+
+        await asyncio.sleep(0.1)
+        assert fired == ["crd1"]
+        assert "crd1" not in scheduler
+
+    @pytest.mark.asyncio
+    async def test_pending_retries_survive_detach(self):
+        """
+        Tests that retries scheduled before the watch restarts
+        are re-armed when the scheduler is attached again
+        """
+        fired = []
+
+        async def submit(name):
+            fired.append(name)
+
+        scheduler = RetryScheduler()
+        scheduler.attach(submit)
+        scheduler.schedule("crd1", 0.05)
+        scheduler.detach()
+        await asyncio.sleep(0.1)
+        assert fired == []
+
+        scheduler.attach(submit)
+        await asyncio.sleep(0.01)
+        assert fired == ["crd1"]
+
+    @pytest.mark.asyncio
+    async def test_schedule_from_another_thread(self):
+        """
+        Tests that a name scheduled from an informer thread
+        is handed back on the loop the scheduler is attached to
+        """
+        fired = []
+
+        async def submit(name):
+            fired.append(name)
+
+        scheduler = RetryScheduler()
+        scheduler.attach(submit)
+        thread = threading.Thread(target=scheduler.schedule, args=("crd1", 0))
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0.01)
+
+        assert fired == ["crd1"]
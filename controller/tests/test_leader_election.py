@@ -0,0 +1,170 @@
+import asyncio
+import pytest
+from datetime import datetime, timezone
+from unittest import mock
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+
+from controller import follow_ownership, reconcile, start
+from helpers.leader_election import LeaderElector
+from helpers.workers import WorkerPool
+from models.crd import Analytics
+
+
+def lease(holder:str, version:str="1"):
+    now = datetime.now(timezone.utc)
+    return client.V1Lease(
+        metadata=client.V1ObjectMeta(name="fn-task-controller", resource_version=version),
+        spec=client.V1LeaseSpec(
+            holder_identity=holder,
+            lease_duration_seconds=15,
+            acquire_time=now,
+            renew_time=now,
+            lease_transitions=0
+        )
+    )
+
+
+@pytest.fixture
+def lease_api(mocker):
+    return {
+        "read": mocker.patch('helpers.kubernetes_helper.KubernetesCoordination.read_namespaced_lease'),
+        "create": mocker.patch(
+            'helpers.kubernetes_helper.KubernetesCoordination.create_namespaced_lease',
+            side_effect=lambda namespace, body: body
+        ),
+        "replace": mocker.patch(
+            'helpers.kubernetes_helper.KubernetesCoordination.replace_namespaced_lease',
+            side_effect=lambda name, namespace, body: body
+        )
+    }
+
+
+class TestLeaderElection:
+    def elector(self, **kwargs) -> LeaderElector:
+        return LeaderElector(identity="replica-1", enabled=True, **kwargs)
+
+    def test_creates_missing_lease(self, lease_api):
+        """
+        Tests that the first replica creates the Lease and holds it
+        """
+        lease_api["read"].side_effect = ApiException(status=404)
+        assert self.elector().try_acquire_or_renew()
+
+        body = lease_api["create"].call_args.args[1]
+        assert body.spec.holder_identity == "replica-1"
+
+    def test_renews_own_lease(self, lease_api):
+        """
+        Tests that the holder renews the Lease without a new transition
+        """
+        lease_api["read"].return_value = lease("replica-1")
+        assert self.elector().try_acquire_or_renew()
+
+        body = lease_api["replace"].call_args.args[2]
+        assert body.spec.lease_transitions == 0
+
+    def test_standby_waits_for_lease_expiry(self, lease_api, mocker):
+        """
+        Tests that a Lease held by someone else is only taken over
+        when it hasn't changed for its whole duration
+        """
+        monotonic = mocker.patch('helpers.leader_election.time.monotonic', return_value=100.0)
+        lease_api["read"].side_effect = lambda *args: lease("replica-0")
+        elector = self.elector()
+
+        assert not elector.try_acquire_or_renew()
+        lease_api["replace"].assert_not_called()
+
+        monotonic.return_value = 116.0
+        assert elector.try_acquire_or_renew()
+        body = lease_api["replace"].call_args.args[2]
+        assert body.spec.holder_identity == "replica-1"
+        assert body.spec.lease_transitions == 1
+
+    def test_lost_race_is_not_leader(self, lease_api):
+        """
+        Tests that if another replica updated the Lease first,
+        this one doesn't consider itself the leader
+        """
+        lease_api["read"].return_value = lease("replica-1")
+        lease_api["replace"].side_effect = ApiException(status=409)
+        assert not self.elector().try_acquire_or_renew()
+
+    def test_disabled_is_always_leader(self):
+        """
+        Tests that with leader election off, the only replica reconciles
+        """
+        assert LeaderElector(enabled=False).is_leader
+
+
+class TestStandby:
+    @pytest.mark.asyncio
+    @mock.patch('controller.sync_users')
+    async def test_standby_only_fills_the_cache(
+            self,
+            sync_mock,
+            k8s_client,
+            k8s_watch_mock,
+            informers,
+            mocker
+        ):
+        """
+        Tests that a replica not holding the Lease keeps
+        its cache warm, but doesn't reconcile
+        """
+        mocker.patch(
+            'controller.coordinator',
+            mock.Mock(owns=mock.Mock(return_value=False), version=0)
+        )
+        await start(True)
+
+        sync_mock.assert_not_called()
+        assert informers["analytics"].get("crd1")
+
+    @pytest.mark.asyncio
+    async def test_no_step_once_ownership_is_lost(
+            self,
+            crd_object_mock,
+            mocker
+        ):
+        """
+        Tests that a CRD queued while owned isn't reconciled
+        once another replica has taken it over
+        """
+        sync_mock = mocker.patch('controller.sync_users')
+        mocker.patch(
+            'controller.coordinator',
+            mock.Mock(owns=mock.Mock(return_value=False), version=0)
+        )
+
+        assert await reconcile(crd_object_mock) is None
+        sync_mock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_lost_leadership_drops_queued_crds(
+            self,
+            mock_crd,
+            informers,
+            mocker
+        ):
+        """
+        Tests that a replica losing the Lease drops what it had
+        queued, and doesn't pick anything up while it's a standby
+        """
+        elector = LeaderElector(enabled=True)
+        elector._leader.set()
+        mocker.patch('controller.coordinator', elector)
+        informers["analytics"].apply("ADDED", mock_crd["object"])
+        pool = WorkerPool(mock.AsyncMock())
+        await pool.submit("test_task", Analytics(mock_crd))
+
+        ownership = asyncio.create_task(follow_ownership(pool))
+        await asyncio.sleep(0)
+        elector._leader.clear()
+        elector.version += 1
+        await asyncio.sleep(1.1)
+        ownership.cancel()
+
+        assert "test_task" not in pool.queue
+        pool.handler.assert_not_called()
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+import pytest
+
+from helpers.request_helper import SharedClient, new_client
+
+
+class TestSharedClient:
+    @pytest.mark.asyncio
+    async def test_client_is_reused_on_the_same_loop(self):
+        """
+        Tests that the same client, and so its connection pool, is handed
+        out on one event loop, while another loop gets its own
+        """
+        shared = SharedClient()
+        client = shared.get()
+        assert shared.get() is client
+
+        other_loop = []
+        thread = threading.Thread(target=lambda: other_loop.append(asyncio.run(self.get(shared))))
+        thread.start()
+        thread.join()
+        assert other_loop[0] is not client
+
+    @pytest.mark.asyncio
+    async def test_closed_client_is_replaced(self):
+        """
+        Tests that closing the client, i.e. when the controller
+        stops, makes the next caller get a new one
+        """
+        shared = SharedClient()
+        client = shared.get()
+
+        await shared.aclose()
+
+        assert client.is_closed
+        assert shared.get() is not client
+
+    @pytest.mark.asyncio
+    async def test_http2_needs_h2(self, mocker):
+        """
+        Tests that HTTP/2 falls back to HTTP/1.1 rather
+        than failing, if the h2 package is missing
+        """
+        mocker.patch('helpers.request_helper.HTTP2', True)
+        mocker.patch('helpers.request_helper.importlib.util.find_spec', return_value=None)
+
+        async with new_client() as client:
+            assert not client._transport._pool._http2
+
+    @staticmethod
+    async def get(shared:SharedClient):
+        return shared.get()
@@ -0,0 +1,140 @@
+import pytest
+import signal
+from unittest import mock
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+
+from controller import shutdown
+from helpers.sharding import ShardCoordinator, ShardRing
+
+
+def member_lease(identity:str, version:str):
+    return client.V1Lease(
+        metadata=client.V1ObjectMeta(name=f"fn-task-controller-{identity}", resource_version=version),
+        spec=client.V1LeaseSpec(holder_identity=identity, lease_duration_seconds=15)
+    )
+
+
+class TestShardRing:
+    names = [f"crd-{n}" for n in range(1000)]
+
+    def test_keys_are_spread_across_members(self):
+        """
+        Tests that every member gets a fair share of the CRDs
+        """
+        ring = ShardRing(["replica-1", "replica-2", "replica-3"])
+        owners = [ring.owner(name) for name in self.names]
+        for member in ring.members:
+            assert 200 < owners.count(member) < 500
+
+    def test_new_member_only_takes_its_share(self):
+        """
+        Tests that adding a replica only moves CRDs to it,
+        and none between the existing ones
+        """
+        before = ShardRing(["replica-1", "replica-2"])
+        after = ShardRing(["replica-1", "replica-2", "replica-3"])
+        moved = [name for name in self.names if before.owner(name) != after.owner(name)]
+
+        assert moved
+        assert all(after.owner(name) == "replica-3" for name in moved)
+
+    def test_empty_ring(self):
+        assert ShardRing([]).owner("crd-1") is None
+
+
+class TestShardCoordinator:
+    def coordinator(self) -> ShardCoordinator:
+        return ShardCoordinator(identity="replica-1", enabled=True, retry_period=2)
+
+    def test_disabled_owns_everything(self):
+        """
+        Tests that without sharding the replica reconciles every CRD
+        """
+        assert ShardCoordinator(enabled=False).owns("crd-1")
+
+    @mock.patch('helpers.sharding.time.monotonic')
+    def test_ownership_settles_before_pick_up(self, monotonic):
+        """
+        Tests that CRDs are only picked up once the membership is stable,
+        but given up as soon as a new member shows up
+        """
+        monotonic.return_value = 100.0
+        coordinator = self.coordinator()
+        coordinator.update_ring(["replica-1"])
+        assert not coordinator.owns("crd-1")
+
+        monotonic.return_value = 104.0
+        coordinator.update_ring(["replica-1"])
+        assert coordinator.owns("crd-1")
+
+        moved = [
+            name for name in TestShardRing.names
+            if ShardRing(["replica-1", "replica-2"]).owner(name) == "replica-2"
+        ]
+        monotonic.return_value = 106.0
+        coordinator.update_ring(["replica-1", "replica-2"])
+        assert not any(coordinator.owns(name) for name in moved)
+        assert coordinator.version == 3
+
+    @mock.patch('helpers.sharding.time.monotonic')
+    @mock.patch('helpers.kubernetes_helper.KubernetesCoordination.list_namespaced_lease')
+    def test_stale_members_are_dropped(self, list_mock, monotonic):
+        """
+        Tests that a replica whose Lease stopped changing for
+        its whole duration is no longer a member
+        """
+        coordinator = self.coordinator()
+        monotonic.return_value = 100.0
+        list_mock.return_value = client.V1LeaseList(items=[
+            member_lease("replica-1", "1"), member_lease("replica-2", "1")
+        ])
+        assert coordinator.live_members() == ["replica-1", "replica-2"]
+
+        monotonic.return_value = 116.0
+        list_mock.return_value = client.V1LeaseList(items=[
+            member_lease("replica-1", "2"), member_lease("replica-2", "1")
+        ])
+        assert coordinator.live_members() == ["replica-1"]
+
+    @mock.patch('helpers.sharding.time.monotonic')
+    @mock.patch('helpers.kubernetes_helper.KubernetesCoordination.delete_namespaced_lease')
+    @mock.patch('helpers.kubernetes_helper.KubernetesCoordination.list_namespaced_lease')
+    def test_long_expired_leases_are_deleted(self, list_mock, delete_mock, monotonic):
+        """
+        Tests that the Lease of a replica gone for a while is deleted,
+        only if still at the version seen expiring
+        """
+        coordinator = self.coordinator()
+        list_mock.return_value = client.V1LeaseList(items=[
+            member_lease("replica-1", "1"), member_lease("replica-2", "1")
+        ])
+        monotonic.return_value = 100.0
+        coordinator.live_members()
+        monotonic.return_value = 130.0
+        coordinator.live_members()
+        delete_mock.assert_not_called()
+
+        delete_mock.side_effect = ApiException(status=409)
+        monotonic.return_value = 161.0
+        assert coordinator.live_members() == ["replica-1"]
+
+        delete_mock.assert_called_once()
+        assert delete_mock.call_args.args[0] == "fn-task-controller-replica-2"
+        assert delete_mock.call_args.kwargs["body"].preconditions.resource_version == "1"
+
+    @mock.patch('helpers.kubernetes_helper.KubernetesCoordination.delete_namespaced_lease')
+    def test_lease_released_on_sigterm(self, delete_mock, mocker):
+        """
+        Tests that a terminated replica gives up its Lease,
+        and stops its informers
+        """
+        coordinator = self.coordinator()
+        mocker.patch('controller.coordinator', coordinator)
+        stop_mock = mocker.patch('controller.stop_informers')
+
+        with pytest.raises(SystemExit):
+            shutdown(signal.SIGTERM, None)
+
+        delete_mock.assert_called_once_with("fn-task-controller-replica-1", coordinator.namespace)
+        stop_mock.assert_called_once()
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import threading
+import pytest
+from contextlib import aclosing
+from unittest.mock import Mock
+from urllib3.exceptions import ProtocolError
+
+from helpers.watch_helper import (
+    RawWatch, ResumePoint, SelfWrites, lean_decoder, list_and_watch, stream_events
+)
+
+
+class TestStreamEvents:
+    @pytest.mark.asyncio
+    async def test_events_are_streamed_in_order(self):
+        """
+        Events produced by the blocking watch are yielded as they are
+        """
+        watcher = Mock(stream=Mock(return_value=[{"type": "ADDED", "n": n} for n in range(5)]))
+        received = [event["n"] async for event in stream_events(watcher, Mock())]
+
+        assert received == list(range(5))
+
+    @pytest.mark.asyncio
+    async def test_slow_consumer_blocks_the_stream(self):
+        """
+        With a full queue the watch thread waits for the consumer
+        instead of buffering everything
+        """
+        produced = []
+        all_produced = threading.Event()
+
+        def stream(*args, **kwargs):
+            for n in range(10):
+                produced.append(n)
+                yield {"n": n}
+            all_produced.set()
+
+        watcher = Mock(stream=Mock(side_effect=stream))
+        async with aclosing(stream_events(watcher, Mock(), max_pending=2)) as events:
+            first = await anext(events)
+            await asyncio.sleep(0.2)
+            # one consumed, two in the queue and one waiting to be put
+            assert first["n"] == 0
+            assert len(produced) <= 4
+            assert not all_produced.is_set()
+        watcher.stop.assert_called()
+
+    @pytest.mark.asyncio
+    async def test_stream_errors_are_raised(self):
+        """
+        Exceptions raised on the watch thread are raised to the consumer
+        """
+        def stream(*args, **kwargs):
+            yield {"n": 0}
+            raise ProtocolError("Connection broken")
+
+        watcher = Mock(stream=Mock(side_effect=stream))
+        with pytest.raises(ProtocolError):
+            async for _ in stream_events(watcher, Mock()):
+                pass
+
+
+class TestListAndWatch:
+    @pytest.mark.asyncio
+    async def test_interrupted_list_starts_over(self):
+        """
+        Tests that a list failing halfway doesn't leave a
+        resourceVersion to resume from, nor starts the watch
+        """
+        resume_point = ResumePoint()
+        watcher = Mock()
+        func = Mock(side_effect=[
+            {"items": [{"metadata": {"name": "crd1", "resourceVersion": "3"}}],
+             "metadata": {"continue": "next", "resourceVersion": "5"}},
+            ProtocolError("Connection broken")
+        ])
+
+        received = []
+        with pytest.raises(ProtocolError):
+            async with aclosing(list_and_watch(watcher, resume_point, func, page_size=1)) as events:
+                async for event in events:
+                    received.append(event["object"]["metadata"]["name"])
+
+        assert received == ["crd1"]
+        assert resume_point.version is None
+        watcher.stream.assert_not_called()
+
+
+class TestRawWatch:
+    def test_events_are_not_deserialized(self):
+        """
+        Tests that the raw watch hands over the decoded JSON,
+        and keeps track of its resourceVersion
+        """
+        watcher = RawWatch()
+        event = watcher.unmarshal_event(json.dumps({
+            "type": "MODIFIED",
+            "object": {"metadata": {"name": "pod1", "resourceVersion": "5"}, "status": {"phase": "Running"}}
+        }), "V1Pod")
+
+        assert event["object"]["status"]["phase"] == "Running"
+        assert watcher.resource_version == "5"
+
+    def test_lean_view_keeps_listed_fields(self):
+        """
+        Tests that only the listed fields are kept, readable
+        as snake_case attributes, and missing sections are empty
+        """
+        decode = lean_decoder({
+            "metadata": {"name": None, "labels": None},
+            "status": {"startTime": None, "uncountedTerminatedPods": {"succeeded": None}}
+        })
+        view = decode({
+            "metadata": {"name": "job1", "labels": {"crd": "crd1"}, "managedFields": [{}]},
+            "spec": {"template": {}},
+            "status": {"startTime": "2024-01-01T00:00:00Z"}
+        })
+
+        assert view.metadata.name == "job1"
+        assert view.metadata.labels == {"crd": "crd1"}
+        assert view.status.start_time == "2024-01-01T00:00:00Z"
+        assert view.status.uncounted_terminated_pods.succeeded is None
+        assert not hasattr(view, "spec")
+        assert not hasattr(view.metadata, "managed_fields")
+
+
+class TestSelfWrites:
+    def event(self, annotations:dict, version:str="2", generation:int=1):
+        return {"type": "MODIFIED", "object": {"metadata": {
+            "name": "crd1", "annotations": annotations,
+            "resourceVersion": version, "generation": generation
+        }}}
+
+    def test_echo_of_a_write_is_own(self):
+        """
+        Tests that the event caused by a write is recognised, either by
+        its resourceVersion or, before the answer is back, by its annotations
+        """
+        writes = SelfWrites()
+        writes.expect("crd1", {"user": "ok"})
+        assert writes.is_own(self.event({"user": "ok"}, version="7"))
+
+        writes.record("crd1", self.event({"user": "ok"}, version="7")["object"])
+        writes.expect("crd1", {"user": "ok", "done": "true"})
+        assert writes.is_own(self.event({"user": "ok"}, version="7"))
+
+    def test_changed_values_get_through(self):
+        """
+        Tests that values changed or removed by someone else after a
+        write, like a reviewer approving the results, are not dropped
+        """
+        writes = SelfWrites()
+        writes.expect("crd1", {"user": "ok", "done": "true", "approved": "false"})
+        writes.record("crd1", self.event({"user": "ok"}, version="3")["object"])
+
+        assert writes.is_own(self.event({"user": "ok", "done": "true", "approved": "false"}))
+        assert not writes.is_own(self.event({"user": "ok", "done": "true", "approved": "true"}))
+        assert not writes.is_own(self.event({"done": "true", "approved": "false"}))
+
+    def test_news_get_through(self):
+        """
+        Tests that annotations added by someone else, a spec change,
+        or an object never written to, are not dropped
+        """
+        writes = SelfWrites()
+        writes.expect("crd1", {"user": "ok"})
+        writes.record("crd1", self.event({"user": "ok"}, version="3")["object"])
+
+        assert not writes.is_own(self.event({"user": "ok", "approved": "true"}))
+        assert not writes.is_own(self.event({"user": "ok"}, generation=2))
+        writes.forget("crd1")
+        assert not writes.is_own(self.event({"user": "ok"}))
+
+    def test_failed_write_is_rolled_back(self):
+        """
+        Tests that annotations which didn't make it to the
+        API server are not expected anymore
+        """
+        writes = SelfWrites()
+        previous = writes.expect("crd1", {"user": "ok"})
+        writes.restore("crd1", previous)
+
+        assert not writes.is_own(self.event({}))
+
+    def test_size_is_bounded(self):
+        """
+        Tests that the least recently written objects are forgotten first
+        """
+        writes = SelfWrites(size=2)
+        for name in ["crd1", "crd2", "crd3"]:
+            writes.expect(name, {"user": "ok"})
+
+        assert len(writes) == 2
+        assert not writes.is_own(self.event({}))
@@ -1,11 +1,20 @@
+import asyncio
+from copy import deepcopy
 import httpx
 import pytest
+import threading
+from kubernetes import client
 from kubernetes.client.exceptions import ApiException
 from unittest import mock
 from unittest.mock import AsyncMock, mock_open
+from urllib3.exceptions import MaxRetryError, ProtocolError
 
-from controller import start
+from controller import crd_resume_point, reconcile, resync_once, start
+from helpers.kubernetes_helper import crd_writes, task_pods
+from helpers.retry_scheduler import retry_scheduler
+from helpers.workers import WorkerPool
 from exceptions import CRDException
+from models.crd import Analytics
 
 
 class TestWatcher:
@@ -36,11 +45,12 @@ class TestWatcher:
         await start(True)
         k8s_client["patch_cluster_custom_object_mock"].assert_called_with(
             'tasks.federatednode.com', 'v1', 'analytics', 'crd1',
-            [{'op': 'add', 'path': '/metadata/annotations', 'value':
+            {"metadata": {"annotations":
                 {
                     f"{domain}/user": "ok"
                 }
-            }]
+            }},
+            _content_type='application/merge-patch+json'
         )
 
     @pytest.mark.asyncio
@@ -61,11 +71,13 @@ class TestWatcher:
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
 
     @pytest.mark.asyncio
+    @mock.patch('controller.schedule_retry')
     async def test_sync_user_job_fails_run(
         self,
+        schedule_retry_mock,
         k8s_client,
         k8s_watch_mock,
-        mock_pod_watch
+        mock_job_watch
     ):
         """
         Tests the first step of the CRD lifecycle.
@@ -73,11 +85,37 @@ class TestWatcher:
         no annotation is added to the CRD,
         keeping it to the same status
         """
-        mock_pod_watch["watch"].return_value.stream.return_value = [{"object": mock.Mock(status=mock.Mock(failed=True))}]
+        mock_job_watch["status"] = client.V1JobStatus(failed=1)
 
         await start(True)
 
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
+        schedule_retry_mock.assert_called()
+
+    @pytest.mark.asyncio
+    async def test_sync_user_ignores_previous_jobs(
+        self,
+        k8s_client,
+        k8s_watch_mock,
+        mock_job_watch,
+        informers,
+        domain
+    ):
+        """
+        Tests that a failed sync job left over from a previous
+        attempt for the same CRD doesn't fail the new one
+        """
+        informers["jobs"].apply("ADDED", client.V1Job(
+            metadata=client.V1ObjectMeta(
+                name="link-user-old", namespace="fn-controller", labels={"crd": "crd1"}
+            ),
+            status=client.V1JobStatus(failed=1)
+        ))
+
+        await start(True)
+
+        annotations = k8s_client["patch_cluster_custom_object_mock"].call_args.args[4]["metadata"]["annotations"]
+        assert annotations == {f"{domain}/user": "ok"}
 
     @pytest.mark.asyncio
     async def test_post_task_successful(
@@ -108,20 +146,22 @@ class TestWatcher:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_called_with(
             'tasks.federatednode.com', 'v1', 'analytics', crd_name,
-            [{'op': 'add', 'path': '/metadata/annotations', 'value':
+            {"metadata": {"annotations":
                 {
-                    f"{domain}/user": "ok",
                     f"{domain}/done": "true",
                     f"{domain}/task_id": "1"
                 }
-            }]
+            }},
+            _content_type='application/merge-patch+json'
         )
 
     @pytest.mark.asyncio
+    @mock.patch('controller.schedule_retry')
     @mock.patch('helpers.actions.get_user_token', return_value="token")
     async def test_post_task_fails(
             self,
             token_mock,
+            schedule_retry_mock,
             mock_crd_user_synched,
             crd_name,
             k8s_client,
@@ -236,17 +276,20 @@ class TestWatcher:
         k8s_client["create_namespaced_job_mock"].assert_called()
 
     @pytest.mark.asyncio
+    @mock.patch('controller.schedule_retry')
     @mock.patch("builtins.open", new_callable=mock_open, read_data="data")
     @mock.patch('helpers.actions.get_user_token', return_value="token")
     async def test_get_results_task_fails(
             self,
             token_mock,
             open_mock,
+            schedule_retry_mock,
             k8s_client,
             k8s_watch_mock,
             crd_name,
             mock_crd_task_done,
             mock_pod_watch,
+            task_pod,
             backend_url,
             domain
         ):
@@ -254,7 +297,7 @@ class TestWatcher:
         Tests that once the task's pod is completed,
         a new github job pusher is created
         """
-        mock_pod_watch["watch"].return_value.stream.return_value = [{"object": mock.Mock(status=mock.Mock(phase="Failed"))}]
+        mock_pod_watch["cache"].replace([task_pod("Failed")])
         mock_crd_task_done['object']['metadata']['annotations']\
                 [f"{domain}/approved"] = "true"
         k8s_watch_mock.return_value.stream.return_value = [mock_crd_task_done]
@@ -262,6 +305,38 @@ class TestWatcher:
 
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
 
+    @pytest.mark.asyncio
+    @mock.patch('helpers.actions.get_user_token', return_value="token")
+    async def test_get_results_pod_completes_later(
+            self,
+            token_mock,
+            k8s_client,
+            k8s_watch_mock,
+            mock_crd_task_done,
+            mock_pod_watch,
+            task_pod,
+            informers
+        ):
+        """
+        Tests that a task pod still running when the CRD is reconciled
+        isn't waited on, and its completion, dispatched by the shared
+        watch, queues the CRD again
+        """
+        informers["task_pods"].replace([task_pod("Running")])
+        k8s_watch_mock.return_value.stream.return_value = [mock_crd_task_done]
+        await start(True)
+
+        k8s_client["create_namespaced_job_mock"].assert_not_called()
+        assert "test_task" not in retry_scheduler
+
+        informers["task_pods"].apply("MODIFIED", task_pod("Running"))
+        await asyncio.sleep(0)
+        assert "test_task" not in retry_scheduler
+
+        informers["task_pods"].apply("MODIFIED", task_pod("Succeeded"))
+        await asyncio.sleep(0)
+        assert "test_task" in retry_scheduler
+
     @pytest.mark.asyncio
     async def test_get_results_blocked(
             self,
@@ -297,9 +372,9 @@ class TestWatcher:
         """
         calls_to_assert =[
             k8s_client["patch_cluster_custom_object_mock"],
-            mocker.patch('helpers.actions.KubernetesV1Batch.create_helper_job'),
+            mocker.patch('helpers.kubernetes_helper.KubernetesV1Batch.create_helper_job'),
             mocker.patch('helpers.actions.create_fn_task'),
-            mocker.patch("helpers.actions.watch_task_pod", new_callable=AsyncMock)
+            mocker.patch("helpers.actions.deliver_results", new_callable=AsyncMock)
         ]
         k8s_watch_mock.return_value.stream.return_value = [mock_crd_done]
         await start(True)
@@ -319,9 +394,9 @@ class TestWatcher:
         """
         calls_to_assert =[
             k8s_client["patch_cluster_custom_object_mock"],
-            mocker.patch('helpers.actions.KubernetesV1Batch.create_helper_job'),
+            mocker.patch('helpers.kubernetes_helper.KubernetesV1Batch.create_helper_job'),
             mocker.patch('helpers.actions.create_fn_task'),
-            mocker.patch("helpers.actions.watch_task_pod", new_callable=AsyncMock)
+            mocker.patch("helpers.actions.deliver_results", new_callable=AsyncMock)
         ]
         mock_crd_done["type"] = "DELETED"
         k8s_watch_mock.return_value.stream.return_value = [mock_crd_done]
@@ -343,9 +418,9 @@ class TestWatcher:
         k8s_watch_mock.return_value.stream.return_value[0]["object"]["spec"].pop("user")
         calls_to_assert =[
             k8s_client["patch_cluster_custom_object_mock"],
-            mocker.patch('helpers.actions.KubernetesV1Batch.create_helper_job'),
+            mocker.patch('helpers.kubernetes_helper.KubernetesV1Batch.create_helper_job'),
             mocker.patch('helpers.actions.create_fn_task'),
-            mocker.patch("helpers.actions.watch_task_pod", new_callable=AsyncMock)
+            mocker.patch("helpers.actions.deliver_results", new_callable=AsyncMock)
         ]
         with pytest.raises(CRDException):
             await start(True)
@@ -381,11 +456,11 @@ class TestWatcher:
     @pytest.mark.asyncio
     @mock.patch("builtins.open", new_callable=mock_open, read_data="data")
     @mock.patch('helpers.actions.get_user_token', return_value="token")
-    @mock.patch('controller.create_retry_job')
-    @mock.patch('helpers.pod_watcher.MAX_TIMEOUT', 1)
+    @mock.patch('controller.schedule_retry')
+    @mock.patch('helpers.pod_watcher.MAX_TIMEOUT', 0)
     async def test_watch_timeouts(
             self,
-            create_retry_job_mock,
+            schedule_retry_mock,
             token_mock,
             open_mock,
             k8s_client,
@@ -397,15 +472,321 @@ class TestWatcher:
         Tests that a CRD with an incorrect task_id (due to the pod manually deleted)
         raises an exception instead of hanging
         """
-        import time
-
-        def mock_stream(*args, **kwargs):
-            yield from []
-            time.sleep(kwargs.get('timeout_seconds', 1) + 0.5)
-
         k8s_watch_mock.return_value.stream.return_value = [mock_crd_task_done]
-        mock_pod_watch["watch"].return_value.stream.side_effect = mock_stream
+        mock_pod_watch["cache"].replace([])
         await start(True)
 
         k8s_client["patch_cluster_custom_object_mock"].assert_not_called()
-        create_retry_job_mock.assert_called()
+        schedule_retry_mock.assert_called()
+
+
+class TestFatalErrors:
+    @pytest.mark.asyncio
+    async def test_unreachable_urls_stop_the_controller(
+            self,
+            k8s_client,
+            k8s_watch_mock,
+            mocker
+        ):
+        """
+        Tests that an unreachable URL crashes the controller as soon
+        as it's hit, without waiting for the next event to come
+        """
+        mocker.patch("controller.sync_users", side_effect=MaxRetryError(None, "http://kc", "unreachable"))
+        event = k8s_watch_mock.return_value.stream.return_value[0]
+        release = threading.Event()
+
+        def stream(*args, **kwargs):
+            yield event
+            release.wait(5)
+
+        k8s_watch_mock.return_value.stream.side_effect = stream
+        try:
+            with pytest.raises(MaxRetryError):
+                await asyncio.wait_for(start(), 2)
+        finally:
+            release.set()
+
+
+class TestSelfWrites:
+    @pytest.mark.asyncio
+    async def test_own_patch_events_are_dropped(
+            self,
+            k8s_client,
+            k8s_watch_mock,
+            mock_crd_user_synched,
+            mocker,
+            domain
+        ):
+        """
+        Tests that the event caused by the controller's own
+        patch doesn't go through the lifecycle again
+        """
+        crd_writes.expect("test_task", {f"{domain}/user": "ok"})
+        trigger_mock = mocker.patch("controller.trigger_task")
+        k8s_watch_mock.return_value.stream.return_value = [mock_crd_user_synched]
+
+        await start(True)
+
+        trigger_mock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_step_is_followed_up(
+            self,
+            k8s_client,
+            mock_job_watch,
+            mock_crd,
+            domain
+        ):
+        """
+        Tests that a step saving its progress hands the CRD back,
+        as it stands after the patch, for the next step
+        """
+        follow_up = await reconcile(Analytics(mock_crd))
+
+        assert follow_up.annotations == {f"{domain}/user": "ok"}
+        assert follow_up.can_trigger_task()
+
+    @pytest.mark.asyncio
+    @mock.patch('controller.schedule_retry')
+    async def test_failed_step_is_not_followed_up(
+            self,
+            schedule_retry_mock,
+            k8s_client,
+            mock_job_watch,
+            mock_crd
+        ):
+        """
+        Tests that nothing is handed back when the step fails
+        """
+        mock_job_watch["status"] = client.V1JobStatus(failed=1)
+
+        assert await reconcile(Analytics(mock_crd)) is None
+
+
+class TestStatus:
+    @pytest.mark.asyncio
+    async def test_step_is_mirrored_on_status(
+            self,
+            k8s_client,
+            mock_job_watch,
+            mock_crd
+        ):
+        """
+        Tests that a saved step is written on the status
+        subresource, as conditions
+        """
+        await reconcile(Analytics(mock_crd))
+
+        status_mock = k8s_client["patch_cluster_custom_object_status_mock"]
+        status_mock.assert_called_once()
+        body = status_mock.call_args.args[4]
+        assert status_mock.call_args.kwargs["_content_type"] == 'application/merge-patch+json'
+        assert [(cond["type"], cond["status"]) for cond in body["status"]["conditions"]] == [
+            ("UserSynced", "True"), ("TaskTriggered", "False"), ("ResultsDelivered", "False")
+        ]
+
+    @pytest.mark.asyncio
+    async def test_status_only_events_are_skipped(
+            self,
+            k8s_client,
+            k8s_watch_mock,
+            mock_crd_user_synched,
+            informers,
+            mocker
+        ):
+        """
+        Tests that an event only changing the status, which doesn't
+        bump the generation, doesn't go through the lifecycle again
+        """
+        trigger_mock = mocker.patch("controller.trigger_task")
+        informers["analytics"].apply("ADDED", deepcopy(mock_crd_user_synched["object"]))
+        mock_crd_user_synched["type"] = "MODIFIED"
+        mock_crd_user_synched["object"]["status"] = {"observedGeneration": 0}
+        k8s_watch_mock.return_value.stream.return_value = [mock_crd_user_synched]
+
+        await start(True)
+
+        trigger_mock.assert_not_called()
+
+
+class TestResync:
+    @pytest.mark.asyncio
+    async def test_only_stale_crds_are_queued(
+            self,
+            mock_crd_user_synched,
+            informers,
+            domain
+        ):
+        """
+        Tests that the resync only queues the CRDs with a step to run
+        that the controller has lost track of
+        """
+        def cached(name:str, **annotations):
+            obj = deepcopy(mock_crd_user_synched["object"])
+            obj["metadata"]["name"] = name
+            obj["metadata"]["annotations"].update(
+                {f"{domain}/{key}": val for key, val in annotations.items()}
+            )
+            informers["analytics"].apply("ADDED", obj)
+
+        cached("stale")
+        cached("queued")
+        cached("retrying")
+        cached("running", done="true", task_id="7")
+        cached("pod-gone", done="true", task_id="9")
+        cached("finished", done="true", task_id="8", results="true")
+        pool = WorkerPool(AsyncMock())
+        await pool.submit("queued", None)
+        retry_scheduler.schedule("retrying", 60)
+        informers["task_pods"].apply("ADDED", client.V1Pod(
+            metadata=client.V1ObjectMeta(name="pod7", namespace="tasks", labels={"task_id": "7"}),
+            status=client.V1PodStatus(phase="Running")
+        ))
+        task_pods.notify("7", "running", lambda: None)
+        task_pods.notify("9", "pod-gone", lambda: None)
+
+        try:
+            assert await resync_once(pool) == 2
+        finally:
+            task_pods.cancel("7", "running")
+            task_pods.cancel("9", "pod-gone")
+
+        assert pool.queue.active("stale")
+        assert pool.queue.active("pod-gone")
+        assert len(pool.queue) == 3
+
+
+class TestResumableWatch:
+    @pytest.mark.asyncio
+    async def test_watch_requests_bookmarks(
+            self,
+            k8s_client,
+            k8s_watch_mock,
+            crd_list_mock,
+            mock_crd_done
+        ):
+        """
+        Tests that the first watch asks for bookmarks, and
+        starts from the list, as no resourceVersion is known
+        """
+        k8s_watch_mock.return_value.stream.return_value = [mock_crd_done]
+        await start(True)
+
+        crd_list_mock.assert_called_once()
+        kwargs = k8s_watch_mock.return_value.stream.call_args.kwargs
+        assert kwargs["allow_watch_bookmarks"] is True
+        assert kwargs["resource_version"] == "1"
+
+    @pytest.mark.asyncio
+    async def test_initial_list_is_paginated(
+            self,
+            k8s_client,
+            k8s_watch_mock,
+            crd_list_mock,
+            mock_crd_done,
+            informers
+        ):
+        """
+        Tests that the initial list follows the continue token,
+        and the watch starts from the last page's resourceVersion
+        """
+        first, second = deepcopy(mock_crd_done["object"]), deepcopy(mock_crd_done["object"])
+        second["metadata"]["name"] = "crd2"
+        crd_list_mock.side_effect = [
+            {"items": [first], "metadata": {"continue": "next", "resourceVersion": "5"}},
+            {"items": [second], "metadata": {"resourceVersion": "6"}}
+        ]
+        k8s_watch_mock.return_value.stream.return_value = []
+        await start(True)
+
+        assert [call.kwargs["_continue"] for call in crd_list_mock.call_args_list] == [None, "next"]
+        assert crd_list_mock.call_args.kwargs["limit"] == 500
+        assert {obj["metadata"]["name"] for obj in informers["analytics"].list()} == {"test_task", "crd2"}
+        assert k8s_watch_mock.return_value.stream.call_args.kwargs["resource_version"] == "6"
+        assert crd_resume_point.version == "6"
+
+    @pytest.mark.asyncio
+    async def test_watch_resumes_from_last_version(
+            self,
+            k8s_client,
+            k8s_watch_mock,
+            mock_crd_done
+        ):
+        """
+        Tests that after the stream drops, the next watch
+        starts from the last resourceVersion, bookmarks included
+        """
+        mock_crd_done["object"]["metadata"]["resourceVersion"] = "100"
+        bookmark = {
+            "type": "BOOKMARK",
+            "object": {"metadata": {"resourceVersion": "150"}}
+        }
+        k8s_watch_mock.return_value.stream.return_value = [mock_crd_done, bookmark]
+        await start(True)
+        assert crd_resume_point.version == "150"
+
+        await start(True)
+        kwargs = k8s_watch_mock.return_value.stream.call_args.kwargs
+        assert kwargs["resource_version"] == "150"
+
+    @pytest.mark.asyncio
+    async def test_queued_crds_are_seen_through_on_reconnect(
+            self,
+            k8s_client,
+            k8s_watch_mock,
+            mocker
+        ):
+        """
+        Tests that a dropped connection lets the reconciles already
+        queued complete, as the next watch resumes after their events
+        """
+        completed = []
+
+        async def slow_sync(crd, _annotations):
+            await asyncio.sleep(0.1)
+            completed.append(crd.name)
+
+        mocker.patch("controller.sync_users", side_effect=slow_sync)
+        event = k8s_watch_mock.return_value.stream.return_value[0]
+
+        def stream(*args, **kwargs):
+            yield event
+            raise ProtocolError("Connection broken")
+
+        k8s_watch_mock.return_value.stream.side_effect = stream
+        await start()
+
+        assert completed == ["crd1"]
+
+    @pytest.mark.asyncio
+    async def test_watch_relists_on_gone(
+            self,
+            k8s_client,
+            k8s_watch_mock
+        ):
+        """
+        Tests that an expired resourceVersion (410) is dropped, so the
+        next watch starts with a full list
+        """
+        crd_resume_point.version = "100"
+        k8s_watch_mock.return_value.stream.side_effect = ApiException(status=410)
+        await start(True)
+
+        assert crd_resume_point.version is None
+
+    @pytest.mark.asyncio
+    async def test_watch_other_api_errors_are_raised(
+            self,
+            k8s_client,
+            k8s_watch_mock
+        ):
+        """
+        Tests that API errors, other than 410, are not swallowed
+        """
+        crd_resume_point.version = "100"
+        k8s_watch_mock.return_value.stream.side_effect = ApiException(status=403)
+        with pytest.raises(ApiException):
+            await start(True)
+
+        assert crd_resume_point.version == "100"
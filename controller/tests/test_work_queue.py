@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+
+from helpers.work_queue import RateLimiter, WorkQueue
+
+
+class TestRateLimiter:
+    def test_per_key_backoff(self):
+        """
+        The first add of a key is immediate, the following ones
+        double the wait, up to the max, until the key is forgotten
+        """
+        limiter = RateLimiter(base_delay=1, max_delay=4, qps=0)
+        assert [limiter.when("crd1") for _ in range(5)] == [0, 1, 2, 4, 4]
+        assert limiter.when("crd2") == 0
+
+        limiter.forget("crd1")
+        assert limiter.when("crd1") == 0
+
+    def test_token_bucket(self):
+        """
+        Once the burst is used up, keys wait for the bucket to refill
+        """
+        limiter = RateLimiter(base_delay=1, max_delay=4, qps=10, burst=2)
+        assert limiter.when("crd1") == 0
+        assert limiter.when("crd2") == 0
+        assert limiter.when("crd3") == pytest.approx(0.1, abs=0.01)
+
+
+class TestWorkQueue:
+    @pytest.mark.asyncio
+    async def test_pending_duplicates_collapse(self):
+        """
+        Adding the same key again keeps a single entry with the latest item
+        """
+        queue = WorkQueue(RateLimiter(qps=0))
+        queue.add("crd1", "v1")
+        queue.add("crd2", "v1")
+        queue.add("crd1", "v2")
+
+        assert len(queue) == 2
+        assert await queue.get() == ("crd1", "v2")
+        assert await queue.get() == ("crd2", "v1")
+
+    @pytest.mark.asyncio
+    async def test_key_held_while_processing(self):
+        """
+        A key being processed is only queued again once it's done,
+        with its backoff increased
+        """
+        queue = WorkQueue(RateLimiter(base_delay=0.05, qps=0))
+        queue.add("crd1", "v1")
+        key, _ = await queue.get()
+        queue.add("crd1", "v2")
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.1)
+
+        await queue.done(key)
+        assert await asyncio.wait_for(queue.get(), 0.2) == ("crd1", "v2")
+        assert queue.limiter.requeues("crd1") == 2
+
+        await queue.done("crd1")
+        assert queue.limiter.requeues("crd1") == 0
+
+    @pytest.mark.asyncio
+    async def test_wait_idle(self):
+        """
+        wait_idle only returns after every key has been processed
+        """
+        queue = WorkQueue(RateLimiter(qps=0))
+        queue.add("crd1", "v1")
+        idle = asyncio.create_task(queue.wait_idle())
+        await asyncio.sleep(0)
+        assert not idle.done()
+
+        key, _ = await queue.get()
+        await asyncio.sleep(0)
+        assert not idle.done()
+
+        await queue.done(key)
+        await asyncio.wait_for(idle, 0.1)
+
+    @pytest.mark.asyncio
+    async def test_discard(self):
+        """
+        A discarded key is never handed out, the others still are
+        """
+        queue = WorkQueue(RateLimiter(qps=0))
+        queue.add("crd1", "v1")
+        queue.add("crd2", "v1")
+        await queue.discard("crd1")
+
+        assert "crd1" not in queue
+        assert await asyncio.wait_for(queue.get(), 0.1) == ("crd2", "v1")
+        await queue.done("crd2")
+        await asyncio.wait_for(queue.wait_idle(), 0.1)
@@ -0,0 +1,100 @@
+import asyncio
+import pytest
+
+from helpers.workers import WorkerPool
+
+
+class TestWorkerPool:
+    @pytest.mark.asyncio
+    async def test_same_crd_is_serialized(self):
+        """
+        Events for the same CRD are handled one at a time, and
+        the ones arriving meanwhile collapse into the latest
+        """
+        running = set()
+        handled = []
+
+        async def handler(item):
+            key, idx = item
+            assert key not in running
+            running.add(key)
+            await asyncio.sleep(0.01)
+            handled.append(item)
+            running.discard(key)
+
+        pool = WorkerPool(handler, size=4)
+        pool.start()
+        await pool.submit("crd1", ("crd1", 0))
+        await asyncio.sleep(0)
+        for idx in range(1, 4):
+            await pool.submit("crd1", ("crd1", idx))
+        await pool.join()
+        await pool.stop()
+
+        assert handled == [("crd1", 0), ("crd1", 3)]
+
+    @pytest.mark.asyncio
+    async def test_different_crds_run_in_parallel(self):
+        """
+        Different CRDs do not wait on each other
+        """
+        concurrent = 0
+        peak = 0
+
+        async def handler(_item):
+            nonlocal concurrent, peak
+            concurrent += 1
+            peak = max(peak, concurrent)
+            await asyncio.sleep(0.05)
+            concurrent -= 1
+
+        pool = WorkerPool(handler, size=3)
+        pool.start()
+        for name in ["crd1", "crd2", "crd3", "crd4"]:
+            await pool.submit(name, name)
+        await pool.join()
+        await pool.stop()
+
+        assert peak == 3
+
+    @pytest.mark.asyncio
+    async def test_follow_ups_are_queued(self):
+        """
+        An item returned by the handler is queued again for the same
+        key, unless follow ups are disabled
+        """
+        handled = []
+
+        async def handler(step):
+            handled.append(step)
+            return step + 1 if step < 3 else None
+
+        pool = WorkerPool(handler, size=2)
+        pool.start()
+        await pool.submit("crd1", 1)
+        await pool.join()
+        await pool.stop()
+        assert handled == [1, 2, 3]
+
+        handled.clear()
+        pool = WorkerPool(handler, size=2, follow_ups=False)
+        pool.start()
+        await pool.submit("crd1", 1)
+        await pool.join()
+        await pool.stop()
+        assert handled == [1]
+
+    @pytest.mark.asyncio
+    async def test_unhandled_errors_are_raised(self):
+        """
+        Anything escaping the handler is re-raised to the watch loop
+        """
+        async def handler(_item):
+            raise ValueError("boom")
+
+        pool = WorkerPool(handler, size=1)
+        pool.start()
+        await pool.submit("crd1", "crd1")
+        with pytest.raises(ValueError):
+            await pool.join()
+        await pool.stop()